@@ -4,6 +4,8 @@ from django.shortcuts import render
 from django.template.response import TemplateResponse
 from .models import Movie, Review
 from .tmdb_api import TMDBApi
+from .tmdb_cache import get_response_cache
+from .tmdb_throttle import get_circuit_breaker
 from django.utils.html import format_html
 
 
@@ -65,6 +67,12 @@ class TMDBApiAdmin:
                 'message': 'Failed to retrieve popular movies',
                 'data': result
             })
+    
+    def tmdb_cache_stats(self, request):
+        """Счетчики попаданий/промахов кэша ответов TMDB для текущего воркера"""
+        stats = get_response_cache().stats()
+        stats['circuit_breaker'] = get_circuit_breaker().state
+        return JsonResponse(stats)
 
 
 # Настраиваем шаблон главной страницы админки
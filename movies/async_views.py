@@ -0,0 +1,305 @@
+"""
+Асинхронные версии самых посещаемых страниц для запуска под ASGI.
+
+Подключаются в movies/urls.py при ASYNC_VIEWS=True. Независимые запросы к
+TMDB и к БД выполняются одновременно, а не по очереди. Отправка форм отзывов
+(POST) делегируется синхронным представлениям из views.py.
+"""
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.contrib import messages
+from django.shortcuts import render, redirect
+from django.utils import timezone
+
+from . import views
+from .models import Movie, Review, TVShow, Season, Episode, TVShowReview, SeasonReview
+from .models import MovieWatchStatus, TVShowWatchStatus, WatchStatus
+from .forms import MovieSearchForm, ReviewForm, TVShowReviewForm, SeasonReviewForm
+from .tmdb_api_async import AsyncTMDBApi
+from .ingest import upsert_movies, upsert_tv_shows, resolve_existing
+from .freshness import schedule_movie_refresh, schedule_tv_show_refresh, has_tv_show_details
+from .image_cache import resolve_posters
+
+
+async def _get_user(request):
+    """Возвращает аутентифицированного пользователя или None (request.user ленивый и обращается к БД)"""
+    return await sync_to_async(lambda: request.user if request.user.is_authenticated else None)()
+
+
+async def _list(queryset):
+    return [obj async for obj in queryset]
+
+
+async def _render(request, template_name, context):
+    # Шаблоны могут обращаться к связанным объектам, поэтому рендерим в синхронном потоке
+    return await sync_to_async(render)(request, template_name, context)
+
+
+async def _cache_poster(obj, path_attr='poster_path', url_attr='cached_poster_url'):
+    await sync_to_async(resolve_posters)([obj], path_attr, url_attr)
+
+
+async def _get_or_fetch_tvshow(tmdb_api, tmdb_id):
+    """Сериал из БД или, если его нет, из TMDB с сохранением. None - если не найден"""
+    try:
+        return await TVShow.objects.aget(tmdb_id=tmdb_id)
+    except TVShow.DoesNotExist:
+        tvshow_data = await tmdb_api.get_tv_show_details(tmdb_id)
+        if not tvshow_data:
+            return None
+        return await TVShow.objects.acreate(**tmdb_api.format_tv_show_data(tvshow_data),
+                                            details_updated_at=timezone.now())
+
+
+async def home(request):
+    """Async version of views.home: TMDB and DB lookups are issued together"""
+    tmdb_api = AsyncTMDBApi()
+    form = MovieSearchForm(request.GET)
+
+    if form.is_valid() and form.cleaned_data.get('query'):
+        query = form.cleaned_data['query']
+        movie_search_results, tvshow_search_results = await asyncio.gather(
+            tmdb_api.search_movies(query),
+            tmdb_api.search_tv_shows(query),
+        )
+
+        movie_results = []
+        if movie_search_results and 'results' in movie_search_results:
+            movie_results = await sync_to_async(resolve_existing)(Movie, [
+                tmdb_api.format_movie_data(movie_data)
+                for movie_data in movie_search_results['results']
+            ])
+
+        tvshow_results = []
+        if tvshow_search_results and 'results' in tvshow_search_results:
+            tvshow_results = await sync_to_async(resolve_existing)(TVShow, [
+                tmdb_api.format_tv_show_data(tvshow_data)
+                for tvshow_data in tvshow_search_results['results']
+            ])
+
+        movie_results = await sync_to_async(views.process_movie_posters)(movie_results)
+        tvshow_results = await sync_to_async(views.process_tvshow_posters)(tvshow_results)
+
+        context = {
+            'search_form': form,
+            'movie_results': movie_results,
+            'tvshow_results': tvshow_results,
+            'query': query,
+            'search_mode': True
+        }
+        return await _render(request, 'movies/home.html', context)
+
+    popular_movies_data, popular_tvshows_data, local_movies, local_tvshows = await asyncio.gather(
+        tmdb_api.get_popular_movies(),
+        tmdb_api.get_popular_tv_shows(),
+        _list(Movie.objects.filter(review_count__gt=0).order_by('-avg_rating', '-review_count')[:4]),
+        _list(TVShow.objects.filter(review_count__gt=0).order_by('-avg_rating', '-review_count')[:4]),
+    )
+
+    movies = []
+    if popular_movies_data and 'results' in popular_movies_data:
+        movies = await sync_to_async(upsert_movies)([
+            tmdb_api.format_movie_data(movie_data)
+            for movie_data in popular_movies_data['results'][:8]
+        ])
+
+    tvshows = []
+    if popular_tvshows_data and 'results' in popular_tvshows_data:
+        tvshows = await sync_to_async(upsert_tv_shows)([
+            tmdb_api.format_tv_show_data(tvshow_data)
+            for tvshow_data in popular_tvshows_data['results'][:8]
+        ])
+
+    movies = await sync_to_async(views.process_movie_posters)(movies)
+    tvshows = await sync_to_async(views.process_tvshow_posters)(tvshows)
+    local_movies = await sync_to_async(views.process_movie_posters)(local_movies)
+    local_tvshows = await sync_to_async(views.process_tvshow_posters)(local_tvshows)
+
+    context = {
+        'popular_movies': movies,
+        'popular_tvshows': tvshows,
+        'reviewed_movies': local_movies,
+        'reviewed_tvshows': local_tvshows,
+        'search_form': MovieSearchForm()
+    }
+    return await _render(request, 'movies/home.html', context)
+
+
+async def movie_detail(request, tmdb_id):
+    """Async version of views.movie_detail"""
+    if request.method == 'POST':
+        return await sync_to_async(views.movie_detail)(request, tmdb_id)
+
+    user = await _get_user(request)
+    tmdb_api = AsyncTMDBApi()
+
+    try:
+        movie = await Movie.objects.aget(tmdb_id=tmdb_id)
+        schedule_movie_refresh(movie)
+    except Movie.DoesNotExist:
+        movie_data = await tmdb_api.get_movie_details(tmdb_id)
+        if not movie_data:
+            messages.error(request, "Movie not found")
+            return redirect('home')
+        movie = await Movie.objects.acreate(**tmdb_api.format_movie_data(movie_data),
+                                            details_updated_at=timezone.now())
+
+    async def load_user_state():
+        if user is None:
+            return None, None, False
+        return await asyncio.gather(
+            Review.objects.filter(user=user, movie=movie).afirst(),
+            MovieWatchStatus.objects.filter(user=user, movie=movie).afirst(),
+            movie.favorited_by.filter(id=user.id).aexists(),
+        )
+
+    _, reviews, (user_review, user_watch_status, is_favorite) = await asyncio.gather(
+        _cache_poster(movie),
+        _list(movie.reviews.select_related('user').all()),
+        load_user_state(),
+    )
+
+    context = {
+        'movie': movie,
+        'reviews': reviews,
+        'form': ReviewForm(instance=user_review),
+        'user_review': user_review,
+        'is_favorite': is_favorite,
+        'user_watch_status': user_watch_status,
+        'watch_statuses': WatchStatus.choices
+    }
+    return await _render(request, 'movies/movie_detail.html', context)
+
+
+async def tvshow_detail(request, tmdb_id):
+    """Async version of views.tvshow_detail"""
+    if request.method == 'POST':
+        return await sync_to_async(views.tvshow_detail)(request, tmdb_id)
+
+    user = await _get_user(request)
+    tmdb_api = AsyncTMDBApi()
+
+    try:
+        tvshow = await TVShow.objects.aget(tmdb_id=tmdb_id)
+        if has_tv_show_details(tvshow):
+            schedule_tv_show_refresh(tvshow)
+        else:
+            tvshow_data = await tmdb_api.get_tv_show_details(tmdb_id)
+            if tvshow_data:
+                tvshow_dict = tmdb_api.format_tv_show_data(tvshow_data)
+                for key, value in tvshow_dict.items():
+                    setattr(tvshow, key, value)
+                tvshow.details_updated_at = timezone.now()
+                # Только поля из TMDB - агрегаты отзывов обновляются отдельно (см. ratings.py)
+                await tvshow.asave(update_fields=[*tvshow_dict, 'details_updated_at', 'updated_at'])
+    except TVShow.DoesNotExist:
+        tvshow_data = await tmdb_api.get_tv_show_details(tmdb_id)
+        if not tvshow_data:
+            messages.error(request, "TV show not found")
+            return redirect('tvshows_home')
+        tvshow = await TVShow.objects.acreate(**tmdb_api.format_tv_show_data(tvshow_data),
+                                              details_updated_at=timezone.now())
+
+    async def load_seasons():
+        seasons_data = await tmdb_api.get_seasons_details(tmdb_id, range(1, tvshow.number_of_seasons + 1))
+        seasons = []
+        for season_number in range(1, tvshow.number_of_seasons + 1):
+            season_data = seasons_data.get(season_number)
+            if season_data:
+                season_dict = tmdb_api.format_season_data(season_data, tvshow.id)
+                season, created = await Season.objects.aget_or_create(
+                    tv_show_id=tvshow.id,
+                    season_number=season_number,
+                    defaults=season_dict
+                )
+                seasons.append(season)
+        return await sync_to_async(resolve_posters)(seasons)
+
+    async def load_user_state():
+        if user is None:
+            return None, None, False
+        return await asyncio.gather(
+            TVShowReview.objects.filter(user=user, tvshow=tvshow).afirst(),
+            TVShowWatchStatus.objects.filter(user=user, tvshow=tvshow).afirst(),
+            tvshow.favorited_by.filter(id=user.id).aexists(),
+        )
+
+    _, seasons, reviews, (user_review, user_watch_status, is_favorite) = await asyncio.gather(
+        _cache_poster(tvshow),
+        load_seasons(),
+        _list(tvshow.reviews.select_related('user').all()),
+        load_user_state(),
+    )
+
+    context = {
+        'tvshow': tvshow,
+        'seasons': seasons,
+        'reviews': reviews,
+        'form': TVShowReviewForm(instance=user_review),
+        'user_review': user_review,
+        'is_favorite': is_favorite,
+        'user_watch_status': user_watch_status,
+        'watch_statuses': WatchStatus.choices
+    }
+    return await _render(request, 'movies/tvshow_detail.html', context)
+
+
+async def season_detail(request, tmdb_id, season_number):
+    """Async version of views.season_detail: the show and the season are loaded together"""
+    if request.method == 'POST':
+        return await sync_to_async(views.season_detail)(request, tmdb_id, season_number)
+
+    user = await _get_user(request)
+    tmdb_api = AsyncTMDBApi()
+
+    tvshow, season_data = await asyncio.gather(
+        _get_or_fetch_tvshow(tmdb_api, tmdb_id),
+        tmdb_api.get_season_details(tmdb_id, season_number),
+    )
+    if tvshow is None:
+        messages.error(request, "TV show not found")
+        return redirect('tvshows_home')
+    if not season_data:
+        messages.error(request, "Season not found")
+        return redirect('tvshow_detail', tmdb_id=tmdb_id)
+
+    season, created = await Season.objects.aget_or_create(
+        tv_show_id=tvshow.id,
+        season_number=season_number,
+        defaults=tmdb_api.format_season_data(season_data, tvshow.id)
+    )
+
+    async def load_episodes():
+        episodes = []
+        for episode_data in season_data.get('episodes', []):
+            episode, created = await Episode.objects.aget_or_create(
+                tv_show=tvshow,
+                season=season,
+                episode_number=episode_data.get('episode_number'),
+                defaults=tmdb_api.format_episode_data(episode_data, tvshow.id, season.id)
+            )
+            episodes.append(episode)
+        return await sync_to_async(resolve_posters)(episodes, 'still_path', 'cached_still_url')
+
+    async def load_user_review():
+        if user is None:
+            return None
+        return await SeasonReview.objects.filter(user=user, season=season).afirst()
+
+    _, episodes, reviews, user_review = await asyncio.gather(
+        _cache_poster(season),
+        load_episodes(),
+        _list(season.reviews.select_related('user').all()),
+        load_user_review(),
+    )
+
+    context = {
+        'tvshow': tvshow,
+        'season': season,
+        'episodes': episodes,
+        'reviews': reviews,
+        'form': SeasonReviewForm(instance=user_review),
+        'user_review': user_review
+    }
+    return await _render(request, 'movies/season_detail.html', context)
@@ -0,0 +1,77 @@
+"""
+Политика свежести для данных TMDB, сохраненных в локальной БД.
+
+Свежая запись отдается прямо из БД, устаревшая тоже отдается сразу, но в
+фоне планируется ее обновление из TMDB. Блокирующий запрос к TMDB нужен
+только когда записи нет.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Movie, TVShow
+from .tasks import run_in_background
+from .tmdb_api import TMDBApi
+
+logger = logging.getLogger(__name__)
+
+
+def is_stale(obj, max_age=None):
+    """
+    Check whether the details of a TMDB-backed row are older than the freshness window.
+
+    Popular and search list upserts bump updated_at as well, so freshness is
+    judged by details_updated_at, which only detail fetches set.
+    """
+    if max_age is None:
+        max_age = getattr(settings, 'TMDB_DETAIL_MAX_AGE', 6 * 60 * 60)
+    if obj.details_updated_at is None:
+        return True
+    return timezone.now() - obj.details_updated_at > timedelta(seconds=max_age)
+
+
+def has_tv_show_details(tvshow):
+    """
+    Popular and search lists do not include status or season counts, so a
+    show only seen in such lists must still be fetched before rendering.
+    """
+    return bool(tvshow.status)
+
+
+def refresh_movie(tmdb_id):
+    """Re-fetch a movie from TMDB and update its row"""
+    tmdb_api = TMDBApi()
+    # Мимо кэша ответов: его TTL для деталей больше окна свежести
+    movie_data = tmdb_api.get_movie_details(tmdb_id, refresh=True)
+    if not movie_data:
+        return False
+    movie_dict = tmdb_api.format_movie_data(movie_data)
+    now = timezone.now()
+    Movie.objects.filter(tmdb_id=tmdb_id).update(updated_at=now, details_updated_at=now, **movie_dict)
+    return True
+
+
+def refresh_tv_show(tmdb_id):
+    """Re-fetch a TV show from TMDB and update its row"""
+    tmdb_api = TMDBApi()
+    tvshow_data = tmdb_api.get_tv_show_details(tmdb_id, refresh=True)
+    if not tvshow_data:
+        return False
+    tvshow_dict = tmdb_api.format_tv_show_data(tvshow_data)
+    now = timezone.now()
+    TVShow.objects.filter(tmdb_id=tmdb_id).update(updated_at=now, details_updated_at=now, **tvshow_dict)
+    return True
+
+
+def schedule_movie_refresh(movie):
+    """Schedule a background refresh if the movie row is stale"""
+    if is_stale(movie):
+        run_in_background(f'refresh-movie-{movie.tmdb_id}', refresh_movie, movie.tmdb_id)
+
+
+def schedule_tv_show_refresh(tvshow):
+    """Schedule a background refresh if the TV show row is stale"""
+    if is_stale(tvshow):
+        run_in_background(f'refresh-tvshow-{tvshow.tmdb_id}', refresh_tv_show, tvshow.tmdb_id)
@@ -1,180 +1,660 @@
 import os
-import json
-import requests
-from datetime import datetime, timedelta
+import threading
+import time
+from datetime import timedelta
 from django.conf import settings
+from django.core.cache import caches
 from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile
+from django.db.models import Sum
+from django.utils import timezone
+import hashlib
 import logging
+from collections import OrderedDict, namedtuple
+
+from .image_derivatives import (
+    FORMAT_OPTIONS, MIME_TYPES, derivative_path, derivative_paths, generate_derivatives, generate_placeholder,
+)
+from .models import CachedPoster, Episode, Movie, Season, TVShow
+from .tasks import run_in_background, run_in_pool
+from .tmdb_api import get_session, get_timeout
+from .tmdb_cache import SingleFlight
 
 logger = logging.getLogger(__name__)
 
-def get_or_cache_poster(poster_path, size='w500', max_age_days=14):
+# Время последнего доступа не пишется в БД при каждом попадании в кэш:
+# пути копятся в памяти и периодически обновляются одним UPDATE в фоне
+_access_buffer = set()
+_access_lock = threading.Lock()
+_last_flush = time.monotonic()
+
+
+def _record_access(local_path):
+    with _access_lock:
+        _access_buffer.add(local_path)
+        due = time.monotonic() - _last_flush >= getattr(settings, 'POSTER_ACCESS_FLUSH_INTERVAL', 60)
+    if due:
+        run_in_background('poster-access-flush', flush_access_log)
+
+
+def flush_access_log():
     """
-    Получает URL постера фильма, кэшируя его на сервере.
-    
-    Args:
-        poster_path: Путь к постеру в TMDB (например, '/abc123.jpg')
-        size: Размер изображения (w500, original и т.д.)
-        max_age_days: Максимальный возраст кэша в днях
-        
+    Записывает накопленные обращения к кэшу в индекс.
+
     Returns:
-        URL к кэшированному изображению или None, если изображение недоступно
+        Количество обновленных путей
     """
-    if not poster_path:
+    global _last_flush
+    with _access_lock:
+        paths = list(_access_buffer)
+        _access_buffer.clear()
+        _last_flush = time.monotonic()
+
+    now = timezone.now()
+    for i in range(0, len(paths), 500):
+        CachedPoster.objects.filter(path__in=paths[i:i + 500]).update(last_accessed=now)
+    return len(paths)
+
+
+class PosterInfo(namedtuple('PosterInfo', ['cached_date', 'formats', 'widths', 'color',
+                                           'content_hash', 'file_size'])):
+    """
+    Сведения об изображении из индекса, нужные для построения разметки и учета размера кэша.
+
+    Заглушка (data URI) сюда не входит: она занимает больше всех остальных полей
+    вместе взятых и нужна только на отображаемой странице - ее читает resolve_posters.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_index(cls, cached_date, formats, widths, color='', content_hash='', file_size=0):
+        return cls(
+            cached_date,
+            tuple(fmt for fmt in formats.split(',') if fmt),
+            tuple(int(width) for width in widths.split(',') if width),
+            color,
+            content_hash,
+            file_size,
+        )
+
+
+class PosterPresence:
+    """
+    Какие изображения есть в кэше: путь -> PosterInfo, в памяти процесса.
+
+    Загружается из индекса при первом обращении, обновляется при загрузке
+    и удалении файлов этим процессом и периодически перечитывается в фоне
+    (POSTER_PRESENCE_RELOAD_INTERVAL), чтобы увидеть изменения других воркеров.
+
+    Удаление изображений любым процессом (вытеснение, clean_image_cache)
+    увеличивает счетчик поколений в общем Django-кэше (invalidate). Воркеры
+    сверяют его не чаще раза в POSTER_PRESENCE_CHECK_INTERVAL секунд и при
+    изменении перечитывают набор в фоне, не дожидаясь плановой загрузки;
+    запросы тем временем пользуются прежним набором.
+
+    Попутно ведет текущий размер кэша (total_size) - по нему без запросов
+    к БД определяется, что пора запускать вытеснение.
+    """
+    GENERATION_KEY = 'poster-presence:generation'
+
+    def __init__(self):
+        self._entries = {}
+        self._loaded_at = None
+        self._generation = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self.total_size = 0
+
+    @property
+    def shared(self):
+        return caches[getattr(settings, 'TMDB_CACHE_ALIAS', 'default')]
+
+    def _shared_generation(self):
+        try:
+            return self.shared.get(self.GENERATION_KEY, 0)
+        except Exception as e:
+            logger.warning(f"Poster presence generation unavailable: {e}")
+            return None
+
+    def reload(self):
+        # Поколение читается до индекса: удаления во время чтения приведут к повторной загрузке
+        generation = self._shared_generation()
+        rows = CachedPoster.objects.values_list('path', *INFO_FIELDS)
+        entries = {path: PosterInfo.from_index(*info) for path, *info in rows.iterator(chunk_size=2000)}
+        with self._lock:
+            self._entries = entries
+            self.total_size = sum(info.file_size for info in entries.values())
+            self._loaded_at = self._checked_at = time.monotonic()
+            self._generation = generation
+        return len(entries)
+
+    def _ensure_loaded(self):
+        if self._loaded_at is None:
+            # Одновременные первые запросы ждут одну загрузку, а не читают индекс каждый
+            with self._load_lock:
+                if self._loaded_at is None:
+                    self.reload()
+            return
+        now = time.monotonic()
+        stale = now - self._loaded_at >= getattr(settings, 'POSTER_PRESENCE_RELOAD_INTERVAL', 300)
+        if not stale and now - self._checked_at >= getattr(settings, 'POSTER_PRESENCE_CHECK_INTERVAL', 5):
+            self._checked_at = now
+            generation = self._shared_generation()
+            stale = generation is not None and generation != self._generation
+        if stale:
+            run_in_background('poster-presence-reload', self.reload)
+
+    def invalidate(self):
+        """Сообщает всем воркерам, что изображения удалены (вызывать после удаления записей индекса)"""
+        try:
+            try:
+                generation = self.shared.incr(self.GENERATION_KEY)
+            except ValueError:
+                # Счетчика еще нет или он вытеснен из кэша
+                generation = 1 if self.shared.add(self.GENERATION_KEY, 1, timeout=None) \
+                    else self.shared.incr(self.GENERATION_KEY)
+        except Exception as e:
+            logger.warning(f"Poster presence generation unavailable: {e}")
+            return
+        with self._lock:
+            # Свои удаления набор уже учел (discard); чужие, случившиеся между проверками, - нет
+            if self._generation is not None and generation == self._generation + 1:
+                self._generation = generation
+
+    def get(self, local_path):
+        """PosterInfo изображения или None, если его нет в кэше"""
+        self._ensure_loaded()
+        return self._entries.get(local_path)
+
+    def add(self, local_path, info):
+        with self._lock:
+            previous = self._entries.get(local_path)
+            self._entries[local_path] = info
+            self.total_size += info.file_size - (previous.file_size if previous else 0)
+
+    def discard(self, local_path):
+        with self._lock:
+            previous = self._entries.pop(local_path, None)
+            if previous:
+                self.total_size -= previous.file_size
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self.total_size = 0
+            self._loaded_at = None
+            self._generation = None
+
+
+class PosterFailures:
+    """
+    Негативный кэш: изображения, загрузка которых не удалась.
+
+    После неудачи путь не запрашивается у TMDB до retry_at; задержка растет
+    экспоненциально с числом неудач подряд. 404 откладывается надолго
+    (POSTER_MISSING_BACKOFF_BASE), сетевые ошибки и 5xx - на короткое время
+    (POSTER_RETRY_BACKOFF_BASE), обе не дольше POSTER_RETRY_BACKOFF_MAX.
+
+    Страницы проверяют только копию в памяти процесса; общий Django-кэш
+    (TMDB_CACHE_ALIAS) читается в фоновой загрузке, чтобы неудачи одного
+    воркера видели остальные.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def shared(self):
+        return caches[getattr(settings, 'TMDB_CACHE_ALIAS', 'default')]
+
+    @staticmethod
+    def _key(local_path):
+        return 'poster-failure:' + hashlib.sha1(local_path.encode('utf-8')).hexdigest()
+
+    def _set_local(self, local_path, entry):
+        with self._lock:
+            self._local[local_path] = entry
+            self._local.move_to_end(local_path)
+            while len(self._local) > self.max_entries:
+                self._local.popitem(last=False)
+
+    def get(self, local_path):
+        """Запись о неудаче, если повтор еще не разрешен, иначе None (без обращения к общему кэшу)"""
+        entry = self._local.get(local_path)
+        if entry and entry['retry_at'] > time.time():
+            return entry
         return None
-        
-    # Удалить начальный слэш, если есть
-    if poster_path.startswith('/'):
-        poster_path = poster_path[1:]
-        
-    # Пути для файлов
-    local_path = f"posters/{size}/{poster_path}"
-    meta_path = f"posters/{size}/{poster_path}.meta"
-    
-    # Проверка на существование файла и его возраст
-    if default_storage.exists(local_path):
-        # Проверяем метаданные
-        if default_storage.exists(meta_path):
+
+    def check_shared(self, local_path):
+        """То же, что get(), но с учетом неудач других воркеров"""
+        try:
+            entry = self.shared.get(self._key(local_path))
+        except Exception as e:
+            logger.warning(f"Poster failure cache error on get: {e}")
+            entry = None
+        if entry:
+            self._set_local(local_path, entry)
+        return self.get(local_path)
+
+    def record_failure(self, local_path, missing):
+        previous = self._local.get(local_path) or {}
+        failures = previous.get('failures', 0) + 1
+        base = getattr(settings, 'POSTER_MISSING_BACKOFF_BASE' if missing else 'POSTER_RETRY_BACKOFF_BASE',
+                       3600 if missing else 60)
+        max_delay = getattr(settings, 'POSTER_RETRY_BACKOFF_MAX', 24 * 60 * 60)
+        delay = min(max_delay, base * 2 ** (failures - 1))
+        entry = {'failures': failures, 'missing': missing, 'retry_at': time.time() + delay}
+        self._set_local(local_path, entry)
+        try:
+            # Запись хранится дольше задержки, чтобы следующая неудача продолжила рост задержки
+            self.shared.set(self._key(local_path), entry, timeout=max_delay * 2)
+        except Exception as e:
+            logger.warning(f"Poster failure cache error on set: {e}")
+        return entry
+
+    def record_success(self, local_path):
+        with self._lock:
+            known = self._local.pop(local_path, None)
+        if known:
             try:
-                meta_content = default_storage.open(meta_path).read()
-                metadata = json.loads(meta_content.decode('utf-8'))
-                cached_date = datetime.fromisoformat(metadata['cached_date'])
-                
-                # Проверка возраста
-                if datetime.now() - cached_date < timedelta(days=max_age_days):
-                    # Обновляем дату последнего доступа
-                    metadata['last_accessed'] = datetime.now().isoformat()
-                    default_storage.delete(meta_path)
-                    default_storage.save(meta_path, ContentFile(json.dumps(metadata).encode('utf-8')))
-                    return default_storage.url(local_path)
-                # Иначе продолжаем и перезагружаем
+                self.shared.delete(self._key(local_path))
             except Exception as e:
-                logger.warning(f"Error reading metadata for {poster_path}: {e}")
-                
-    # Загрузить изображение с TMDB
-    tmdb_url = f"https://image.tmdb.org/t/p/{size}/{poster_path}"
+                logger.warning(f"Poster failure cache error on delete: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._local.clear()
+
+
+poster_presence = PosterPresence()
+poster_failures = PosterFailures()
+_download_flight = SingleFlight()
+
+# Поля индекса в порядке полей PosterInfo
+INFO_FIELDS = ('cached_date', 'formats', 'widths', 'color', 'content_hash', 'file_size')
+
+# Размеры изображений TMDB (постеры и кадры эпизодов); другие значения poster_file не принимает
+IMAGE_SIZES = frozenset({'w92', 'w154', 'w185', 'w300', 'w342', 'w500', 'w780', 'original'})
+
+
+def poster_local_path(poster_path, size='w500'):
+    """Путь изображения в хранилище - однозначно определяется путем в TMDB и размером"""
+    return f"posters/{size}/{poster_path.lstrip('/')}"
+
+
+def _poster_url_base():
+    # С POSTER_X_ACCEL_REDIRECT изображения идут через представление poster_file (/posters/...),
+    # иначе nginx отдает их напрямую из MEDIA_ROOT по MEDIA_URL
+    return '/' if getattr(settings, 'POSTER_X_ACCEL_REDIRECT', False) else settings.MEDIA_URL
+
+
+def poster_media_url(local_path, content_hash=''):
+    """
+    URL кэшированного изображения, без обращения к хранилищу.
+
+    С хешем содержимого (?v=...) URL неизменяем: новая версия файла получает
+    новый URL, поэтому браузеры и CDN могут кэшировать его навсегда.
+    """
+    url = f"{_poster_url_base()}{local_path}"
+    return f"{url}?v={content_hash}" if content_hash else url
+
+
+def content_hash(content):
+    return hashlib.sha1(content).hexdigest()[:12]
+
+
+def tmdb_image_url(poster_path, size='w500'):
+    """URL изображения на CDN TMDB"""
+    return f"https://image.tmdb.org/t/p/{size}/{poster_path.lstrip('/')}"
+
+
+def _cached_info(url):
+    base = _poster_url_base()
+    if not url or not url.startswith(f"{base}posters/"):
+        return None, None
+    local_path = url[len(base):].partition('?')[0]
+    return local_path, poster_presence.get(local_path)
+
+
+def poster_sources(url):
+    """
+    Варианты <source> для <picture> по URL кэшированного изображения.
+
+    Returns:
+        Список пар (MIME-тип, srcset); пустой, если изображение не из кэша
+        или для него нет производных
+    """
+    local_path, info = _cached_info(url)
+    if not info:
+        return []
+    return [
+        (MIME_TYPES[fmt], ', '.join(
+            f"{poster_media_url(derivative_path(local_path, width, fmt), info.content_hash)} {width}w"
+            for width in info.widths
+        ))
+        for fmt in FORMAT_OPTIONS if fmt in info.formats
+    ]
+
+
+def poster_color(url):
+    """Средний цвет кэшированного изображения; пустая строка, если его нет"""
+    local_path, info = _cached_info(url)
+    return info.color if info else ''
+
+
+def delete_poster_files(path, formats='', widths=''):
+    """
+    Удаляет изображение кэша вместе с его производными.
+
+    Другие воркеры узнают об удалении после poster_presence.invalidate(),
+    который вызывающий код делает после удаления записей из индекса.
+    """
+    info = PosterInfo.from_index(None, formats, widths)
+    for file_path in [path] + derivative_paths(path, info.formats, info.widths):
+        default_storage.delete(file_path)
+    poster_presence.discard(path)
+
+
+def download_poster(poster_path, size='w500', max_age_days=None):
+    """
+    Загружает изображение с TMDB в хранилище и записывает его в индекс.
+
+    Args:
+        poster_path: Путь к постеру в TMDB (без начального слэша)
+        size: Размер изображения (w500, original и т.д.)
+        max_age_days: Если задан, свежая копия из индекса (например, загруженная
+            другим воркером) не загружается повторно
+
+    Returns:
+        URL к кэшированному изображению или None, если загрузка не удалась
+    """
+    local_path = poster_local_path(poster_path, size)
+    if poster_failures.check_shared(local_path):
+        return None
+    if max_age_days is not None:
+        row = CachedPoster.objects.filter(path=local_path).values_list(*INFO_FIELDS).first()
+        if row and timezone.now() - row[0] < timedelta(days=max_age_days):
+            info = PosterInfo.from_index(*row)
+            poster_presence.add(local_path, info)
+            return poster_media_url(local_path, info.content_hash)
     try:
-        response = requests.get(tmdb_url, timeout=10)
+        # Общая сессия с пулом соединений - keep-alive до image.tmdb.org между загрузками
+        response = get_session().get(tmdb_image_url(poster_path, size), timeout=get_timeout())
         if response.status_code == 200:
             # Создаем директорию, если её нет
             path_dir = os.path.dirname(local_path)
             os.makedirs(os.path.join(settings.MEDIA_ROOT, path_dir), exist_ok=True)
-            
-            # Сохранить изображение
+
+            # Сохранить изображение (старую копию удаляем, иначе хранилище сохранит файл под другим именем)
+            if default_storage.exists(local_path):
+                default_storage.delete(local_path)
             default_storage.save(local_path, ContentFile(response.content))
-            
-            # Сохранить метаданные
-            metadata = {
-                'cached_date': datetime.now().isoformat(),
-                'last_accessed': datetime.now().isoformat(),
-                'original_url': tmdb_url,
-                'size': size,
-                'file_size': len(response.content)
-            }
-            default_storage.save(meta_path, ContentFile(json.dumps(metadata).encode('utf-8')))
-            
+
+            # Уменьшенные копии для srcset; без них отдается оригинал
+            try:
+                formats, widths, derivatives_size = generate_derivatives(local_path, response.content)
+            except Exception as e:
+                logger.warning(f"Failed to generate derivatives for {poster_path}: {e}")
+                formats, widths, derivatives_size = [], [], 0
+            try:
+                color, placeholder = generate_placeholder(response.content)
+            except Exception as e:
+                logger.warning(f"Failed to generate placeholder for {poster_path}: {e}")
+                color, placeholder = '', ''
+
+            # Записать в индекс (размер - вместе с производными)
+            now = timezone.now()
+            version = content_hash(response.content)
+            file_size = len(response.content) + derivatives_size
+            CachedPoster.objects.update_or_create(
+                path=local_path,
+                defaults={
+                    'size': size,
+                    'file_size': file_size,
+                    'cached_date': now,
+                    'last_accessed': now,
+                    'formats': ','.join(formats),
+                    'widths': ','.join(map(str, widths)),
+                    'color': color,
+                    'placeholder': placeholder,
+                    'content_hash': version,
+                }
+            )
+
+            poster_presence.add(local_path, PosterInfo(
+                now, tuple(formats), tuple(widths), color, version, file_size
+            ))
+            if poster_presence.total_size > cache_budget():
+                run_in_background('poster-cache-evict', evict_to_budget)
+
+            poster_failures.record_success(local_path)
+
             logger.info(f"Cached poster {poster_path} (size: {size})")
-            return default_storage.url(local_path)
+            return poster_media_url(local_path, version)
         else:
-            logger.warning(f"Failed to download poster {poster_path}: HTTP {response.status_code}")
+            failure = poster_failures.record_failure(local_path, missing=response.status_code == 404)
+            logger.warning(f"Failed to download poster {poster_path}: HTTP {response.status_code} "
+                           f"(failure #{failure['failures']})")
     except Exception as e:
-        logger.error(f"Error downloading poster {poster_path}: {e}")
-        
+        failure = poster_failures.record_failure(local_path, missing=False)
+        logger.error(f"Error downloading poster {poster_path}: {e} (failure #{failure['failures']})")
+
     return None
 
-def check_cache_size(max_size_mb=500):
+
+def is_known_image(poster_path):
+    """
+    Есть ли изображение у фильма, сериала, сезона или эпизода в БД.
+
+    poster_file загружает с TMDB только такие изображения - иначе любой
+    запрос с произвольным путем стоил бы загрузки или записи в негативный кэш.
+    """
+    tmdb_path = '/' + poster_path.lstrip('/')
+    return any(model.objects.filter(**{field: tmdb_path}).exists() for model, field in (
+        (Movie, 'poster_path'), (TVShow, 'poster_path'), (Season, 'poster_path'), (Episode, 'still_path'),
+    ))
+
+
+def fetch_poster(poster_path, size='w500', max_age_days=14):
+    """
+    Загружает постер немедленно (для poster_file при промахе кэша).
+
+    Одновременные запросы одного и того же изображения ждут одну загрузку.
+
+    Returns:
+        URL к кэшированному изображению или None, если загрузка не удалась
     """
-    Проверяет размер кэша и очищает старые файлы, если превышен лимит
-    
+    local_path = poster_local_path(poster_path, size)
+    return _download_flight.do(local_path, lambda: download_poster(poster_path, size, max_age_days))
+
+
+def schedule_poster_download(poster_path, size='w500', max_age_days=None):
+    """
+    Ставит загрузку постера в очередь пула 'posters'.
+
+    Число одновременных загрузок ограничено размером пула
+    (POSTER_DOWNLOAD_WORKERS), повторная постановка того же пути
+    игнорируется, пока загрузка не завершилась.
+    """
+    poster_path = poster_path.lstrip('/')
+    run_in_pool('posters', f"poster-download:{size}/{poster_path}", download_poster, poster_path, size, max_age_days)
+
+
+def get_or_cache_poster(poster_path, size='w500', max_age_days=14):
+    """
+    Получает URL постера фильма, кэшируя его на сервере.
+
+    Рендер страницы не ждет загрузки с TMDB: при промахе загрузка ставится
+    в фоновую очередь, а возвращается URL изображения на CDN TMDB.
+
     Args:
-        max_size_mb: Максимальный размер кэша в МБ
-    
+        poster_path: Путь к постеру в TMDB (например, '/abc123.jpg')
+        size: Размер изображения (w500, original и т.д.)
+        max_age_days: Максимальный возраст кэша в днях
+
+    Returns:
+        URL к кэшированному изображению, URL на CDN TMDB или None, если постера нет (в том числе на TMDB)
+    """
+    if not poster_path:
+        return None
+
+    # Удалить начальный слэш, если есть
+    if poster_path.startswith('/'):
+        poster_path = poster_path[1:]
+
+    return _resolve_url(poster_path, size, max_age_days)
+
+
+def _resolve_url(poster_path, size, max_age_days):
+    # Попадание в кэш проверяется по набору в памяти - без запросов к БД и хранилищу
+    local_path = poster_local_path(poster_path, size)
+    info = poster_presence.get(local_path)
+    if info:
+        _record_access(local_path)
+        if timezone.now() - info.cached_date >= timedelta(days=max_age_days):
+            # Устаревшую копию отдаем, пока в фоне загружается новая
+            schedule_poster_download(poster_path, size)
+        return poster_media_url(local_path, info.content_hash)
+
+    failure = poster_failures.get(local_path)
+    if failure:
+        # Недавняя неудача: не ставим загрузку повторно; отсутствующего изображения нет и на TMDB
+        return None if failure['missing'] else tmdb_image_url(poster_path, size)
+
+    if getattr(settings, 'POSTER_X_ACCEL_REDIRECT', False):
+        # poster_file загрузит изображение при первом запросе браузера
+        return poster_media_url(local_path)
+
+    # Промах: возможно, изображение уже загрузил другой воркер - это проверит фоновая задача
+    schedule_poster_download(poster_path, size, max_age_days)
+    return tmdb_image_url(poster_path, size)
+
+
+def resolve_posters(objects, path_attr='poster_path', url_attr='cached_poster_url', size='w500', max_age_days=14):
+    """
+    Проставляет URL изображений сразу для списка объектов.
+
+    Попадания определяются по набору в памяти (PosterPresence), промахи
+    загружаются параллельно в пуле 'posters'. Заглушки попаданий читаются
+    из индекса одним запросом и проставляются в атрибут с суффиксом
+    _placeholder вместо _url (cached_poster_placeholder). Объектам без
+    изображения атрибуты не проставляются.
+
+    Args:
+        objects: Объекты моделей или словари из API
+        path_attr: Атрибут с путем в TMDB ('poster_path', 'still_path')
+        url_attr: Атрибут для URL ('cached_poster_url', 'cached_still_url')
+        size: Размер изображения (w500, original и т.д.)
+        max_age_days: Максимальный возраст кэша в днях
+
+    Returns:
+        Тот же список объектов
+    """
+    placeholder_attr = url_attr.removesuffix('_url') + '_placeholder'
+    hits = {}
+    for obj in objects:
+        poster_path = obj.get(path_attr) if isinstance(obj, dict) else getattr(obj, path_attr, None)
+        if not poster_path:
+            continue
+        url = _resolve_url(poster_path.lstrip('/'), size, max_age_days)
+        _set(obj, url_attr, url)
+        _set(obj, placeholder_attr, '')
+        local_path, info = _cached_info(url)
+        if info:
+            hits.setdefault(local_path, []).append(obj)
+
+    if hits:
+        placeholders = CachedPoster.objects.filter(path__in=list(hits)).values_list('path', 'placeholder')
+        for local_path, placeholder in placeholders:
+            for obj in hits[local_path]:
+                _set(obj, placeholder_attr, placeholder)
+
+    return objects
+
+
+def _set(obj, attr, value):
+    if isinstance(obj, dict):
+        obj[attr] = value
+    else:
+        setattr(obj, attr, value)
+
+
+def cache_budget():
+    """Максимальный размер кэша изображений в байтах (POSTER_CACHE_MAX_SIZE_MB)"""
+    return getattr(settings, 'POSTER_CACHE_MAX_SIZE_MB', 500) * 1024 * 1024
+
+
+def evict_to_budget(max_bytes=None, target_bytes=None):
+    """
+    Вытесняет давно не использованные изображения, пока кэш не уложится в бюджет.
+
+    Работает только по индексу: размер берется одной агрегацией, порядок
+    вытеснения - по индексу last_accessed, за один проход и без обхода
+    файловой системы.
+
+    Args:
+        max_bytes: Бюджет в байтах (по умолчанию cache_budget())
+        target_bytes: До какого размера освобождать при превышении бюджета
+            (по умолчанию POSTER_CACHE_EVICT_TARGET от бюджета - с запасом,
+            чтобы вытеснение не запускалось после каждой загрузки)
+
     Returns:
         tuple: (total_size_before, total_size_after, files_removed)
     """
-    cache_dir = 'posters/'
-    total_size = 0
-    file_info = []
-    
-    # Проверяем существование директории
-    if not default_storage.exists(cache_dir):
-        return 0, 0, 0
-    
-    # Рекурсивно собираем информацию о файлах
-    def collect_file_info(dir_path):
-        nonlocal total_size
+    if max_bytes is None:
+        max_bytes = cache_budget()
+    if target_bytes is None:
+        target_bytes = max_bytes * getattr(settings, 'POSTER_CACHE_EVICT_TARGET', 0.9)
+
+    # Сначала сохраняем накопленные обращения, чтобы не удалить недавно использованные файлы
+    flush_access_log()
+
+    total_size = CachedPoster.objects.aggregate(total=Sum('file_size'))['total'] or 0
+    if total_size <= max_bytes:
+        return total_size, total_size, 0
+
+    size_to_free = total_size - target_bytes
+    files_removed = 0
+    freed = 0
+    removed_ids = []
+
+    entries = CachedPoster.objects.order_by('last_accessed').values_list('id', 'path', 'file_size', 'formats', 'widths')
+    for entry_id, path, file_size, formats, widths in entries.iterator(chunk_size=500):
         try:
-            dirs, files = default_storage.listdir(dir_path)
-            for f in files:
-                if not f.endswith('.meta'):
-                    file_path = os.path.join(dir_path, f)
-                    try:
-                        size = default_storage.size(file_path)
-                        
-                        # Получаем время последнего доступа 
-                        meta_path = file_path + '.meta'
-                        accessed_time = datetime.now() - timedelta(days=365)  # По умолчанию очень старый
-                        
-                        if default_storage.exists(meta_path):
-                            try:
-                                meta_content = default_storage.open(meta_path).read()
-                                metadata = json.loads(meta_content.decode('utf-8'))
-                                # Используем last_accessed если есть, иначе cached_date
-                                if 'last_accessed' in metadata:
-                                    accessed_time = datetime.fromisoformat(metadata['last_accessed'])
-                                else:
-                                    accessed_time = datetime.fromisoformat(metadata['cached_date'])
-                            except:
-                                pass
-                        
-                        file_info.append({
-                            'path': file_path,
-                            'size': size,
-                            'accessed': accessed_time,
-                            'meta_path': meta_path
-                        })
-                        
-                        total_size += size
-                    except Exception as e:
-                        logger.warning(f"Error processing file {file_path}: {e}")
-            
-            for d in dirs:
-                new_dir = os.path.join(dir_path, d)
-                collect_file_info(new_dir)
+            delete_poster_files(path, formats, widths)
         except Exception as e:
-            logger.error(f"Error accessing directory {dir_path}: {e}")
-    
-    collect_file_info(cache_dir)
-    
-    # Проверяем, не превышен ли лимит
+            logger.error(f"Error removing file {path}: {e}")
+            continue
+        removed_ids.append(entry_id)
+        freed += file_size
+        files_removed += 1
+        if len(removed_ids) >= 500:
+            CachedPoster.objects.filter(id__in=removed_ids).delete()
+            removed_ids = []
+        if freed >= size_to_free:
+            break
+
+    CachedPoster.objects.filter(id__in=removed_ids).delete()
+    if files_removed:
+        # Один раз за проход: каждое поколение заставляет все воркеры перечитать индекс
+        poster_presence.invalidate()
+    logger.info(f"Cache cleanup: removed {freed / (1024*1024):.2f} MB ({files_removed} files)")
+
+    return total_size, total_size - freed, files_removed
+
+
+def check_cache_size(max_size_mb=500):
+    """
+    Проверяет размер кэша и очищает давно не использованные файлы, если превышен лимит
+
+    Args:
+        max_size_mb: Максимальный размер кэша в МБ
+
+    Returns:
+        tuple: (total_size_before, total_size_after, files_removed)
+    """
     max_size_bytes = max_size_mb * 1024 * 1024
-    total_size_before = total_size
-    files_removed = 0
-    
-    if total_size > max_size_bytes:
-        # Сортируем файлы по времени доступа (самые старые в начале)
-        file_info.sort(key=lambda x: x['accessed'])
-        
-        # Удаляем старые файлы, пока не освободится достаточно места
-        size_to_free = total_size - max_size_bytes
-        freed = 0
-        
-        for file_data in file_info:
-            # Удаляем файл и его метаданные
-            try:
-                default_storage.delete(file_data['path'])
-                if default_storage.exists(file_data['meta_path']):
-                    default_storage.delete(file_data['meta_path'])
-                
-                freed += file_data['size']
-                files_removed += 1
-                
-                if freed >= size_to_free:
-                    break
-            except Exception as e:
-                logger.error(f"Error removing file {file_data['path']}: {e}")
-        
-        logger.info(f"Cache cleanup: removed {freed / (1024*1024):.2f} MB ({files_removed} files)")
-    
-    return total_size_before, total_size_before - freed if 'freed' in locals() else total_size, files_removed 
\ No newline at end of file
+    return evict_to_budget(max_size_bytes, max_size_bytes)
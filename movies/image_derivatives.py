@@ -0,0 +1,99 @@
+"""
+Производные изображения кэша постеров: уменьшенные копии в WebP (и AVIF,
+если Pillow умеет его сохранять, например с pillow-avif-plugin).
+
+Пути производных однозначно определяются путем оригинала, шириной и
+форматом, поэтому для построения srcset не нужно обращаться к хранилищу.
+"""
+import base64
+import os
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image
+
+# Порядок важен: в <picture> первым должен идти более компактный формат
+FORMAT_OPTIONS = {
+    'avif': {'format': 'AVIF', 'quality': 55},
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 4},
+}
+
+MIME_TYPES = {
+    'avif': 'image/avif',
+    'webp': 'image/webp',
+}
+
+
+def available_formats():
+    """Форматы производных, которые может сохранить установленный Pillow"""
+    Image.init()
+    return [fmt for fmt, options in FORMAT_OPTIONS.items() if options['format'] in Image.SAVE]
+
+
+def derivative_path(local_path, width, fmt):
+    """posters/w500/abc.jpg -> posters/w500/derived/abc-185.webp"""
+    directory, filename = os.path.split(local_path)
+    stem = os.path.splitext(filename)[0]
+    return f"{directory}/derived/{stem}-{width}.{fmt}"
+
+
+def derivative_paths(local_path, formats, widths):
+    return [derivative_path(local_path, width, fmt) for fmt in formats for width in widths]
+
+
+def generate_derivatives(local_path, content):
+    """
+    Создает производные изображения для оригинала local_path.
+
+    Args:
+        local_path: Путь оригинала в хранилище
+        content: Байты оригинала
+
+    Returns:
+        tuple: (formats, widths, total_size) - созданные форматы, ширины и их общий размер в байтах
+    """
+    formats = available_formats()
+    with Image.open(BytesIO(content)) as original:
+        image = original.convert('RGB')
+
+    # Увеличивать изображения нет смысла - берем только ширины не больше оригинала
+    widths = sorted({w for w in getattr(settings, 'POSTER_DERIVATIVE_WIDTHS', (185, 342, 500)) if w <= image.width})
+    if not widths:
+        widths = [image.width]
+
+    os.makedirs(os.path.join(settings.MEDIA_ROOT, os.path.dirname(derivative_path(local_path, 0, 'webp'))),
+                exist_ok=True)
+
+    total_size = 0
+    for width in widths:
+        height = round(image.height * width / image.width)
+        resized = image if width == image.width else image.resize((width, height), Image.LANCZOS)
+        for fmt in formats:
+            buffer = BytesIO()
+            resized.save(buffer, **FORMAT_OPTIONS[fmt])
+            path = derivative_path(local_path, width, fmt)
+            if default_storage.exists(path):
+                default_storage.delete(path)
+            default_storage.save(path, ContentFile(buffer.getvalue()))
+            total_size += buffer.tell()
+
+    return formats, widths, total_size
+
+
+def generate_placeholder(content):
+    """
+    Заглушка, которую страница показывает до загрузки изображения.
+
+    Returns:
+        tuple: (color, data_uri) - средний цвет '#rrggbb' и data URI
+        WebP-миниатюры шириной 16px (несколько сотен байт)
+    """
+    with Image.open(BytesIO(content)) as original:
+        image = original.convert('RGB')
+    color = '#%02x%02x%02x' % image.resize((1, 1), Image.BOX).getpixel((0, 0))
+    image.thumbnail((16, 16 * image.height // image.width or 1), Image.BOX)
+    buffer = BytesIO()
+    image.save(buffer, format='WEBP', quality=40)
+    return color, 'data:image/webp;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
@@ -0,0 +1,67 @@
+"""
+Массовое сохранение и сопоставление списков из TMDB (популярное, поиск) с локальной БД.
+
+Вместо update_or_create на каждую запись вся страница результатов
+сохраняется одним INSERT ... ON CONFLICT (tmdb_id) DO UPDATE, причем
+записываются только новые и изменившиеся строки.
+"""
+from .models import Movie, TVShow
+
+
+def _row_changed(obj, row):
+    return any(getattr(obj, field) != value for field, value in row.items())
+
+
+def bulk_upsert(model, rows):
+    """
+    Insert or update rows (dicts from TMDBApi.format_*_data) by tmdb_id.
+
+    Returns model instances in the order of rows. Costs one SELECT when
+    nothing changed, otherwise SELECT + upsert + SELECT of the written rows.
+    """
+    if not rows:
+        return []
+
+    rows_by_id = {row['tmdb_id']: row for row in rows}
+    existing = model.objects.in_bulk(list(rows_by_id), field_name='tmdb_id')
+
+    changed = [
+        model(**row) for tmdb_id, row in rows_by_id.items()
+        if tmdb_id not in existing or _row_changed(existing[tmdb_id], row)
+    ]
+    if changed:
+        # Обновляем только поля, которые есть во всех строках: в списках TMDB
+        # нет, например, статуса сериала, и его нельзя затирать значением по умолчанию
+        common_fields = set.intersection(*(set(row) for row in rows_by_id.values()))
+        update_fields = sorted(common_fields - {'tmdb_id'}) + ['updated_at']
+        model.objects.bulk_create(
+            changed,
+            update_conflicts=True,
+            unique_fields=['tmdb_id'],
+            update_fields=update_fields,
+        )
+        # Django 4.2 не проставляет pk при update_conflicts - перечитываем записанные строки
+        existing.update(model.objects.in_bulk([obj.tmdb_id for obj in changed], field_name='tmdb_id'))
+
+    return [existing[row['tmdb_id']] for row in rows if row['tmdb_id'] in existing]
+
+
+def resolve_existing(model, rows):
+    """
+    Match rows against stored objects with a single in_bulk query.
+
+    Rows already in the DB are returned as stored instances, the rest as
+    transient (unsaved) instances, in the order of rows.
+    """
+    existing = model.objects.in_bulk([row['tmdb_id'] for row in rows], field_name='tmdb_id')
+    return [existing.get(row['tmdb_id']) or model(**row) for row in rows]
+
+
+def upsert_movies(movie_dicts):
+    """Bulk insert/update movies formatted by TMDBApi.format_movie_data"""
+    return bulk_upsert(Movie, movie_dicts)
+
+
+def upsert_tv_shows(tvshow_dicts):
+    """Bulk insert/update TV shows formatted by TMDBApi.format_tv_show_data"""
+    return bulk_upsert(TVShow, tvshow_dicts)
@@ -1,133 +1,272 @@
 from django.core.management.base import BaseCommand
-from django.conf import settings
-from datetime import datetime, timedelta
+from django.core.files.storage import default_storage, FileSystemStorage
+from django.utils import timezone
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 import json
 import os
-from movies.image_cache import check_cache_size
+import time
+from movies.image_cache import delete_poster_files, poster_presence
+from movies.image_derivatives import derivative_paths
+from movies.models import CachedPoster
+
+# Файлы без записи в индексе моложе этого возраста не трогаем - загрузка может быть еще не записана в индекс
+ORPHAN_GRACE = timedelta(hours=1)
+SHARD_SIZE = 1000
+
+
+def _stat_shard(entries):
+    files = []
+    for entry in entries:
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        files.append((entry.path, stat.st_size, stat.st_mtime))
+    return files
+
+
+def _unlink_shard(paths):
+    """Удаляет файлы; возвращает пути, которые удалить не удалось"""
+    failed = []
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            failed.append(path)
+    return failed
+
+
+def _shards(items, size=SHARD_SIZE):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def plan_removals(entries, cutoff, max_bytes):
+    """
+    Выбирает, что удалить, за один проход: сначала все старше cutoff,
+    затем давно не использованные, пока размер не уложится в max_bytes.
+
+    Args:
+        entries: Список (key, size, cached_date, last_accessed)
+
+    Returns:
+        tuple: (aged, evicted, total_size_after) - ключи удаляемых по возрасту и по размеру
+    """
+    aged = [entry for entry in entries if entry[2] < cutoff]
+    total_size = sum(entry[1] for entry in entries) - sum(entry[1] for entry in aged)
+    evicted = []
+    if total_size > max_bytes:
+        for entry in sorted((entry for entry in entries if entry[2] >= cutoff), key=lambda entry: entry[3]):
+            evicted.append(entry)
+            total_size -= entry[1]
+            if total_size <= max_bytes:
+                break
+    return [entry[0] for entry in aged], [entry[0] for entry in evicted], total_size
+
 
 class Command(BaseCommand):
     help = 'Clean old cached movie posters'
 
     def add_arguments(self, parser):
-        parser.add_argument('--days', type=int, default=14, 
+        parser.add_argument('--days', type=int, default=14,
                           help='Remove images older than this many days')
         parser.add_argument('--max-size', type=int, default=500,
                           help='Maximum cache size in MB')
         parser.add_argument('--dry-run', action='store_true',
                           help='Show what would be done without actually removing files')
+        parser.add_argument('--json', action='store_true',
+                          help='Print a machine-readable JSON summary instead of progress messages')
+        parser.add_argument('--workers', type=int, default=8,
+                          help='Threads used to scan and delete files (local filesystem storage only)')
+
+    def log(self, message, style=None):
+        if not self.json_output:
+            self.stdout.write(style(message) if style else message)
 
     def handle(self, *args, **options):
-        days = options['days']
-        max_size_mb = options['max_size']
+        self.json_output = options['json']
         dry_run = options['dry_run']
-        
-        self.stdout.write(f"Cleaning image cache older than {days} days")
-        self.stdout.write(f"Maximum cache size: {max_size_mb} MB")
-        
+        max_bytes = options['max_size'] * 1024 * 1024
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        started = time.monotonic()
+
+        self.log(f"Cleaning image cache older than {options['days']} days")
+        self.log(f"Maximum cache size: {options['max_size']} MB")
         if dry_run:
-            self.stdout.write(self.style.WARNING("DRY RUN - no files will be deleted"))
-            
-        # Сначала проверяем по возрасту
-        from django.core.files.storage import default_storage
-        
-        posters_dir = 'posters/'
-        if not default_storage.exists(posters_dir):
-            self.stdout.write(self.style.WARNING("Posters directory does not exist"))
+            self.log("DRY RUN - no files will be deleted", self.style.WARNING)
+        self.log(f"Cutoff date: {cutoff.isoformat()}")
+
+        # Для локального хранилища - быстрый путь через os.scandir, иначе только по индексу
+        if isinstance(default_storage, FileSystemStorage):
+            summary = self.clean_local(cutoff, max_bytes, dry_run, options['workers'])
+        else:
+            summary = self.clean_index(cutoff, max_bytes, dry_run)
+
+        summary.update({
+            'dry_run': dry_run,
+            'cutoff': cutoff.isoformat(),
+            'max_size_bytes': max_bytes,
+            'duration_seconds': round(time.monotonic() - started, 3),
+        })
+
+        if self.json_output:
+            self.stdout.write(json.dumps(summary))
             return
-            
-        cutoff_date = datetime.now() - timedelta(days=days)
-        self.stdout.write(f"Cutoff date: {cutoff_date.isoformat()}")
-        
-        # Собираем мета-файлы для проверки
-        paths = []
-        
-        def collect_meta_paths(dir_path):
-            try:
-                dirs, files = default_storage.listdir(dir_path)
-                for f in files:
-                    if f.endswith('.meta'):
-                        paths.append(os.path.join(dir_path, f))
-                for d in dirs:
-                    collect_meta_paths(os.path.join(dir_path, d))
-            except Exception as e:
-                self.stdout.write(self.style.ERROR(f"Error processing directory {dir_path}: {e}"))
-        
-        collect_meta_paths(posters_dir)
-        self.stdout.write(f"Found {len(paths)} cached images")
-        
-        # Проверяем метаданные каждого файла
-        removed_count = 0
-        removed_size = 0
-        
-        for meta_path in paths:
+
+        verb = 'Would remove' if dry_run else 'Removed'
+        self.log(f"{verb} {summary['removed_aged']} old cached images, "
+                 f"{summary['removed_for_size']} least recently used images "
+                 f"and {summary['removed_orphans']} untracked files", self.style.SUCCESS)
+        self.log(f"Cache size: {summary['total_size_before'] / (1024*1024):.2f} MB -> "
+                 f"{summary['total_size_after'] / (1024*1024):.2f} MB", self.style.SUCCESS)
+        if summary['errors']:
+            self.log(f"Finished with {summary['errors']} errors", self.style.WARNING)
+        self.log("Cache cleanup completed", self.style.SUCCESS)
+
+    def clean_index(self, cutoff, max_bytes, dry_run):
+        """Очистка только по индексу CachedPoster (для хранилищ, отличных от локального)"""
+        rows = {
+            row[0]: row[1:] for row in CachedPoster.objects.values_list(
+                'id', 'path', 'file_size', 'cached_date', 'last_accessed', 'formats', 'widths'
+            ).iterator(chunk_size=2000)
+        }
+        self.log(f"Found {len(rows)} cached images")
+        aged, evicted, total_after = plan_removals(
+            [(entry_id, row[1], row[2], row[3]) for entry_id, row in rows.items()], cutoff, max_bytes
+        )
+
+        errors = 0
+        removed_ids = []
+        for entry_id in aged + evicted:
+            path, file_size, cached_date, last_accessed, formats, widths = rows[entry_id]
+            self.log(f"Removing {path} ({file_size / 1024:.1f} KB)")
+            if dry_run:
+                continue
             try:
-                meta_content = default_storage.open(meta_path).read()
-                metadata = json.loads(meta_content.decode('utf-8'))
-                cached_date = datetime.fromisoformat(metadata['cached_date'])
-                
-                # Если файл старше cutoff_date, удаляем его
-                if cached_date < cutoff_date:
-                    # Путь к самому изображению (без .meta)
-                    image_path = meta_path[:-5]  # удаляем '.meta'
-                    
-                    if default_storage.exists(image_path):
-                        size = default_storage.size(image_path)
-                        removed_size += size
-                        
-                        if not dry_run:
-                            # Удаляем изображение
-                            default_storage.delete(image_path)
-                            # Удаляем метаданные
-                            default_storage.delete(meta_path)
-                            
-                        removed_count += 1
-                        self.stdout.write(f"Removing {image_path} (age: {(datetime.now() - cached_date).days} days)")
+                delete_poster_files(path, formats, widths)
+                removed_ids.append(entry_id)
             except Exception as e:
-                self.stdout.write(self.style.ERROR(f"Error processing {meta_path}: {e}"))
-        
-        self.stdout.write(self.style.SUCCESS(
-            f"Age-based cleanup: {'Would remove' if dry_run else 'Removed'} {removed_count} "
-            f"old cached images ({removed_size / (1024*1024):.2f} MB)"
-        ))
-        
-        # Затем проверяем по размеру
+                self.log(f"Error processing {path}: {e}", self.style.ERROR)
+                errors += 1
+        for chunk in _shards(removed_ids, 500):
+            CachedPoster.objects.filter(id__in=chunk).delete()
+        if removed_ids:
+            poster_presence.invalidate()
+
+        return {
+            'mode': 'index',
+            'scanned_files': len(rows),
+            'total_size_before': sum(row[1] for row in rows.values()),
+            'total_size_after': total_after,
+            'removed_aged': len(aged),
+            'removed_for_size': len(evicted),
+            'removed_orphans': 0,
+            'dangling_rows': 0,
+            'legacy_files': 0,
+            'errors': errors,
+        }
+
+    def clean_local(self, cutoff, max_bytes, dry_run, workers):
+        """
+        Очистка локального кэша за один проход: файлы перечисляются через
+        os.scandir, stat и удаление выполняются шардами в пуле потоков.
+        Заодно удаляются файлы без записи в индексе и записи без файлов.
+        """
+        location = str(default_storage.location)
+        root = os.path.join(location, 'posters')
+
+        # Индекс читается до обхода файлов: файл, загруженный после чтения, моложе ORPHAN_GRACE
+        # и поэтому не будет принят за файл без записи
+        rows = {
+            row[0]: row[1:] for row in CachedPoster.objects.values_list(
+                'path', 'id', 'cached_date', 'last_accessed', 'formats', 'widths'
+            ).iterator(chunk_size=2000)
+        }
+        file_entries = []
+        directories = [root] if os.path.isdir(root) else []
+        while directories:
+            with os.scandir(directories.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        file_entries.append(entry)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            files = [f for shard in executor.map(_stat_shard, _shards(file_entries)) for f in shard]
+        self.log(f"Found {len(files)} cached files")
+        # Производные учитываются вместе со своим оригиналом
+        owner = {}
+        for path, (entry_id, cached_date, last_accessed, formats, widths) in rows.items():
+            for derived in derivative_paths(path, formats.split(',') if formats else [],
+                                            widths.split(',') if widths else []):
+                owner[derived] = path
+
+        groups = {}  # путь оригинала в хранилище -> [размер вместе с производными, абсолютные пути файлов]
+        orphans = []
+        legacy = 0
+        orphan_cutoff = (timezone.now() - ORPHAN_GRACE).timestamp()
+        files = [(os.path.relpath(abs_path, location).replace(os.sep, '/'), abs_path, size, mtime)
+                 for abs_path, size, mtime in files]
+        meta_files = {rel_path for rel_path, _, _, _ in files if rel_path.endswith('.meta')}
+        if files and not rows:
+            self.log("The index is empty - run migrate_poster_meta first; untracked files are kept",
+                     self.style.WARNING)
+        for rel_path, abs_path, size, mtime in files:
+            key = rel_path if rel_path in rows else owner.get(rel_path)
+            if key is None:
+                if rel_path in meta_files or rel_path + '.meta' in meta_files:
+                    # Кэш в старом формате (.meta рядом с изображением) ждет migrate_poster_meta
+                    legacy += 1
+                elif rows and mtime < orphan_cutoff:
+                    orphans.append((rel_path, abs_path, size))
+                continue
+            group = groups.setdefault(key, [0, []])
+            group[0] += size
+            group[1].append(abs_path)
+
+        dangling = [rows[path][0] for path in rows if path not in groups]
+        # Файл мог попасть в индекс уже после его чтения - такие файлы не трогаем
+        indexed = set()
+        for chunk in _shards([rel_path for rel_path, _, _ in orphans], 500):
+            indexed.update(CachedPoster.objects.filter(path__in=chunk).values_list('path', flat=True))
+        orphans = [(abs_path, size) for rel_path, abs_path, size in orphans if rel_path not in indexed]
+        aged, evicted, total_after = plan_removals(
+            [(path, size, rows[path][1], rows[path][2]) for path, (size, _) in groups.items()],
+            cutoff, max_bytes
+        )
+
+        for path in aged + evicted:
+            self.log(f"Removing {path} ({groups[path][0] / 1024:.1f} KB)")
+        for abs_path, size in orphans:
+            self.log(f"Removing untracked file {abs_path}")
+
+        errors = 0
         if not dry_run:
-            before_size, after_size, files_removed = check_cache_size(max_size_mb)
-            
-            self.stdout.write(self.style.SUCCESS(
-                f"Size-based cleanup: Cache size {before_size / (1024*1024):.2f} MB -> "
-                f"{after_size / (1024*1024):.2f} MB, removed {files_removed} files"
-            ))
-        else:
-            # В режиме dry run просто показываем текущий размер
-            from movies.image_cache import check_cache_size
-            total_size = 0
-            
-            def get_dir_size(dir_path):
-                nonlocal total_size
-                try:
-                    dirs, files = default_storage.listdir(dir_path)
-                    for f in files:
-                        if not f.endswith('.meta'):
-                            file_path = os.path.join(dir_path, f)
-                            try:
-                                total_size += default_storage.size(file_path)
-                            except Exception:
-                                pass
-                    for d in dirs:
-                        get_dir_size(os.path.join(dir_path, d))
-                except Exception:
-                    pass
-            
-            get_dir_size(posters_dir)
-            
-            self.stdout.write(self.style.SUCCESS(
-                f"Current cache size: {total_size / (1024*1024):.2f} MB"
-            ))
-            
-            if total_size > max_size_mb * 1024 * 1024:
-                self.stdout.write(self.style.WARNING(
-                    f"Cache size exceeds maximum ({max_size_mb} MB), would trigger cleanup"
-                ))
-        
-        self.stdout.write(self.style.SUCCESS("Cache cleanup completed")) 
\ No newline at end of file
+            to_unlink = [f for path in aged + evicted for f in groups[path][1]] + [f for f, _ in orphans]
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                failed = {f for shard in executor.map(_unlink_shard, _shards(to_unlink)) for f in shard}
+            errors = len(failed)
+            # Запись изображения, часть файлов которого удалить не удалось, остается - повторим при следующем запуске
+            removed_ids = [
+                rows[path][0] for path in aged + evicted if not failed.intersection(groups[path][1])
+            ] + dangling
+            for chunk in _shards(removed_ids, 500):
+                CachedPoster.objects.filter(id__in=chunk).delete()
+            if removed_ids:
+                poster_presence.invalidate()
+
+        return {
+            'mode': 'scandir',
+            'scanned_files': len(files),
+            'total_size_before': sum(size for size, _ in groups.values()) + sum(size for _, size in orphans),
+            'total_size_after': total_after,
+            'removed_aged': len(aged),
+            'removed_for_size': len(evicted),
+            'removed_orphans': len(orphans),
+            'dangling_rows': len(dangling),
+            'legacy_files': legacy,
+            'errors': errors,
+        }
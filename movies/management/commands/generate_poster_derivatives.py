@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.core.files.storage import default_storage
+from django.db.models import Q
+from movies.image_cache import content_hash
+from movies.image_derivatives import generate_derivatives, generate_placeholder
+from movies.models import CachedPoster
+
+class Command(BaseCommand):
+    # Воркеры увидят новые производные при следующем перечитывании индекса (POSTER_PRESENCE_RELOAD_INTERVAL)
+    help = 'Generate WebP/AVIF derivatives, placeholders and content hashes for cached posters missing them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                          help='Regenerate derivatives and placeholders for all cached posters')
+
+    def handle(self, *args, **options):
+        entries = CachedPoster.objects.only('id', 'path')
+        if not options['force']:
+            entries = entries.filter(Q(formats='') | Q(placeholder='') | Q(content_hash=''))
+
+        processed = 0
+        errors = 0
+        for entry in entries.iterator():
+            try:
+                with default_storage.open(entry.path) as f:
+                    content = f.read()
+                formats, widths, derivatives_size = generate_derivatives(entry.path, content)
+                color, placeholder = generate_placeholder(content)
+            except Exception as e:
+                self.stdout.write(self.style.ERROR(f"Error processing {entry.path}: {e}"))
+                errors += 1
+                continue
+            CachedPoster.objects.filter(id=entry.id).update(
+                formats=','.join(formats),
+                widths=','.join(map(str, widths)),
+                file_size=len(content) + derivatives_size,
+                color=color,
+                placeholder=placeholder,
+                content_hash=content_hash(content),
+            )
+            processed += 1
+
+        self.stdout.write(self.style.SUCCESS(f"Generated derivatives for {processed} cached images"))
+        if errors:
+            self.stdout.write(self.style.WARNING(f"Finished with {errors} errors"))
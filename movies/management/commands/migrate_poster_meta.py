@@ -0,0 +1,90 @@
+from django.core.management.base import BaseCommand
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from datetime import datetime
+import json
+import os
+from movies.models import CachedPoster
+
+class Command(BaseCommand):
+    help = 'Import legacy .meta files of the poster cache into the CachedPoster index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-meta', action='store_true',
+                          help='Do not delete .meta files after importing them')
+        parser.add_argument('--batch-size', type=int, default=500,
+                          help='Number of index rows written per query')
+
+    def _parse_date(self, value):
+        # Старые .meta файлы содержат наивное локальное время
+        date = datetime.fromisoformat(value)
+        if timezone.is_naive(date):
+            date = timezone.make_aware(date)
+        return date
+
+    def handle(self, *args, **options):
+        keep_meta = options['keep_meta']
+        batch_size = options['batch_size']
+
+        posters_dir = 'posters/'
+        if not default_storage.exists(posters_dir):
+            self.stdout.write(self.style.WARNING("Posters directory does not exist"))
+            return
+
+        indexed = set(CachedPoster.objects.values_list('path', flat=True))
+        entries = []
+        meta_paths = []
+        errors = 0
+
+        def collect(dir_path):
+            nonlocal errors
+            try:
+                dirs, files = default_storage.listdir(dir_path)
+            except Exception as e:
+                self.stdout.write(self.style.ERROR(f"Error processing directory {dir_path}: {e}"))
+                errors += 1
+                return
+            file_set = set(files)
+            for f in files:
+                if f.endswith('.meta'):
+                    continue
+                image_path = os.path.join(dir_path, f)
+                meta_path = image_path + '.meta'
+                if f + '.meta' in file_set:
+                    meta_paths.append(meta_path)
+                if image_path in indexed:
+                    continue
+                try:
+                    now = timezone.now()
+                    metadata = {}
+                    if f + '.meta' in file_set:
+                        metadata = json.loads(default_storage.open(meta_path).read().decode('utf-8'))
+                    cached_date = self._parse_date(metadata['cached_date']) if 'cached_date' in metadata \
+                        else default_storage.get_modified_time(image_path)
+                    last_accessed = self._parse_date(metadata['last_accessed']) if 'last_accessed' in metadata \
+                        else cached_date
+                    entries.append(CachedPoster(
+                        path=image_path,
+                        size=metadata.get('size') or image_path.split('/')[1],
+                        file_size=metadata.get('file_size') or default_storage.size(image_path),
+                        cached_date=cached_date or now,
+                        last_accessed=last_accessed or now,
+                    ))
+                except Exception as e:
+                    self.stdout.write(self.style.ERROR(f"Error processing {image_path}: {e}"))
+                    errors += 1
+            for d in dirs:
+                collect(os.path.join(dir_path, d))
+
+        collect(posters_dir)
+
+        CachedPoster.objects.bulk_create(entries, batch_size=batch_size, ignore_conflicts=True)
+        self.stdout.write(self.style.SUCCESS(f"Indexed {len(entries)} cached images"))
+
+        if not keep_meta:
+            for meta_path in meta_paths:
+                default_storage.delete(meta_path)
+            self.stdout.write(self.style.SUCCESS(f"Removed {len(meta_paths)} .meta files"))
+
+        if errors:
+            self.stdout.write(self.style.WARNING(f"Finished with {errors} errors"))
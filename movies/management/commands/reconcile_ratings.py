@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from movies.ratings import REVIEW_TARGETS, average, compute_ratings
+
+class Command(BaseCommand):
+    help = ('Recalculate denormalized review_count/rating_sum/avg_rating of movies, TV shows, '
+            'seasons and episodes from their reviews and fix rows that drifted')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                          help='Only report rows with wrong aggregates')
+
+    def handle(self, *args, **options):
+        total_fixed = 0
+        for review_model, (model, _) in REVIEW_TARGETS.items():
+            expected = compute_ratings(review_model)
+
+            # Сохраненные агрегаты; объекты с отзывами, но нулевым review_count найдутся по expected
+            stored = {
+                pk: (count, total, avg) for pk, count, total, avg in model.objects.filter(review_count__gt=0)
+                .values_list('id', 'review_count', 'rating_sum', 'avg_rating').iterator()
+            }
+            to_fix = []
+            for pk in sorted(stored.keys() | expected.keys()):
+                count, total = expected.get(pk, (0, 0))
+                if stored.get(pk, (0, 0, 0)) != (count, total, average(total, count)):
+                    to_fix.append(pk)
+                    self.stdout.write(f"{model.__name__} {pk}: {stored.get(pk, (0, 0, 0))[:2]} -> {(count, total)}")
+                    if not options['dry_run']:
+                        model.objects.filter(pk=pk).update(
+                            review_count=count, rating_sum=total, avg_rating=average(total, count)
+                        )
+            total_fixed += len(to_fix)
+            self.stdout.write(f"{model._meta.verbose_name_plural}: {len(expected)} with reviews, "
+                              f"{len(to_fix)} out of sync")
+
+        verb = 'Would fix' if options['dry_run'] else 'Fixed'
+        self.stdout.write(self.style.SUCCESS(f"{verb} {total_fixed} rows"))
@@ -0,0 +1,145 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.db.models import Count
+from django.utils import timezone
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import time
+from movies.image_cache import download_poster, poster_failures, poster_local_path
+from movies.models import Movie, TVShow, Season, Episode, CachedPoster, WatchStatus
+from movies.tmdb_api import TMDBApi
+
+class Command(BaseCommand):
+    help = ('Prefetch the posters users are most likely to see: favorites, watch lists, popular lists, '
+            'seasons and episodes of shows being watched. Images cached within --days are skipped, '
+            'so an interrupted run can simply be restarted.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-size', type=int, default=None,
+                          help='Byte budget in MB for the warmed set (default: the eviction target of '
+                               'POSTER_CACHE_MAX_SIZE_MB, so warming does not trigger eviction)')
+        parser.add_argument('--workers', type=int, default=8,
+                          help='Number of concurrent downloads')
+        parser.add_argument('--popular-pages', type=int, default=1,
+                          help='Pages of TMDB popular movies and TV shows to include (0 to skip)')
+        parser.add_argument('--days', type=int, default=14,
+                          help='Re-download cached images older than this many days')
+        parser.add_argument('--dry-run', action='store_true',
+                          help='Only show the working set')
+
+    def working_set(self, popular_pages):
+        """
+        Пути изображений (poster_path/still_path, размер w500) в порядке приоритета:
+        чем больше пользователей ссылается на фильм или сериал, тем раньше
+        """
+        paths = []
+
+        movies = Movie.objects.exclude(poster_path__isnull=True).exclude(poster_path='').annotate(
+            refs=Count('favorited_by', distinct=True) + Count('watch_statuses', distinct=True)
+        ).filter(refs__gt=0).order_by('-refs').values_list('poster_path', flat=True)
+        tvshows = TVShow.objects.exclude(poster_path__isnull=True).exclude(poster_path='').annotate(
+            refs=Count('favorited_by', distinct=True) + Count('watch_statuses', distinct=True)
+        ).filter(refs__gt=0).order_by('-refs').values_list('poster_path', flat=True)
+        paths += movies
+        paths += tvshows
+
+        if popular_pages:
+            tmdb_api = TMDBApi()
+            for page in range(1, popular_pages + 1):
+                for data in (tmdb_api.get_popular_movies(page), tmdb_api.get_popular_tv_shows(page)):
+                    paths += [item.get('poster_path') for item in (data or {}).get('results', [])]
+
+        # Сезоны и эпизоды сериалов, которые сейчас смотрят
+        watching = TVShow.objects.filter(watch_statuses__status=WatchStatus.WATCHING).values('id')
+        paths += Season.objects.filter(tv_show__in=watching).order_by('tv_show_id', 'season_number') \
+            .values_list('poster_path', flat=True)
+        paths += Episode.objects.filter(tv_show__in=watching).order_by('season_id', 'episode_number') \
+            .values_list('still_path', flat=True)
+
+        # Без пустых путей и повторов, с сохранением порядка
+        return list(dict.fromkeys(path.lstrip('/') for path in paths if path))
+
+    def handle(self, *args, **options):
+        max_size_mb = options['max_size']
+        if max_size_mb is None:
+            max_bytes = getattr(settings, 'POSTER_CACHE_MAX_SIZE_MB', 500) * 1024 * 1024 \
+                * getattr(settings, 'POSTER_CACHE_EVICT_TARGET', 0.9)
+        else:
+            max_bytes = max_size_mb * 1024 * 1024
+
+        paths = self.working_set(options['popular_pages'])
+        self.stdout.write(f"Working set: {len(paths)} images, budget {max_bytes / (1024*1024):.2f} MB")
+
+        # Уже закэшированные изображения набора занимают часть бюджета
+        cached = {}
+        local_paths = [poster_local_path(path) for path in paths]
+        for i in range(0, len(local_paths), 500):
+            cached.update((path, (file_size, cached_date)) for path, file_size, cached_date in
+                          CachedPoster.objects.filter(path__in=local_paths[i:i + 500])
+                          .values_list('path', 'file_size', 'cached_date'))
+        used = sum(file_size for file_size, _ in cached.values())
+        # Копии старше --days загружаются заново; неудачные недавно (негативный кэш) пропускаем
+        stale_before = timezone.now() - timedelta(days=options['days'])
+        stale = {path for path, (_, cached_date) in cached.items() if cached_date < stale_before}
+        pending = [path for path, local_path in zip(paths, local_paths)
+                   if (local_path not in cached or local_path in stale)
+                   and not poster_failures.check_shared(local_path)]
+        self.stdout.write(f"Already cached: {len(cached)} images ({used / (1024*1024):.2f} MB, "
+                          f"{len(stale)} stale), to download: {len(pending)}")
+
+        if options['dry_run'] or not pending:
+            return
+
+        # Средний размер изображения - чтобы не начинать загрузки, которые уже не поместятся в бюджет
+        average = used / len(cached) if cached else 0
+        downloaded = failed = 0
+        started = time.monotonic()
+        remaining = iter(pending)
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            def submit():
+                for path in remaining:
+                    # Обновление устаревшей копии заменяет файл, уже учтенный в used
+                    old_size = cached.get(poster_local_path(path), (None,))[0]
+                    if old_size is None and used + average * (len(in_flight) + 1) >= max_bytes:
+                        continue
+                    future = executor.submit(self.download, path, options['days'])
+                    in_flight[future] = old_size or 0
+                    return future
+                return None
+
+            in_flight = {}
+            for _ in range(options['workers']):
+                if submit() is None:
+                    break
+
+            while in_flight:
+                future = next(as_completed(in_flight))
+                old_size = in_flight.pop(future)
+                size = future.result()
+                if size is None:
+                    failed += 1
+                else:
+                    downloaded += 1
+                    used += size - old_size
+                    average += (size - average) / (len(cached) + downloaded)
+
+                done = downloaded + failed
+                if done % 50 == 0 or not in_flight:
+                    self.stdout.write(f"[{done}/{len(pending)}] downloaded {downloaded}, failed {failed}, "
+                                      f"{used / (1024*1024):.2f} MB used, "
+                                      f"{done / (time.monotonic() - started):.1f} images/s")
+
+                submit()
+
+        skipped = len(pending) - downloaded - failed
+        self.stdout.write(self.style.SUCCESS(f"Warm-up finished: downloaded {downloaded}, failed {failed}"))
+        if skipped:
+            self.stdout.write(self.style.WARNING(f"Byte budget reached, {skipped} images were not downloaded"))
+
+    def download(self, path, days):
+        """Загружает изображение; возвращает его размер вместе с производными или None при неудаче"""
+        if not download_poster(path, 'w500', days):
+            return None
+        return CachedPoster.objects.filter(path=poster_local_path(path)) \
+            .values_list('file_size', flat=True).first() or 0
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.7 on 2026-10-18 07:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0004_friendinvitation_friendship'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CachedPoster',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=255, unique=True)),
+                ('size', models.CharField(max_length=20)),
+                ('file_size', models.PositiveIntegerField(default=0)),
+                ('cached_date', models.DateTimeField()),
+                ('last_accessed', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-18 07:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0005_cachedposter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cachedposter',
+            name='formats',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='cachedposter',
+            name='widths',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
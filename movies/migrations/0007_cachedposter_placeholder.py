@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-18 07:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0006_cachedposter_derivatives'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cachedposter',
+            name='color',
+            field=models.CharField(blank=True, default='', max_length=7),
+        ),
+        migrations.AddField(
+            model_name='cachedposter',
+            name='placeholder',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
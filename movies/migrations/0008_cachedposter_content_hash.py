@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 07:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0007_cachedposter_placeholder'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cachedposter',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', max_length=16),
+        ),
+    ]
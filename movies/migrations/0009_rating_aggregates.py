@@ -0,0 +1,95 @@
+# Generated by Django 4.2.7 on 2026-10-18 07:24
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def backfill_ratings(apps, schema_editor):
+    for target_name, review_name, field in (('Movie', 'Review', 'movie'), ('TVShow', 'TVShowReview', 'tvshow'),
+                                            ('Season', 'SeasonReview', 'season'),
+                                            ('Episode', 'EpisodeReview', 'episode')):
+        target = apps.get_model('movies', target_name)
+        rows = apps.get_model('movies', review_name).objects.order_by().values_list(f'{field}_id').annotate(
+            count=Count('id'), total=Sum('rating')
+        )
+        for pk, count, total in rows.iterator():
+            target.objects.filter(pk=pk).update(review_count=count, rating_sum=total, avg_rating=total / count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0008_cachedposter_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='episode',
+            name='avg_rating',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='episode',
+            name='rating_sum',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='episode',
+            name='review_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='movie',
+            name='avg_rating',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='movie',
+            name='rating_sum',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='movie',
+            name='review_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='season',
+            name='avg_rating',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='season',
+            name='rating_sum',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='season',
+            name='review_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='tvshow',
+            name='avg_rating',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='tvshow',
+            name='rating_sum',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='tvshow',
+            name='review_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_ratings, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='movie',
+            index=models.Index(condition=models.Q(('review_count__gt', 0)), fields=['-avg_rating', '-review_count'], name='movie_top_rated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tvshow',
+            index=models.Index(condition=models.Q(('review_count__gt', 0)), fields=['-avg_rating', '-review_count'], name='tvshow_top_rated_idx'),
+        ),
+    ]
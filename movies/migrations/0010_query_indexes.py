@@ -0,0 +1,48 @@
+# Generated by Django 4.2.7 on 2026-10-18 07:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('movies', '0009_rating_aggregates'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='episodereview',
+            index=models.Index(fields=['episode', '-created_at'], name='episodereview_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='friendinvitation',
+            index=models.Index(condition=models.Q(('uses_remaining__gt', 0)), fields=['creator', 'expires_at'], name='invitation_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='moviewatchstatus',
+            index=models.Index(fields=['user', 'status', '-updated_at'], name='moviestatus_user_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(fields=['movie', '-created_at'], name='review_movie_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='seasonreview',
+            index=models.Index(fields=['season', '-created_at'], name='seasonreview_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tvshowreview',
+            index=models.Index(fields=['tvshow', '-created_at'], name='tvshowreview_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tvshowwatchstatus',
+            index=models.Index(fields=['user', 'status', '-updated_at'], name='tvstatus_user_status_idx'),
+        ),
+        # Вход по email (EmailAuthenticationForm.clean): User.objects.get(email=...);
+        # модель User принадлежит приложению auth, поэтому индекс создается SQL
+        migrations.RunSQL(
+            'CREATE INDEX auth_user_email_idx ON auth_user (email)',
+            'DROP INDEX auth_user_email_idx',
+        ),
+    ]
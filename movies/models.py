@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.core.validators import MinValueValidator, MaxValueValidator
 
@@ -13,6 +13,11 @@ class Movie(models.Model):
     vote_average = models.FloatField(default=0)
     vote_count = models.IntegerField(default=0)
     favorited_by = models.ManyToManyField(User, related_name='favorite_movies', blank=True)
+    # Когда данные последний раз загружались из детального ответа TMDB (списки его не меняют, см. freshness.py)
+    details_updated_at = models.DateTimeField(blank=True, null=True)
+    review_count = models.IntegerField(default=0)  # Денормализованные агрегаты отзывов (см. ratings.py)
+    rating_sum = models.IntegerField(default=0)
+    avg_rating = models.FloatField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -21,9 +26,26 @@ class Movie(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # "Лучшие по оценкам": filter(review_count__gt=0).order_by('-avg_rating', '-review_count')
+            models.Index(fields=['-avg_rating', '-review_count'], name='movie_top_rated_idx',
+                         condition=models.Q(review_count__gt=0)),
+        ]
+
+
+class RatedReview(models.Model):
+    """Base class for reviews that keep rating aggregates of the reviewed object (see ratings.py)"""
+
+    class Meta:
+        abstract = True
 
+    def save(self, *args, **kwargs):
+        # Отзыв и агрегаты объекта (обработчики post_save) сохраняются в одной транзакции
+        with transaction.atomic(using=kwargs.get('using')):
+            super().save(*args, **kwargs)
 
-class Review(models.Model):
+
+class Review(RatedReview):
     """Model for user reviews of movies"""
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='reviews')
     movie = models.ForeignKey(Movie, on_delete=models.CASCADE, related_name='reviews')
@@ -40,6 +62,10 @@ class Review(models.Model):
     class Meta:
         unique_together = ('user', 'movie')
         ordering = ['-created_at']
+        indexes = [
+            # Отзывы на странице фильма: movie.reviews.all() в порядке -created_at
+            models.Index(fields=['movie', '-created_at'], name='review_movie_created_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username}'s review of {self.movie.title}"
@@ -59,6 +85,11 @@ class TVShow(models.Model):
     number_of_episodes = models.IntegerField(default=0)
     status = models.CharField(max_length=50, blank=True, null=True)
     favorited_by = models.ManyToManyField(User, related_name='favorite_tvshows', blank=True)
+    # Когда данные последний раз загружались из детального ответа TMDB (списки его не меняют, см. freshness.py)
+    details_updated_at = models.DateTimeField(blank=True, null=True)
+    review_count = models.IntegerField(default=0)  # Денормализованные агрегаты отзывов (см. ratings.py)
+    rating_sum = models.IntegerField(default=0)
+    avg_rating = models.FloatField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -69,6 +100,10 @@ class TVShow(models.Model):
         ordering = ['-created_at']
         verbose_name = "TV Show"
         verbose_name_plural = "TV Shows"
+        indexes = [
+            models.Index(fields=['-avg_rating', '-review_count'], name='tvshow_top_rated_idx',
+                         condition=models.Q(review_count__gt=0)),
+        ]
 
 
 class Season(models.Model):
@@ -81,6 +116,9 @@ class Season(models.Model):
     season_number = models.IntegerField()
     air_date = models.DateField(blank=True, null=True)
     episode_count = models.IntegerField(default=0)
+    review_count = models.IntegerField(default=0)  # Денормализованные агрегаты отзывов (см. ratings.py)
+    rating_sum = models.IntegerField(default=0)
+    avg_rating = models.FloatField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -105,6 +143,9 @@ class Episode(models.Model):
     air_date = models.DateField(blank=True, null=True)
     vote_average = models.FloatField(default=0)
     vote_count = models.IntegerField(default=0)
+    review_count = models.IntegerField(default=0)  # Денормализованные агрегаты отзывов (см. ratings.py)
+    rating_sum = models.IntegerField(default=0)
+    avg_rating = models.FloatField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -116,7 +157,7 @@ class Episode(models.Model):
         unique_together = ('tv_show', 'season_number', 'episode_number')
 
 
-class TVShowReview(models.Model):
+class TVShowReview(RatedReview):
     """Model for user reviews of TV shows"""
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='tvshow_reviews')
     tvshow = models.ForeignKey(TVShow, on_delete=models.CASCADE, related_name='reviews')
@@ -133,6 +174,9 @@ class TVShowReview(models.Model):
     class Meta:
         unique_together = ('user', 'tvshow')
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['tvshow', '-created_at'], name='tvshowreview_created_idx'),
+        ]
         verbose_name = "TV Show Review"
         verbose_name_plural = "TV Show Reviews"
 
@@ -140,7 +184,7 @@ class TVShowReview(models.Model):
         return f"{self.user.username}'s review of {self.tvshow.name}"
 
 
-class SeasonReview(models.Model):
+class SeasonReview(RatedReview):
     """Model for user reviews of TV show seasons"""
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='season_reviews')
     season = models.ForeignKey(Season, on_delete=models.CASCADE, related_name='reviews')
@@ -157,12 +201,15 @@ class SeasonReview(models.Model):
     class Meta:
         unique_together = ('user', 'season')
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['season', '-created_at'], name='seasonreview_created_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username}'s review of {self.season.tv_show.name} - {self.season.name}"
 
 
-class EpisodeReview(models.Model):
+class EpisodeReview(RatedReview):
     """Model for user reviews of TV show episodes"""
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='episode_reviews')
     episode = models.ForeignKey(Episode, on_delete=models.CASCADE, related_name='reviews')
@@ -179,6 +226,9 @@ class EpisodeReview(models.Model):
     class Meta:
         unique_together = ('user', 'episode')
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['episode', '-created_at'], name='episodereview_created_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username}'s review of {self.episode.tv_show.name} - S{self.episode.season_number:02d}E{self.episode.episode_number:02d}"
@@ -202,6 +252,10 @@ class MovieWatchStatus(models.Model):
     class Meta:
         unique_together = ('user', 'movie')
         verbose_name_plural = 'Movie watch statuses'
+        indexes = [
+            # Списки по статусу (my_watch_list, friend_watch_list): filter(user, status).order_by('-updated_at')
+            models.Index(fields=['user', 'status', '-updated_at'], name='moviestatus_user_status_idx'),
+        ]
     
     def __str__(self):
         return f"{self.user.username}'s status for {self.movie.title}: {self.status}"
@@ -217,6 +271,9 @@ class TVShowWatchStatus(models.Model):
     class Meta:
         unique_together = ('user', 'tvshow')
         verbose_name_plural = 'TV show watch statuses'
+        indexes = [
+            models.Index(fields=['user', 'status', '-updated_at'], name='tvstatus_user_status_idx'),
+        ]
     
     def __str__(self):
         return f"{self.user.username}'s status for {self.tvshow.name}: {self.status}"
@@ -244,9 +301,33 @@ class FriendInvitation(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     expires_at = models.DateTimeField()  # Дата истечения срока действия ссылки
     
+    class Meta:
+        indexes = [
+            # Активное приглашение пользователя (my_friends): только приглашения с оставшимися использованиями
+            models.Index(fields=['creator', 'expires_at'], name='invitation_active_idx',
+                         condition=models.Q(uses_remaining__gt=0)),
+        ]
+    
     def is_valid(self):
         from django.utils import timezone
         return self.uses_remaining > 0 and self.expires_at > timezone.now()
     
     def __str__(self):
         return f"Invitation by {self.creator.username} ({self.uses_remaining} uses left)"
+
+
+class CachedPoster(models.Model):
+    """Индекс локального кэша изображений TMDB (постеры, кадры эпизодов)"""
+    path = models.CharField(max_length=255, unique=True)  # Путь в хранилище, например posters/w500/abc.jpg
+    size = models.CharField(max_length=20)  # Размер изображения TMDB (w500, original и т.д.)
+    file_size = models.PositiveIntegerField(default=0)
+    cached_date = models.DateTimeField()
+    last_accessed = models.DateTimeField(db_index=True)
+    formats = models.CharField(max_length=32, blank=True, default='')  # Форматы производных изображений, например "avif,webp"
+    widths = models.CharField(max_length=64, blank=True, default='')  # Ширины производных изображений, например "185,342,500"
+    color = models.CharField(max_length=7, blank=True, default='')  # Средний цвет изображения, например "#1a2b3c"
+    placeholder = models.TextField(blank=True, default='')  # data URI миниатюры, показываемой до загрузки
+    content_hash = models.CharField(max_length=16, blank=True, default='')  # Хеш содержимого для неизменяемых URL (?v=...)
+
+    def __str__(self):
+        return self.path
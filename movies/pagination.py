@@ -0,0 +1,106 @@
+"""
+Постраничный вывод по ключу (keyset): страница выбирается условием на id
+вместо OFFSET, поэтому ее стоимость не зависит от того, насколько далеко
+пользователь пролистал список.
+
+Избранное упорядочено по id строки связи ManyToMany (сначала добавленные
+последними); количество элементов кэшируется и сбрасывается при изменении
+избранного (см. signals.py).
+"""
+from django.conf import settings
+from django.core.cache import cache
+
+
+class KeysetPage:
+    """Страница списка с курсорами соседних страниц (вместо номеров страниц)"""
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None, count=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.count = count
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+def parse_cursor(value):
+    try:
+        return int(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def keyset_page(queryset, after=None, before=None, per_page=12):
+    """
+    Страница queryset в порядке убывания id.
+
+    Args:
+        queryset: Выборка с уникальным возрастающим полем id
+        after: Курсор - страница начинается сразу после строки с этим id
+        before: Курсор - страница заканчивается прямо перед строкой с этим id
+        per_page: Размер страницы
+
+    Returns:
+        KeysetPage со строками queryset (count не заполняется)
+    """
+    if before is not None:
+        rows = list(queryset.filter(id__gt=before).order_by('id')[:per_page + 1])
+        if rows:
+            has_more = len(rows) > per_page
+            rows = rows[:per_page][::-1]
+            return KeysetPage(rows, next_cursor=rows[-1].id, previous_cursor=rows[0].id if has_more else None)
+        # Курсор устарел (строки удалены) - показываем первую страницу
+        after = None
+
+    if after is not None:
+        queryset = queryset.filter(id__lt=after)
+    rows = list(queryset.order_by('-id')[:per_page + 1])
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    return KeysetPage(
+        rows,
+        next_cursor=rows[-1].id if has_more else None,
+        previous_cursor=rows[0].id if after is not None and rows else None,
+    )
+
+
+def favorites_count_key(model, user_id):
+    return f'favorites-count:{model._meta.label_lower}:{user_id}'
+
+
+def favorites_page(user, model, after=None, before=None, per_page=12):
+    """
+    Страница избранного пользователя (Movie или TVShow) одним запросом
+    к таблице связи favorited_by с select_related на объект.
+
+    Returns:
+        KeysetPage с объектами model; count - общее количество в избранном
+    """
+    field = model._meta.model_name
+    rows = model.favorited_by.through.objects.filter(user=user).select_related(field)
+    page = keyset_page(rows, parse_cursor(after), parse_cursor(before), per_page)
+    page.object_list = [getattr(row, field) for row in page.object_list]
+
+    if not page.has_other_pages():
+        # Весь список поместился на одну страницу - считать отдельно не нужно
+        page.count = len(page.object_list)
+    else:
+        key = favorites_count_key(model, user.pk)
+        page.count = cache.get(key)
+        if page.count is None:
+            page.count = model.favorited_by.through.objects.filter(user=user).count()
+            cache.set(key, page.count, getattr(settings, 'FAVORITES_COUNT_CACHE_TIMEOUT', 300))
+    return page
@@ -0,0 +1,64 @@
+"""
+Денормализованные агрегаты отзывов: review_count, rating_sum и avg_rating
+у фильмов, сериалов, сезонов и эпизодов.
+
+Агрегаты изменяются на разницу (UPDATE ... SET review_count = review_count + 1)
+в той же транзакции, что и сам отзыв (см. signals.py), поэтому параллельные
+отзывы не затирают друг друга. Расхождения, если они все же появились
+(например, после QuerySet.update() по отзывам), исправляет команда
+reconcile_ratings.
+"""
+from django.db.models import Case, Count, F, FloatField, Sum, Value, When
+from django.db.models.functions import Cast
+
+from .models import Movie, TVShow, Season, Episode, Review, TVShowReview, SeasonReview, EpisodeReview
+
+# Модель отзыва -> (модель объекта отзыва, поле внешнего ключа в отзыве)
+REVIEW_TARGETS = {
+    Review: (Movie, 'movie'),
+    TVShowReview: (TVShow, 'tvshow'),
+    SeasonReview: (Season, 'season'),
+    EpisodeReview: (Episode, 'episode'),
+}
+
+
+def average(rating_sum, review_count):
+    return rating_sum / review_count if review_count else 0
+
+
+def apply_rating_delta(model, pk, count_delta, sum_delta):
+    """
+    Изменяет агрегаты объекта одним UPDATE.
+
+    Args:
+        model: Movie, TVShow, Season или Episode
+        pk: id объекта
+        count_delta: Изменение количества отзывов (-1, 0 или 1)
+        sum_delta: Изменение суммы оценок
+    """
+    new_count = F('review_count') + count_delta
+    new_sum = F('rating_sum') + sum_delta
+    model.objects.filter(pk=pk).update(
+        review_count=new_count,
+        rating_sum=new_sum,
+        # В SET используются значения строки до обновления, поэтому среднее считаем по новым выражениям
+        avg_rating=Case(
+            When(review_count__gt=-count_delta, then=Cast(new_sum, FloatField()) / new_count),
+            default=Value(0.0),
+            output_field=FloatField(),
+        ),
+    )
+
+
+def compute_ratings(review_model):
+    """
+    Агрегаты, пересчитанные по таблице отзывов.
+
+    Returns:
+        dict: id объекта -> (review_count, rating_sum)
+    """
+    field = REVIEW_TARGETS[review_model][1]
+    rows = review_model.objects.order_by().values_list(f'{field}_id').annotate(
+        count=Count('id'), total=Sum('rating')
+    )
+    return {pk: (count, total) for pk, count, total in rows.iterator()}
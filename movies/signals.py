@@ -0,0 +1,63 @@
+"""
+Обработчики сигналов моделей, подключаются в MoviesConfig.ready().
+"""
+from django.core.cache import cache
+from django.db.models.signals import m2m_changed, pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Movie, TVShow
+from .pagination import favorites_count_key
+from .ratings import REVIEW_TARGETS, apply_rating_delta
+
+
+@receiver(m2m_changed, sender=Movie.favorited_by.through)
+@receiver(m2m_changed, sender=TVShow.favorited_by.through)
+def invalidate_favorites_count(sender, instance, action, reverse, model, pk_set, **kwargs):
+    """Сбрасывает кэшированное количество избранного у затронутых пользователей"""
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    # reverse: изменение со стороны пользователя (user.favorite_movies.add(...))
+    content_model = model if reverse else type(instance)
+    if reverse:
+        user_ids = [instance.pk]
+    elif action == 'pre_clear':
+        user_ids = list(instance.favorited_by.values_list('id', flat=True))
+    else:
+        user_ids = pk_set or []
+    cache.delete_many([favorites_count_key(content_model, user_id) for user_id in user_ids])
+
+
+def remember_previous_rating(sender, instance, raw=False, **kwargs):
+    """Запоминает оценку и объект отзыва до изменения, чтобы post_save применил разницу"""
+    field = REVIEW_TARGETS[sender][1]
+    instance._previous_rating = None
+    if instance.pk and not raw:
+        instance._previous_rating = sender.objects.filter(pk=instance.pk).values_list(
+            f'{field}_id', 'rating'
+        ).first()
+
+
+def update_ratings_on_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    model, field = REVIEW_TARGETS[sender]
+    target_id = getattr(instance, f'{field}_id')
+    previous = getattr(instance, '_previous_rating', None)
+    if created or previous is None:
+        apply_rating_delta(model, target_id, 1, instance.rating)
+    elif previous[0] != target_id:
+        apply_rating_delta(model, previous[0], -1, -previous[1])
+        apply_rating_delta(model, target_id, 1, instance.rating)
+    elif previous[1] != instance.rating:
+        apply_rating_delta(model, target_id, 0, instance.rating - previous[1])
+
+
+def update_ratings_on_delete(sender, instance, **kwargs):
+    model, field = REVIEW_TARGETS[sender]
+    apply_rating_delta(model, getattr(instance, f'{field}_id'), -1, -instance.rating)
+
+
+for review_model in REVIEW_TARGETS:
+    pre_save.connect(remember_previous_rating, sender=review_model)
+    post_save.connect(update_ratings_on_save, sender=review_model)
+    post_delete.connect(update_ratings_on_delete, sender=review_model)
@@ -0,0 +1,86 @@
+"""
+Фоновые задачи, выполняемые в пуле потоков текущего воркера.
+
+Используются для работы, результат которой не нужен для ответа на текущий
+запрос (например, обновление устаревших данных из TMDB).
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+_executors = {}
+_executors_pid = None
+_pending = set()
+_lock = threading.Lock()
+
+
+def _pool_size(pool):
+    if pool == 'default':
+        return getattr(settings, 'BACKGROUND_TASKS_WORKERS', 4)
+    return getattr(settings, 'BACKGROUND_TASKS_POOLS', {}).get(pool, 2)
+
+
+def get_executor(pool='default'):
+    """Return a background thread pool of the current worker process"""
+    global _executors_pid
+    pid = os.getpid()
+    with _lock:
+        if _executors_pid != pid:
+            # После fork пулы родительского процесса непригодны
+            _executors.clear()
+            _pending.clear()
+            _executors_pid = pid
+        executor = _executors.get(pool)
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=_pool_size(pool),
+                thread_name_prefix=f'tmdb-{pool}',
+            )
+            _executors[pool] = executor
+    return executor
+
+
+def _run(key, func, args, kwargs):
+    try:
+        return func(*args, **kwargs)
+    except Exception:
+        logger.exception(f"Background task {key} failed")
+    finally:
+        with _lock:
+            _pending.discard(key)
+        # Соединения с БД привязаны к потоку - закрываем их после задачи
+        connections.close_all()
+
+
+def run_in_pool(pool, key, func, *args, **kwargs):
+    """
+    Schedule func(*args, **kwargs) on the named background pool.
+
+    A task whose key is already queued or running is not scheduled again.
+    Returns the Future of the scheduled task, or None if it was deduplicated.
+    With BACKGROUND_TASKS_EAGER the task runs inline (useful in tests).
+    """
+    if getattr(settings, 'BACKGROUND_TASKS_EAGER', False):
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            logger.exception(f"Background task {key} failed")
+        return None
+
+    executor = get_executor(pool)
+    with _lock:
+        if key in _pending:
+            return None
+        _pending.add(key)
+    return executor.submit(_run, key, func, args, kwargs)
+
+
+def run_in_background(key, func, *args, **kwargs):
+    """Schedule func(*args, **kwargs) on the default background pool"""
+    return run_in_pool('default', key, func, *args, **kwargs)
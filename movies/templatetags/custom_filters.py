@@ -1,5 +1,8 @@
 from django import template
 from django.template.defaultfilters import stringfilter
+from django.utils.html import format_html, format_html_join
+
+from movies.image_cache import poster_color, poster_sources
 
 register = template.Library()
 
@@ -21,4 +24,34 @@ def replace(value, arg):
     args = arg.split(',')
     if len(args) != 2:
         return value
-    return value.replace(args[0], args[1]) 
\ No newline at end of file
+    return value.replace(args[0], args[1]) 
+@register.simple_tag
+def poster_img(url, alt='', css_class='', sizes='100vw', style='', loading='lazy', placeholder=''):
+    """
+    Renders a cached poster, offering WebP/AVIF derivatives via srcset when they exist.
+    Until the image loads, its average colour and stored placeholder (a blurred
+    16px thumbnail, set by resolve_posters) are shown as the background. Images
+    are lazy-loaded unless loading="eager" is passed (use it for posters above the fold).
+    Example: {% poster_img movie.cached_poster_url movie.title "card-img-top" "(max-width: 768px) 50vw, 25vw" placeholder=movie.cached_poster_placeholder %}
+    """
+    color = poster_color(url)
+    if placeholder:
+        style = f"background: {color} url({placeholder}) center / cover no-repeat; {style}"
+    elif color:
+        style = f"background-color: {color}; {style}"
+    if style:
+        img = format_html('<img src="{}" class="{}" style="{}" alt="{}" loading="{}" decoding="async">',
+                          url, css_class, style.strip(), alt, loading)
+    else:
+        img = format_html('<img src="{}" class="{}" alt="{}" loading="{}" decoding="async">',
+                          url, css_class, alt, loading)
+    sources = poster_sources(url)
+    if not sources:
+        return img
+    # display: contents - <picture> не влияет на раскладку, классы <img> работают как раньше
+    return format_html(
+        '<picture style="display: contents">{}{}</picture>',
+        format_html_join('', '<source type="{}" srcset="{}" sizes="{}">',
+                         ((mime, srcset, sizes) for mime, srcset in sources)),
+        img,
+    )
@@ -1,3 +1,1382 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from io import BytesIO, StringIO
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.http import Http404
+from django.template import Context, Template
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from .freshness import is_stale, refresh_movie, refresh_tv_show
+from .image_cache import (
+    PosterFailures, PosterInfo, PosterPresence, download_poster, evict_to_budget, get_or_cache_poster, poster_failures, poster_local_path, poster_presence,
+    poster_sources, resolve_posters, tmdb_image_url,
+)
+from .image_derivatives import available_formats, derivative_path, generate_derivatives
+from .ingest import bulk_upsert, resolve_existing, upsert_tv_shows
+from .models import Movie, TVShow, MovieWatchStatus, TVShowWatchStatus, WatchStatus, CachedPoster, Friendship
+from .models import Episode, Review, Season, SeasonReview, FriendInvitation, TVShowReview
+from .tasks import run_in_pool
+from .views import poster_file
+from . import async_views
+from .tmdb_api import TMDBApi, max_fetch_time
+from .tmdb_api_async import AsyncTMDBApi
+from .tmdb_cache import AsyncSingleFlight, DEFAULT_TTLS, TMDBResponseCache, get_response_cache, cache_key
+from .tmdb_throttle import CircuitBreaker, LocalTokenBucket, SharedTokenBucket, backoff_delay, retry_after_seconds
+
+
+@override_settings(POSTER_ACCESS_FLUSH_INTERVAL=3600)
+class MyWatchListQueryCountTests(TestCase):
+    """The watch list page must not issue queries per item"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('viewer', password='password')
+        self.client.force_login(self.user)
+        self.created = 0
+
+    def tearDown(self):
+        poster_presence.clear()
+
+    def add_items(self, count):
+        statuses = [choice for choice, _ in WatchStatus.choices]
+        for i in range(self.created, self.created + count):
+            movie = Movie.objects.create(tmdb_id=i, title=f'Movie {i}', poster_path=f'/movie{i}.jpg')
+            tvshow = TVShow.objects.create(tmdb_id=i, name=f'Show {i}', poster_path=f'/show{i}.jpg')
+            MovieWatchStatus.objects.create(user=self.user, movie=movie, status=statuses[i % len(statuses)])
+            TVShowWatchStatus.objects.create(user=self.user, tvshow=tvshow, status=statuses[i % len(statuses)])
+            if i % 2:
+                movie.favorited_by.add(self.user)
+                tvshow.favorited_by.add(self.user)
+            # Постеры уже в кэше - страница не должна ничего загружать
+            for path in (movie.poster_path, tvshow.poster_path):
+                CachedPoster.objects.create(path=poster_local_path(path), size='w500', file_size=1,
+                                            cached_date=timezone.now(), last_accessed=timezone.now())
+        self.created += count
+        poster_presence.reload()
+
+    def count_queries(self, tab):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('my_watch_list'), {'tab': tab, 'status': WatchStatus.WATCHING})
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_list_size(self):
+        self.add_items(1)
+        baseline = {tab: self.count_queries(tab) for tab in ('movies', 'tvshows')}
+
+        self.add_items(20)
+        for tab, expected in baseline.items():
+            with self.assertNumQueries(expected):
+                response = self.client.get(reverse('my_watch_list'),
+                                           {'tab': tab, 'status': WatchStatus.WATCHING})
+            self.assertEqual(response.status_code, 200)
+
+    def test_items_are_marked_as_favorites(self):
+        self.add_items(4)
+        response = self.client.get(reverse('my_watch_list'), {'tab': 'movies', 'status': WatchStatus.WATCHING})
+        items = response.context['movies_by_status'][WatchStatus.WATCHING]
+        self.assertEqual([item['is_favorite'] for item in items], [True])
+        self.assertTrue(all(item['movie'].cached_poster_url for item in items))
+
+
+@override_settings(POSTER_ACCESS_FLUSH_INTERVAL=3600)
+class FriendWatchListQueryCountTests(TestCase):
+    """A friend's list loads one page of the active status with a fixed number of queries"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('viewer', password='password')
+        self.friend = User.objects.create_user('friend', password='password')
+        Friendship.objects.create(user=self.user, friend=self.friend)
+        self.client.force_login(self.user)
+        self.url = reverse('friend_watch_list', args=[self.friend.id])
+
+    def add_movies(self, first, count, status=WatchStatus.COMPLETED):
+        for i in range(first, first + count):
+            movie = Movie.objects.create(tmdb_id=i, title=f'Movie {i}')
+            MovieWatchStatus.objects.create(user=self.friend, movie=movie, status=status)
+            if i % 2:
+                movie.favorited_by.add(self.friend)
+
+    def test_query_count_does_not_grow_with_list_size(self):
+        self.add_movies(0, 1)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.url)
+        self.add_movies(1, 60)
+        self.add_movies(100, 10, WatchStatus.WATCHING)
+        with self.assertNumQueries(len(queries)):
+            response = self.client.get(self.url)
+
+        self.assertEqual(len(response.context['items']), 24)
+        self.assertEqual(response.context['page'].paginator.num_pages, 3)
+        counts = {code: count for code, _, count in response.context['statuses']}
+        self.assertEqual(counts[WatchStatus.COMPLETED], 61)
+        self.assertEqual(counts[WatchStatus.WATCHING], 10)
+        self.assertEqual(counts[WatchStatus.DROPPED], 0)
+        for item in response.context['items']:
+            self.assertEqual(item['is_favorite'], bool(item['movie'].tmdb_id % 2))
+
+
+class FavoritesKeysetPaginationTests(TestCase):
+    """Favorites are paged by the favorites through-row id, newest first"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('viewer', password='password')
+        self.client.force_login(self.user)
+        self.movies = [Movie.objects.create(tmdb_id=i, title=f'Movie {i}') for i in range(30)]
+        for movie in self.movies:
+            movie.favorited_by.add(self.user)
+
+    def get_page(self, **params):
+        response = self.client.get(reverse('user_favorites'), {'tab': 'movies', **params})
+        return response.context['favorite_movies']
+
+    def test_pages_forward_and_back(self):
+        first = self.get_page()
+        self.assertEqual([m.tmdb_id for m in first], list(range(29, 17, -1)))
+        self.assertFalse(first.has_previous())
+        self.assertEqual(first.count, 30)
+
+        second = self.get_page(after_movies=first.next_cursor)
+        self.assertEqual([m.tmdb_id for m in second], list(range(17, 5, -1)))
+        last = self.get_page(after_movies=second.next_cursor)
+        self.assertEqual([m.tmdb_id for m in last], list(range(5, -1, -1)))
+        self.assertFalse(last.has_next())
+
+        back = self.get_page(before_movies=last.previous_cursor)
+        self.assertEqual([m.tmdb_id for m in back], [m.tmdb_id for m in second])
+        back = self.get_page(before_movies=back.previous_cursor)
+        self.assertEqual([m.tmdb_id for m in back], [m.tmdb_id for m in first])
+        self.assertFalse(back.has_previous())
+
+    def test_count_is_cached_and_invalidated(self):
+        self.get_page()
+        with self.assertNumQueries(4):  # session, user, one page of movies and of TV shows
+            self.assertEqual(self.get_page().count, 30)
+        self.movies[0].favorited_by.remove(self.user)
+        self.assertEqual(self.get_page().count, 29)
+        self.user.favorite_movies.add(self.movies[0])
+        self.assertEqual(self.get_page().count, 30)
+
+
+class RatingAggregatesTests(TestCase):
+    """review_count/rating_sum/avg_rating follow review changes"""
+
+    def setUp(self):
+        self.users = [User.objects.create_user(f'user{i}', password='password') for i in range(3)]
+        self.movie = Movie.objects.create(tmdb_id=1, title='Movie')
+
+    def assertRatings(self, obj, count, total, avg):
+        obj.refresh_from_db()
+        self.assertEqual((obj.review_count, obj.rating_sum), (count, total))
+        self.assertAlmostEqual(obj.avg_rating, avg)
+
+    def test_create_update_delete(self):
+        first = Review.objects.create(user=self.users[0], movie=self.movie, text='', rating=8)
+        Review.objects.create(user=self.users[1], movie=self.movie, text='', rating=5)
+        self.assertRatings(self.movie, 2, 13, 6.5)
+
+        first.rating = 10
+        first.save()
+        self.assertRatings(self.movie, 2, 15, 7.5)
+
+        first.delete()
+        self.assertRatings(self.movie, 1, 5, 5)
+        Review.objects.all().delete()
+        self.assertRatings(self.movie, 0, 0, 0)
+
+    def test_season_reviews(self):
+        tvshow = TVShow.objects.create(tmdb_id=1, name='Show')
+        season = Season.objects.create(tmdb_id=1, tv_show=tvshow, name='Season 1', season_number=1)
+        SeasonReview.objects.create(user=self.users[0], season=season, text='', rating=7)
+        self.assertRatings(season, 1, 7, 7)
+        self.assertRatings(tvshow, 0, 0, 0)
+
+    def test_top_rated_order(self):
+        other = Movie.objects.create(tmdb_id=2, title='Other')
+        Movie.objects.create(tmdb_id=3, title='Unreviewed')
+        Review.objects.create(user=self.users[0], movie=self.movie, text='', rating=6)
+        Review.objects.create(user=self.users[0], movie=other, text='', rating=9)
+        top = Movie.objects.filter(review_count__gt=0).order_by('-avg_rating', '-review_count')
+        self.assertEqual(list(top), [other, self.movie])
+
+    def test_reconcile_fixes_drift(self):
+        Review.objects.create(user=self.users[0], movie=self.movie, text='', rating=8)
+        # QuerySet.update() bypasses signals, so the aggregates drift
+        Review.objects.update(rating=2)
+        Movie.objects.create(tmdb_id=2, title='Stale', review_count=3, rating_sum=9, avg_rating=3)
+
+        out = StringIO()
+        call_command('reconcile_ratings', '--dry-run', stdout=out)
+        self.assertIn('Would fix 2 rows', out.getvalue())
+        self.assertRatings(self.movie, 1, 8, 8)
+
+        call_command('reconcile_ratings', stdout=StringIO())
+        self.assertRatings(self.movie, 1, 2, 2)
+        self.assertRatings(Movie.objects.get(tmdb_id=2), 0, 0, 0)
+
+    async def test_async_detail_fill_keeps_concurrent_aggregates(self):
+        tvshow = await TVShow.objects.acreate(tmdb_id=1, name='Show')
+
+        async def details(tmdb_id):
+            # A review lands while the view is fetching the details
+            await TVShowReview.objects.acreate(user=self.users[0], tvshow=tvshow, text='', rating=9)
+            return {'id': 1, 'name': 'Show', 'status': 'Ended', 'number_of_seasons': 0}
+
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        with mock.patch.object(async_views.AsyncTMDBApi, 'get_tv_show_details', side_effect=details), \
+                mock.patch.object(async_views.AsyncTMDBApi, 'get_seasons_details', return_value={}):
+            response = await async_views.tvshow_detail(request, 1)
+        self.assertEqual(response.status_code, 200)
+        tvshow = await TVShow.objects.aget(pk=tvshow.pk)
+        self.assertEqual((tvshow.status, tvshow.review_count, tvshow.rating_sum), ('Ended', 1, 9))
+
+
+@skipUnless(connection.vendor == 'sqlite', 'Query plans are checked against SQLite EXPLAIN QUERY PLAN output')
+class QueryIndexTests(TestCase):
+    """The hot queries of the views are planned on the indexes added for them"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('viewer', email='viewer@example.com', password='password')
+        self.movie = Movie.objects.create(tmdb_id=1, title='Movie')
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(index_name, plan)
+        self.assertNotIn('USE TEMP B-TREE', plan)
+
+    def test_watch_status_by_user_and_status(self):
+        self.assertUsesIndex(
+            MovieWatchStatus.objects.filter(user=self.user, status=WatchStatus.WATCHING).order_by('-updated_at'),
+            'moviestatus_user_status_idx'
+        )
+        self.assertUsesIndex(
+            TVShowWatchStatus.objects.filter(user=self.user, status=WatchStatus.WATCHING).order_by('-updated_at'),
+            'tvstatus_user_status_idx'
+        )
+
+    def test_reviews_of_movie(self):
+        self.assertUsesIndex(self.movie.reviews.all(), 'review_movie_created_idx')
+
+    def test_active_invitation(self):
+        self.assertUsesIndex(
+            FriendInvitation.objects.filter(creator=self.user, expires_at__gt=timezone.now(), uses_remaining__gt=0),
+            'invitation_active_idx'
+        )
+
+    def test_user_by_email(self):
+        self.assertUsesIndex(User.objects.filter(email='viewer@example.com'), 'auth_user_email_idx')
+
+    def test_top_rated(self):
+        self.assertUsesIndex(
+            Movie.objects.filter(review_count__gt=0).order_by('-avg_rating', '-review_count'),
+            'movie_top_rated_idx'
+        )
+
+
+class PosterPlaceholderTests(TestCase):
+    """Placeholders stay out of the per-process presence map and are read per page"""
+
+    def setUp(self):
+        poster_presence.clear()
+        self.addCleanup(poster_presence.clear)
+        now = timezone.now()
+        CachedPoster.objects.create(path=poster_local_path('cached.jpg'), size='w500', last_accessed=now,
+                                    cached_date=now, color='#102030', placeholder='data:image/webp;base64,AAAA')
+
+    def test_resolve_posters_reads_placeholders_in_one_query(self):
+        poster_presence.reload()
+        self.assertNotIn('data:', repr(poster_presence.get(poster_local_path('cached.jpg'))))
+        movies = [Movie(tmdb_id=1, poster_path='/cached.jpg'), Movie(tmdb_id=2, poster_path='/cached.jpg'),
+                  Movie(tmdb_id=3, poster_path='/missing.jpg'), Movie(tmdb_id=4, poster_path='')]
+        with mock.patch('movies.image_cache.schedule_poster_download'), self.assertNumQueries(1):
+            resolve_posters(movies)
+        self.assertEqual([movie.cached_poster_placeholder for movie in movies[:3]],
+                         ['data:image/webp;base64,AAAA', 'data:image/webp;base64,AAAA', ''])
+        self.assertFalse(hasattr(movies[3], 'cached_poster_placeholder'))
+
+
+class PosterFileTests(SimpleTestCase):
+    """poster_file only serves paths inside the poster cache"""
+
+    def test_rejects_unknown_sizes_and_parent_segments(self):
+        request = RequestFactory().get('/posters/')
+        with mock.patch('movies.views.fetch_poster') as fetch:
+            for size, poster_path in (('..', 'settings.py'), ('w500/..', 'x.jpg'), ('w999', 'x.jpg'),
+                                      ('w500', '../../settings.py')):
+                with self.subTest(size=size, poster_path=poster_path), self.assertRaises(Http404):
+                    poster_file(request, size, poster_path)
+        fetch.assert_not_called()
+
+
+@override_settings(POSTER_PRESENCE_CHECK_INTERVAL=0)
+class PosterPresenceInvalidationTests(TestCase):
+    """Deletions by one process reach the presence maps of the others"""
+
+    def setUp(self):
+        cache.delete(PosterPresence.GENERATION_KEY)
+        now = timezone.now()
+        self.path = poster_local_path('cached.jpg')
+        CachedPoster.objects.create(path=self.path, size='w500', last_accessed=now, cached_date=now)
+
+    def test_other_process_deletion_triggers_background_reload(self):
+        worker, cleaner = PosterPresence(), PosterPresence()
+        self.assertIsNotNone(worker.get(self.path))
+
+        CachedPoster.objects.filter(path=self.path).delete()
+        cleaner.invalidate()
+        # The request keeps using the old map while the reload is queued
+        with mock.patch('movies.image_cache.run_in_background') as background, self.assertNumQueries(0):
+            self.assertIsNotNone(worker.get(self.path))
+        background.assert_called_once_with('poster-presence-reload', worker.reload)
+
+        with override_settings(BACKGROUND_TASKS_EAGER=True):
+            self.assertIsNone(worker.get(self.path))
+
+    def test_concurrent_first_requests_load_once(self):
+        worker = PosterPresence()
+        calls = []
+
+        def slow_reload():
+            # Stands in for the index query (test threads have no access to the test transaction)
+            calls.append(1)
+            time.sleep(0.05)
+            worker._loaded_at = worker._checked_at = time.monotonic()
+        with mock.patch.object(worker, 'reload', side_effect=slow_reload):
+            threads = [threading.Thread(target=worker.get, args=(self.path,)) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(calls), 1)
+
+    def test_own_deletion_does_not_reload(self):
+        worker = PosterPresence()
+        worker.get(self.path)
+        worker.discard(self.path)
+        CachedPoster.objects.filter(path=self.path).delete()
+        worker.invalidate()
+        with self.assertNumQueries(0):
+            self.assertIsNone(worker.get(self.path))
+
+
+class CleanImageCacheTests(TestCase):
+    """clean_image_cache on the local filesystem storage"""
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root.name))
+        old = timezone.now() - timedelta(days=30)
+        self.files = {}
+        for name in ('locked.jpg', 'free.jpg'):
+            path = poster_local_path(name)
+            self.files[name] = os.path.join(media_root.name, path)
+            os.makedirs(os.path.dirname(self.files[name]), exist_ok=True)
+            with open(self.files[name], 'wb') as f:
+                f.write(b'image')
+            CachedPoster.objects.create(path=path, size='w500', file_size=5, cached_date=old, last_accessed=old)
+
+    def test_rows_of_files_that_failed_to_unlink_are_kept(self):
+        unlink = os.unlink
+
+        def failing_unlink(path):
+            if path == self.files['locked.jpg']:
+                raise PermissionError(path)
+            unlink(path)
+        with mock.patch('movies.management.commands.clean_image_cache.os.unlink', side_effect=failing_unlink):
+            out = StringIO()
+            call_command('clean_image_cache', '--days', '14', '--json', stdout=out)
+
+        self.assertEqual(json.loads(out.getvalue())['errors'], 1)
+        self.assertFalse(os.path.exists(self.files['free.jpg']))
+        self.assertEqual(list(CachedPoster.objects.values_list('path', flat=True)),
+                         [poster_local_path('locked.jpg')])
+
+    def untracked(self, name, age=timedelta(days=1)):
+        path = os.path.join(settings.MEDIA_ROOT, poster_local_path(name))
+        with open(path, 'wb') as f:
+            f.write(b'image')
+        mtime = (timezone.now() - age).timestamp()
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_legacy_meta_cache_is_left_for_migration(self):
+        image = self.untracked('legacy.jpg')
+        meta = self.untracked('legacy.jpg.meta')
+        orphan = self.untracked('orphan.jpg')
+        fresh = self.untracked('fresh.jpg', age=timedelta(minutes=5))
+        out = StringIO()
+        call_command('clean_image_cache', '--days', '60', '--json', stdout=out)
+
+        summary = json.loads(out.getvalue())
+        self.assertEqual((summary['removed_orphans'], summary['legacy_files']), (1, 2))
+        self.assertTrue(os.path.exists(image) and os.path.exists(meta) and os.path.exists(fresh))
+        self.assertFalse(os.path.exists(orphan))
+
+    def test_untracked_files_are_kept_while_index_is_empty(self):
+        CachedPoster.objects.all().delete()
+        orphan = self.untracked('orphan.jpg')
+        out = StringIO()
+        call_command('clean_image_cache', '--days', '60', '--json', stdout=out)
+
+        self.assertEqual(json.loads(out.getvalue())['removed_orphans'], 0)
+        self.assertTrue(os.path.exists(orphan) and os.path.exists(self.files['free.jpg']))
+
+    def test_file_indexed_during_scan_is_not_an_orphan(self):
+        path = self.untracked('late.jpg')
+        scandir = os.scandir
+
+        def indexing_scandir(directory):
+            if not CachedPoster.objects.filter(path=poster_local_path('late.jpg')).exists():
+                now = timezone.now()
+                CachedPoster.objects.create(path=poster_local_path('late.jpg'), size='w500', file_size=5,
+                                            cached_date=now, last_accessed=now)
+            return scandir(directory)
+        with mock.patch('movies.management.commands.clean_image_cache.os.scandir', side_effect=indexing_scandir):
+            out = StringIO()
+            call_command('clean_image_cache', '--days', '60', '--json', stdout=out)
+
+        self.assertEqual(json.loads(out.getvalue())['removed_orphans'], 0)
+        self.assertTrue(os.path.exists(path))
+
+
+def jpeg_bytes(width=500, height=750, color=(200, 30, 30)):
+    buffer = BytesIO()
+    Image.new('RGB', (width, height), color).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+class PosterCacheTestMixin:
+    """Temporary MEDIA_ROOT, inline background tasks and a mocked image.tmdb.org session"""
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.media_root = media_root.name
+        self.enterContext(override_settings(MEDIA_ROOT=media_root.name, BACKGROUND_TASKS_EAGER=True,
+                                            POSTER_ACCESS_FLUSH_INTERVAL=3600))
+        cache.clear()
+        self.addCleanup(cache.clear)
+        for registry in (poster_presence, poster_failures):
+            registry.clear()
+            self.addCleanup(registry.clear)
+        self.session = mock.Mock()
+        self.session.get.return_value = mock.Mock(status_code=200, content=jpeg_bytes())
+        self.enterContext(mock.patch('movies.image_cache.get_session', return_value=self.session))
+
+    def stored(self, local_path):
+        return os.path.exists(os.path.join(self.media_root, local_path))
+
+
+class PosterIndexTests(PosterCacheTestMixin, TestCase):
+    """download_poster keeps the CachedPoster index in step with the files"""
+
+    def test_download_writes_index_row(self):
+        url = download_poster('abc.jpg')
+        row = CachedPoster.objects.get()
+        self.assertEqual((row.path, row.size), ('posters/w500/abc.jpg', 'w500'))
+        self.assertEqual(url, f'{settings.MEDIA_URL}posters/w500/abc.jpg?v={row.content_hash}')
+        self.assertTrue(self.stored(row.path))
+        self.assertGreater(row.file_size, len(jpeg_bytes()))
+        self.assertEqual(poster_presence.get(row.path).file_size, row.file_size)
+
+    def test_failed_download_leaves_index_untouched(self):
+        download_poster('abc.jpg')
+        row = CachedPoster.objects.get()
+
+        self.session.get.return_value = mock.Mock(status_code=503, content=b'')
+        self.assertIsNone(download_poster('abc.jpg'))
+        self.session.get.return_value = mock.Mock(status_code=404, content=b'')
+        self.assertIsNone(download_poster('missing.jpg'))
+        self.session.get.side_effect = ConnectionError('reset')
+        self.assertIsNone(download_poster('broken.jpg'))
+
+        self.assertEqual(list(CachedPoster.objects.values_list('path', 'cached_date', 'content_hash')),
+                         [(row.path, row.cached_date, row.content_hash)])
+        self.assertTrue(self.stored(row.path))
+        self.assertFalse(self.stored('posters/w500/missing.jpg'))
+        self.assertIsNone(poster_presence.get('posters/w500/missing.jpg'))
+
+    def test_fresh_index_row_is_not_downloaded_again(self):
+        download_poster('abc.jpg')
+        self.session.get.reset_mock()
+        poster_presence.clear()
+        url = download_poster('abc.jpg', max_age_days=14)
+        self.session.get.assert_not_called()
+        self.assertTrue(url.endswith('?v=' + CachedPoster.objects.get().content_hash))
+
+
+class PosterDownloadQueueTests(PosterCacheTestMixin, TestCase):
+    """Page renders never wait for image.tmdb.org"""
+
+    def test_miss_returns_cdn_url_and_queues_download(self):
+        with override_settings(BACKGROUND_TASKS_EAGER=False), mock.patch('movies.image_cache.run_in_pool') as queue:
+            self.assertEqual(get_or_cache_poster('/abc.jpg'), tmdb_image_url('abc.jpg'))
+        self.session.get.assert_not_called()
+        queue.assert_called_once_with('posters', 'poster-download:w500/abc.jpg', download_poster, 'abc.jpg', 'w500', 14)
+
+    def test_queued_download_serves_local_copy_next_time(self):
+        self.assertEqual(get_or_cache_poster('/abc.jpg'), tmdb_image_url('abc.jpg'))
+        self.assertTrue(get_or_cache_poster('/abc.jpg').startswith(f'{settings.MEDIA_URL}posters/w500/abc.jpg?v='))
+        self.session.get.assert_called_once()
+
+    @override_settings(BACKGROUND_TASKS_EAGER=False)
+    def test_pool_skips_keys_already_queued(self):
+        started, release = threading.Event(), threading.Event()
+
+        def download():
+            started.set()
+            release.wait(5)
+            return 'done'
+        future = run_in_pool('posters', 'tests:download', download)
+        self.assertTrue(started.wait(5))
+        self.assertIsNone(run_in_pool('posters', 'tests:download', download))
+        release.set()
+        self.assertEqual(future.result(5), 'done')
+
+
+class ResolvePostersTests(PosterCacheTestMixin, TestCase):
+    """resolve_posters handles a whole list with one query, whatever its length"""
+
+    def cache_posters(self, *names):
+        now = timezone.now()
+        for name in names:
+            CachedPoster.objects.create(path=poster_local_path(name), size='w500', cached_date=now,
+                                        last_accessed=now, content_hash=f'hash-{name}')
+        poster_presence.reload()
+
+    def test_hits_misses_and_missing_paths(self):
+        self.cache_posters('hit.jpg')
+        objects = [{'poster_path': '/hit.jpg'}, Movie(tmdb_id=1, poster_path='/miss.jpg'),
+                   {'poster_path': None}, Movie(tmdb_id=2, poster_path='/miss.jpg')]
+        with override_settings(BACKGROUND_TASKS_EAGER=False), mock.patch('movies.image_cache.run_in_pool') as queue:
+            self.assertIs(resolve_posters(objects), objects)
+
+        self.assertEqual(objects[0]['cached_poster_url'], f'{settings.MEDIA_URL}posters/w500/hit.jpg?v=hash-hit.jpg')
+        self.assertEqual([objects[1].cached_poster_url, objects[3].cached_poster_url], [tmdb_image_url('miss.jpg')] * 2)
+        self.assertNotIn('cached_poster_url', objects[2])
+        self.assertEqual({call.args[1] for call in queue.call_args_list}, {'poster-download:w500/miss.jpg'})
+
+    def test_still_attributes(self):
+        self.cache_posters('still.jpg')
+        episode = {'still_path': '/still.jpg'}
+        resolve_posters([episode], 'still_path', 'cached_still_url')
+        self.assertTrue(episode['cached_still_url'].startswith(f'{settings.MEDIA_URL}posters/w500/still.jpg'))
+        self.assertEqual(episode['cached_still_placeholder'], '')
+
+    def test_query_count_does_not_grow_with_list_size(self):
+        names = [f'poster{i}.jpg' for i in range(20)]
+        self.cache_posters(*names)
+        with self.assertNumQueries(1):
+            resolve_posters([{'poster_path': f'/{name}'} for name in names[:2]])
+        with self.assertNumQueries(1):
+            resolve_posters([{'poster_path': f'/{name}'} for name in names])
+        # Nothing cached - no placeholder query at all
+        with self.assertNumQueries(0), mock.patch('movies.image_cache.schedule_poster_download'):
+            resolve_posters([{'poster_path': '/uncached.jpg'}])
+
+
+class PosterPresenceTests(PosterCacheTestMixin, TestCase):
+    """Warm posters resolve from the in-memory presence map without DB or storage I/O"""
+
+    def setUp(self):
+        super().setUp()
+        self.cached_at = timezone.now()
+        CachedPoster.objects.create(path=poster_local_path('abc.jpg'), size='w500', cached_date=self.cached_at,
+                                    last_accessed=self.cached_at, content_hash='v1', file_size=10)
+        poster_presence.reload()
+
+    def test_hit_needs_no_queries_or_storage(self):
+        with self.assertNumQueries(0), \
+                mock.patch('movies.image_cache.default_storage.exists', side_effect=AssertionError('storage I/O')), \
+                mock.patch('movies.image_cache.schedule_poster_download') as schedule:
+            self.assertEqual(get_or_cache_poster('/abc.jpg'), f'{settings.MEDIA_URL}posters/w500/abc.jpg?v=v1')
+        schedule.assert_not_called()
+        self.assertEqual(poster_presence.total_size, 10)
+
+    def test_stale_copy_is_served_while_refreshing(self):
+        CachedPoster.objects.update(cached_date=self.cached_at - timedelta(days=30))
+        poster_presence.reload()
+        with mock.patch('movies.image_cache.schedule_poster_download') as schedule:
+            self.assertEqual(get_or_cache_poster('/abc.jpg'), f'{settings.MEDIA_URL}posters/w500/abc.jpg?v=v1')
+        schedule.assert_called_once_with('abc.jpg', 'w500')
+
+    @override_settings(POSTER_X_ACCEL_REDIRECT=True)
+    def test_urls_point_to_poster_file_behind_nginx(self):
+        self.assertEqual(get_or_cache_poster('/abc.jpg'), '/posters/w500/abc.jpg?v=v1')
+        # A miss is fetched by poster_file when the browser asks for it
+        with mock.patch('movies.image_cache.schedule_poster_download') as schedule:
+            self.assertEqual(get_or_cache_poster('/new.jpg'), '/posters/w500/new.jpg')
+        schedule.assert_not_called()
+
+
+@override_settings(POSTER_DERIVATIVE_WIDTHS=[185, 342, 500])
+class PosterDerivativeTests(PosterCacheTestMixin, TestCase):
+    """WebP/AVIF derivatives and the srcset built from the presence map"""
+
+    def test_generates_only_widths_up_to_original(self):
+        local_path = poster_local_path('abc.jpg')
+        formats, widths, total_size = generate_derivatives(local_path, jpeg_bytes(width=400, height=600))
+        self.assertEqual((formats, widths), (available_formats(), [185, 342]))
+        self.assertIn('webp', formats)
+        paths = [derivative_path(local_path, width, fmt) for fmt in formats for width in widths]
+        self.assertTrue(all(self.stored(path) for path in paths))
+        self.assertEqual(total_size, sum(os.path.getsize(os.path.join(self.media_root, path)) for path in paths))
+
+    def test_sources_come_from_presence_map_without_queries(self):
+        local_path = poster_local_path('abc.jpg')
+        poster_presence.reload()
+        poster_presence.add(local_path, PosterInfo(timezone.now(), ('webp', 'avif'), (185, 342), '', 'v1', 1))
+        url = f'{settings.MEDIA_URL}{local_path}?v=v1'
+        with self.assertNumQueries(0):
+            sources = poster_sources(url)
+            html = Template('{% load custom_filters %}{% poster_img url "Title" %}').render(Context({'url': url}))
+        base = f'{settings.MEDIA_URL}posters/w500/derived/abc'
+        self.assertEqual(sources, [
+            ('image/avif', f'{base}-185.avif?v=v1 185w, {base}-342.avif?v=v1 342w'),
+            ('image/webp', f'{base}-185.webp?v=v1 185w, {base}-342.webp?v=v1 342w'),
+        ])
+        self.assertIn('<picture', html)
+        self.assertIn(f'<source type="image/webp" srcset="{base}-185.webp?v=v1 185w', html)
+
+    def test_no_sources_for_uncached_or_external_urls(self):
+        poster_presence.reload()
+        self.assertEqual(poster_sources(tmdb_image_url('abc.jpg')), [])
+        self.assertEqual(poster_sources(f'{settings.MEDIA_URL}posters/w500/unknown.jpg'), [])
+        html = Template('{% load custom_filters %}{% poster_img url %}').render(Context({'url': tmdb_image_url('abc.jpg')}))
+        self.assertNotIn('<picture', html)
+
+
+@override_settings(POSTER_RETRY_BACKOFF_BASE=60, POSTER_MISSING_BACKOFF_BASE=3600, POSTER_RETRY_BACKOFF_MAX=86400)
+class PosterFailureTests(PosterCacheTestMixin, TestCase):
+    """Failed image downloads are not retried until their backoff expires"""
+
+    def setUp(self):
+        super().setUp()
+        self.now = time.time()
+        self.enterContext(mock.patch('movies.image_cache.time.time', lambda: self.now))
+
+    def test_failed_path_is_skipped_until_backoff_expires(self):
+        self.session.get.return_value = mock.Mock(status_code=503, content=b'')
+        self.assertIsNone(download_poster('abc.jpg'))
+        self.session.get.return_value = mock.Mock(status_code=200, content=jpeg_bytes())
+
+        self.now += 59
+        with mock.patch('movies.image_cache.schedule_poster_download') as schedule:
+            # Transient failure: pages keep using the CDN URL without queueing downloads
+            self.assertEqual(get_or_cache_poster('/abc.jpg'), tmdb_image_url('abc.jpg'))
+        schedule.assert_not_called()
+        self.assertIsNone(download_poster('abc.jpg'))
+        self.assertEqual(self.session.get.call_count, 1)
+
+        self.now += 1
+        self.assertIsNotNone(download_poster('abc.jpg'))
+        self.assertEqual(self.session.get.call_count, 2)
+        self.assertIsNone(poster_failures.get(poster_local_path('abc.jpg')))
+
+    def test_missing_images_back_off_longer_and_exponentially(self):
+        local_path = poster_local_path('gone.jpg')
+        self.session.get.return_value = mock.Mock(status_code=404, content=b'')
+        download_poster('gone.jpg')
+        self.assertEqual(poster_failures.get(local_path)['retry_at'], self.now + 3600)
+        # TMDB has no such image either - no <img> at all
+        self.assertIsNone(get_or_cache_poster('/gone.jpg'))
+
+        self.now += 3600
+        download_poster('gone.jpg')
+        self.assertEqual(poster_failures.get(local_path)['retry_at'], self.now + 7200)
+        self.assertEqual(poster_failures.get(local_path)['failures'], 2)
+
+    def test_failures_are_shared_between_workers(self):
+        self.session.get.return_value = mock.Mock(status_code=404, content=b'')
+        download_poster('gone.jpg')
+        other_worker = PosterFailures()
+        self.assertIsNone(other_worker.get(poster_local_path('gone.jpg')))
+        self.assertTrue(other_worker.check_shared(poster_local_path('gone.jpg'))['missing'])
+
+
+class PosterFileFetchTests(PosterCacheTestMixin, TestCase):
+    """poster_file only downloads images that stored objects reference"""
+
+    def get(self, poster_path):
+        return poster_file(RequestFactory().get('/posters/'), 'w500', poster_path)
+
+    def test_unknown_path_is_redirected_without_download(self):
+        response = self.get('random/abc.jpg')
+        self.assertEqual((response.status_code, response['Location']), (302, tmdb_image_url('random/abc.jpg')))
+        self.session.get.assert_not_called()
+        self.assertIsNone(poster_failures.check_shared(poster_local_path('random/abc.jpg')))
+        self.assertFalse(CachedPoster.objects.exists())
+
+    def test_referenced_path_is_fetched_and_served(self):
+        Movie.objects.create(tmdb_id=1, title='Movie', poster_path='/abc.jpg')
+        response = self.get('abc.jpg')
+        self.assertEqual(response['X-Accel-Redirect'], f'{settings.POSTER_X_ACCEL_LOCATION}posters/w500/abc.jpg')
+        self.session.get.assert_called_once()
+
+        tvshow = TVShow.objects.create(tmdb_id=1, name='Show')
+        season = Season.objects.create(tmdb_id=1, tv_show=tvshow, name='Season 1', season_number=1)
+        Episode.objects.create(tmdb_id=1, tv_show=tvshow, season=season, name='Pilot', episode_number=1,
+                               season_number=1, still_path='/still.jpg')
+        self.assertEqual(self.get('still.jpg').status_code, 200)
+        self.assertEqual(self.session.get.call_count, 2)
+
+
+class EvictionTests(PosterCacheTestMixin, TestCase):
+
+    def test_eviction_invalidates_presence_once_per_run(self):
+        now = timezone.now()
+        CachedPoster.objects.bulk_create(
+            CachedPoster(path=poster_local_path(f'p{i}.jpg'), size='w500', file_size=10, cached_date=now,
+                         last_accessed=now - timedelta(seconds=i))
+            for i in range(1200)
+        )
+        with mock.patch.object(poster_presence, 'invalidate') as invalidate:
+            before, after, removed = evict_to_budget(max_bytes=1000, target_bytes=100)
+        self.assertEqual((before, after, removed), (12000, 100, 1190))
+        invalidate.assert_called_once_with()
+        # The least recently used go first
+        self.assertTrue(CachedPoster.objects.filter(path=poster_local_path('p0.jpg')).exists())
+        self.assertFalse(CachedPoster.objects.filter(path=poster_local_path('p10.jpg')).exists())
+
+
+class WarmImageCacheTests(PosterCacheTestMixin, TransactionTestCase):
+    """warm_image_cache downloads the missing and stale posters of the working set within the byte budget"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('viewer', password='password')
+
+    def favorite(self, name, file_size=None, age=timedelta(days=1)):
+        movie = Movie.objects.create(tmdb_id=Movie.objects.count() + 1, title=name, poster_path=f'/{name}.jpg')
+        movie.favorited_by.add(self.user)
+        if file_size is not None:
+            cached_date = timezone.now() - age
+            CachedPoster.objects.create(path=poster_local_path(f'{name}.jpg'), size='w500', file_size=file_size,
+                                        cached_date=cached_date, last_accessed=cached_date)
+
+    def warm(self, *args):
+        out = StringIO()
+        call_command('warm_image_cache', '--popular-pages', '0', '--workers', '1', *args, stdout=out)
+        return out.getvalue()
+
+    def fetched(self):
+        return sorted(call.args[0] for call in self.session.get.call_args_list)
+
+    def test_missing_and_stale_images_are_selected(self):
+        self.favorite('missing')
+        self.favorite('fresh', file_size=100)
+        self.favorite('stale', file_size=100, age=timedelta(days=30))
+        Movie.objects.create(tmdb_id=100, title='Nobody', poster_path='/nobody.jpg')
+
+        self.warm('--days', '14')
+        self.assertEqual(self.fetched(), [tmdb_image_url('missing.jpg'), tmdb_image_url('stale.jpg')])
+        stale = CachedPoster.objects.get(path=poster_local_path('stale.jpg'))
+        self.assertGreater(stale.cached_date, timezone.now() - timedelta(days=1))
+        self.assertGreater(stale.file_size, 100)
+
+    def test_budget_stops_new_downloads_but_refreshes_stale_ones(self):
+        self.favorite('big', file_size=1024 * 1024)
+        self.favorite('missing')
+        self.favorite('stale', file_size=100, age=timedelta(days=30))
+
+        output = self.warm('--days', '14', '--max-size', '1')
+        self.assertEqual(self.fetched(), [tmdb_image_url('stale.jpg')])
+        self.assertIn('1 images were not downloaded', output)
+
+    def test_restart_downloads_only_the_rest(self):
+        download_poster('probe.jpg')
+        probe = CachedPoster.objects.get()
+        probe.delete()
+        self.session.get.reset_mock()
+        for name in ('a', 'b', 'c'):
+            self.favorite(name)
+
+        # Budget for about one and a half images: the run stops after the first download
+        with override_settings(POSTER_CACHE_MAX_SIZE_MB=probe.file_size * 1.5 / (1024 * 1024),
+                               POSTER_CACHE_EVICT_TARGET=1):
+            self.warm()
+        self.assertEqual(self.session.get.call_count, 1)
+        first = self.fetched()
+
+        self.warm()
+        self.assertEqual(self.session.get.call_count, 3)
+        self.assertEqual(sorted(set(self.fetched())), [tmdb_image_url(f'{name}.jpg') for name in ('a', 'b', 'c')])
+        self.assertEqual(self.fetched().count(first[0]), 1)
+        self.assertEqual(CachedPoster.objects.count(), 3)
+
+
+class BulkUpsertTests(TestCase):
+    """Popular/search pages are stored with one upsert instead of a query per row"""
+
+    def movie_row(self, tmdb_id, title='Movie', vote_count=10):
+        return {'tmdb_id': tmdb_id, 'title': title, 'overview': '', 'poster_path': '', 'release_date': None,
+                'vote_average': 7.0, 'vote_count': vote_count}
+
+    def test_list_upsert_keeps_detail_only_fields(self):
+        TVShow.objects.create(tmdb_id=1, name='Show', status='Ended', number_of_seasons=5)
+        row = {'tmdb_id': 1, 'name': 'Renamed', 'overview': '', 'poster_path': '', 'first_air_date': None,
+               'vote_average': 8.0, 'vote_count': 20}
+        upsert_tv_shows([row])
+        tvshow = TVShow.objects.get(tmdb_id=1)
+        self.assertEqual(tvshow.name, 'Renamed')
+        self.assertEqual(tvshow.status, 'Ended')
+        self.assertEqual(tvshow.number_of_seasons, 5)
+
+    def test_unchanged_rows_are_not_written(self):
+        bulk_upsert(Movie, [self.movie_row(1), self.movie_row(2)])
+        updated_at = dict(Movie.objects.values_list('tmdb_id', 'updated_at'))
+
+        with self.assertNumQueries(1):
+            movies = bulk_upsert(Movie, [self.movie_row(1), self.movie_row(2)])
+        self.assertEqual([movie.tmdb_id for movie in movies], [1, 2])
+
+        bulk_upsert(Movie, [self.movie_row(1), self.movie_row(2, vote_count=11)])
+        self.assertEqual(Movie.objects.get(tmdb_id=1).updated_at, updated_at[1])
+        self.assertNotEqual(Movie.objects.get(tmdb_id=2).updated_at, updated_at[2])
+
+    def test_result_keeps_input_order_with_saved_pks(self):
+        Movie.objects.create(tmdb_id=2, title='Old')
+        rows = [self.movie_row(3), self.movie_row(1), self.movie_row(2, title='New')]
+        movies = bulk_upsert(Movie, rows)
+        self.assertEqual([movie.tmdb_id for movie in movies], [3, 1, 2])
+        self.assertEqual(movies, [Movie.objects.get(tmdb_id=tmdb_id) for tmdb_id in (3, 1, 2)])
+        self.assertTrue(all(movie.pk for movie in movies))
+        self.assertEqual(movies[2].title, 'New')
+        self.assertEqual(bulk_upsert(Movie, []), [])
+
+
+class SearchResultsTests(TestCase):
+    """Search results are matched against stored rows with one query and keep TMDB's order"""
+
+    def movie_data(self, tmdb_id):
+        return {'id': tmdb_id, 'title': f'TMDB {tmdb_id}', 'overview': '', 'poster_path': None,
+                'release_date': '', 'vote_average': 5.0, 'vote_count': 1}
+
+    def test_resolve_existing_merges_stored_rows_in_order(self):
+        stored = Movie.objects.create(tmdb_id=2, title='Stored', review_count=1, rating_sum=8, avg_rating=8)
+        rows = [TMDBApi().format_movie_data(self.movie_data(tmdb_id)) for tmdb_id in (3, 2, 1)]
+        with self.assertNumQueries(1):
+            movies = resolve_existing(Movie, rows)
+        self.assertEqual([movie.tmdb_id for movie in movies], [3, 2, 1])
+        self.assertEqual((movies[1].pk, movies[1].title, movies[1].avg_rating), (stored.pk, 'Stored', 8))
+        self.assertEqual([movies[0].pk, movies[2].pk], [None, None])
+        self.assertEqual(Movie.objects.count(), 1)
+
+    def search(self, count):
+        movies = {'results': [self.movie_data(tmdb_id) for tmdb_id in range(count, 0, -1)]}
+        shows = {'results': [{'id': tmdb_id, 'name': f'Show {tmdb_id}'} for tmdb_id in range(count)]}
+        with mock.patch.object(TMDBApi, 'search_movies', return_value=movies), \
+                mock.patch.object(TMDBApi, 'search_tv_shows', return_value=shows), \
+                CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('home'), {'query': 'title'})
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_search_page_query_count_does_not_grow_with_results(self):
+        for tmdb_id in range(1, 9, 2):
+            Movie.objects.create(tmdb_id=tmdb_id, title=f'Stored {tmdb_id}')
+        _, baseline = self.search(2)
+        response, queries = self.search(8)
+        self.assertEqual(queries, baseline)
+        self.assertEqual([movie.tmdb_id for movie in response.context['movie_results']], list(range(8, 0, -1)))
+        self.assertEqual(response.context['movie_results'][0].title, 'TMDB 8')
+        self.assertEqual(response.context['movie_results'][1].title, 'Stored 7')
+
+
+class FreshnessTests(TestCase):
+    """Detail freshness is not affected by popular/search list upserts"""
+
+    def list_row(self, vote_count):
+        return {'tmdb_id': 1, 'name': 'Show', 'overview': '', 'poster_path': '', 'first_air_date': None,
+                'vote_average': 7.0, 'vote_count': vote_count}
+
+    def test_list_upsert_does_not_make_details_fresh(self):
+        tvshow, = upsert_tv_shows([self.list_row(10)])
+        self.assertTrue(is_stale(tvshow))
+
+        details = {'id': 1, 'name': 'Show', 'status': 'Returning Series', 'number_of_seasons': 2}
+        with mock.patch.object(TMDBApi, 'get_tv_show_details', return_value=details):
+            self.assertTrue(refresh_tv_show(1))
+        tvshow.refresh_from_db()
+        self.assertFalse(is_stale(tvshow))
+
+        # A later list upsert changes the row but not its details timestamp
+        details_updated_at = tvshow.details_updated_at
+        tvshow, = upsert_tv_shows([self.list_row(11)])
+        self.assertEqual(tvshow.vote_count, 11)
+        self.assertEqual(tvshow.details_updated_at, details_updated_at)
+        self.assertTrue(is_stale(tvshow, max_age=0))
+
+    def test_refresh_bypasses_response_cache(self):
+        cache.clear()
+        get_response_cache().clear_local()
+        Movie.objects.create(tmdb_id=5, title='Old title')
+        get_response_cache().set('/movie/5', {}, {'id': 5, 'title': 'Old title'})
+
+        with mock.patch.object(TMDBApi, '_fetch', return_value={'id': 5, 'title': 'New title'}) as fetch:
+            self.assertTrue(refresh_movie(5))
+        fetch.assert_called_once()
+        movie = Movie.objects.get(tmdb_id=5)
+        self.assertEqual(movie.title, 'New title')
+        self.assertFalse(is_stale(movie))
+        # The fresh response replaced the cached one
+        self.assertEqual(TMDBApi().get_movie_details(5)['title'], 'New title')
+
+        # A failed refresh must not stamp an expired cached copy as fresh
+        Movie.objects.filter(tmdb_id=5).update(details_updated_at=None)
+        with mock.patch.object(TMDBApi, '_fetch', return_value=None):
+            self.assertFalse(refresh_movie(5))
+        self.assertIsNone(Movie.objects.get(tmdb_id=5).details_updated_at)
+
+
+class ResponseCacheTests(SimpleTestCase):
+    """Per-endpoint TTLs, the in-process LRU and the shared tier of TMDBResponseCache"""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.now = 1_000_000.0
+        patcher = mock.patch('movies.tmdb_cache.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_ttl_per_endpoint_family(self):
+        response_cache = TMDBResponseCache(ttls={'search': 60})
+        self.assertEqual(response_cache.ttl_for('/movie/popular'), DEFAULT_TTLS['popular'])
+        self.assertEqual(response_cache.ttl_for('/movie/550'), DEFAULT_TTLS['movie'])
+        self.assertEqual(response_cache.ttl_for('/tv/1/season/2'), DEFAULT_TTLS['season'])
+        self.assertEqual(response_cache.ttl_for('/tv/1/season/2/episode/3'), DEFAULT_TTLS['episode'])
+        self.assertEqual(response_cache.ttl_for('/search/movie'), 60)
+        self.assertEqual(response_cache.ttl_for('/genre/movie/list'), DEFAULT_TTLS['default'])
+
+        # TTL 0 disables caching of the family
+        response_cache.set('/configuration', {}, {'images': {}})
+        self.assertIsNone(response_cache.get('/configuration', {}))
+
+    def test_entry_expires_after_family_ttl_but_stays_available_as_stale(self):
+        response_cache = TMDBResponseCache(ttls={'search': 60})
+        response_cache.set('/search/movie', {'query': 'alien'}, {'results': [1]})
+        self.now += 59
+        self.assertEqual(response_cache.get('/search/movie', {'query': 'alien'}), {'results': [1]})
+        self.now += 1
+        self.assertIsNone(response_cache.get('/search/movie', {'query': 'alien'}))
+        self.assertEqual(response_cache.get_stale('/search/movie', {'query': 'alien'}), {'results': [1]})
+
+    def test_lru_evicts_least_recently_used(self):
+        response_cache = TMDBResponseCache(max_entries=2)
+        for movie_id in (1, 2):
+            response_cache.set(f'/movie/{movie_id}', {}, {'id': movie_id})
+        response_cache.get('/movie/1', {})
+        response_cache.set('/movie/3', {}, {'id': 3})
+
+        self.assertEqual(list(response_cache._local), [cache_key('/movie/1'), cache_key('/movie/3')])
+        # The evicted entry is still served by the shared tier
+        self.assertEqual(response_cache.get('/movie/2', {}), {'id': 2})
+        self.assertEqual(response_cache.stats()['shared_hits'], 1)
+
+    def test_workers_share_responses(self):
+        first, second = TMDBResponseCache(), TMDBResponseCache()
+        first.set('/tv/1', {}, {'id': 1})
+        self.assertEqual(second.get('/tv/1', {}), {'id': 1})
+        self.assertEqual(second.get('/tv/1', {}), {'id': 1})
+        stats = second.stats()
+        self.assertEqual((stats['shared_hits'], stats['local_hits'], stats['misses']), (1, 1, 0))
+
+    def test_backend_errors_degrade_to_misses(self):
+        response_cache = TMDBResponseCache()
+        with mock.patch.object(cache, 'get', side_effect=ConnectionError('down')), \
+                mock.patch.object(cache, 'set', side_effect=ConnectionError('down')):
+            response_cache.set('/movie/1', {}, {'id': 1})
+            self.assertEqual(response_cache.get('/movie/1', {}), {'id': 1})
+            self.assertIsNone(response_cache.get('/movie/2', {}))
+        self.assertEqual(response_cache.stats()['errors'], 2)
+
+
+@override_settings(TMDB_SINGLE_FLIGHT_SHARED=True, TMDB_SINGLE_FLIGHT_TIMEOUT=0.3)
+class SharedFillTests(TestCase):
+    """Cross-process single flight through the fill lock in the shared cache"""
+    endpoint = '/movie/7'
+
+    def setUp(self):
+        cache.clear()
+        get_response_cache().clear_local()
+        self.key = cache_key(self.endpoint, {})
+
+    def test_waiter_does_not_release_foreign_lock(self):
+        cache.add(self.key + ':lock', 'other process', timeout=60)
+        with mock.patch.object(TMDBApi, '_fetch', return_value={'id': 7}) as fetch:
+            self.assertEqual(TMDBApi()._fetch_and_store(self.endpoint, {}), {'id': 7})
+        fetch.assert_called_once()
+        self.assertEqual(cache.get(self.key + ':lock'), 'other process')
+
+    def test_waiter_stops_on_leader_miss(self):
+        cache.add(self.key + ':lock', 'other process', timeout=60)
+        get_response_cache().mark_fill_failed(self.endpoint, {})
+        with mock.patch.object(TMDBApi, '_fetch') as fetch:
+            self.assertIsNone(TMDBApi()._fetch_and_store(self.endpoint, {}))
+        fetch.assert_not_called()
+
+    def test_leader_publishes_miss_and_releases_lock(self):
+        with mock.patch.object(TMDBApi, '_fetch', return_value=None):
+            self.assertIsNone(TMDBApi()._fetch_and_store(self.endpoint, {}))
+        self.assertIsNotNone(cache.get(self.key + ':miss'))
+        self.assertIsNone(cache.get(self.key + ':lock'))
+
+    @override_settings(TMDB_MAX_RETRIES=3, TMDB_RATE_LIMIT_WAIT=5, TMDB_HTTP_CONNECT_TIMEOUT=3,
+                       TMDB_HTTP_READ_TIMEOUT=10, TMDB_RETRY_BACKOFF_MAX=8)
+    def test_lock_outlives_slowest_fetch(self):
+        self.assertEqual(max_fetch_time(), 4 * (5 + 3 + 10) + 3 * 8)
+        response_cache = get_response_cache()
+        with mock.patch.object(response_cache, 'acquire_fill_lock', wraps=response_cache.acquire_fill_lock) as lock, \
+                mock.patch.object(TMDBApi, '_fetch', return_value={'id': 7}):
+            TMDBApi()._fetch_and_store(self.endpoint, {})
+        self.assertEqual(lock.call_args.kwargs['timeout'], max_fetch_time())
+
+    def test_leader_keeps_lock_taken_over_by_another_process(self):
+        def fetch(endpoint, params):
+            # Our lock expired and another process took it over
+            cache.set(self.key + ':lock', 'other process', timeout=60)
+            return {'id': 7}
+        with mock.patch.object(TMDBApi, '_fetch', side_effect=fetch):
+            TMDBApi()._fetch_and_store(self.endpoint, {})
+        self.assertEqual(cache.get(self.key + ':lock'), 'other process')
+
+    def test_leader_rechecks_cache_after_lock(self):
+        cache.set(self.key, {'data': {'id': 7}, 'expires_at': time.time() + 60})
+        with mock.patch.object(TMDBApi, '_fetch') as fetch:
+            self.assertEqual(TMDBApi()._fetch_and_store(self.endpoint, {}), {'id': 7})
+        fetch.assert_not_called()
+
+
+class FakeClock:
+    """Replaces time.monotonic() in tmdb_throttle"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class CircuitBreakerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch('movies.tmdb_throttle.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+
+    def open_breaker(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+
+    def test_opens_after_threshold(self):
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_success_resets_failure_count(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_single_trial_after_reset_timeout(self):
+        self.open_breaker()
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_trial_success_closes(self):
+        self.open_breaker()
+        self.clock.now += 30
+        self.breaker.allow()
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    def test_trial_failure_reopens(self):
+        self.open_breaker()
+        self.clock.now += 30
+        self.breaker.allow()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+
+    def test_abandoned_trial_lets_next_one_through(self):
+        self.open_breaker()
+        self.clock.now += 30
+        self.breaker.allow()
+        self.breaker.record_abandoned()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertTrue(self.breaker.allow())
+
+    def test_abandoned_request_does_not_count_as_failure(self):
+        self.breaker.record_abandoned()
+        self.breaker.record_abandoned()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_lost_trial_expires_after_reset_timeout(self):
+        self.open_breaker()
+        self.clock.now += 30
+        self.breaker.allow()
+        self.clock.now += 29
+        self.assertFalse(self.breaker.allow())
+        self.clock.now += 1
+        self.assertTrue(self.breaker.allow())
+
+
+class BackoffTests(SimpleTestCase):
+
+    def test_backoff_delay_is_capped_full_jitter(self):
+        with mock.patch('movies.tmdb_throttle.random.uniform', side_effect=lambda low, high: high) as uniform:
+            self.assertEqual(backoff_delay(0, base=0.5, cap=8), 0.5)
+            self.assertEqual(backoff_delay(3, base=0.5, cap=8), 4)
+            self.assertEqual(backoff_delay(10, base=0.5, cap=8), 8)
+        self.assertEqual(uniform.call_args_list[0], mock.call(0, 0.5))
+
+    def test_retry_after_seconds(self):
+        self.assertEqual(retry_after_seconds(mock.Mock(headers={'Retry-After': '3'})), 3)
+        self.assertEqual(retry_after_seconds(mock.Mock(headers={'Retry-After': '-1'})), 0)
+        self.assertIsNone(retry_after_seconds(mock.Mock(headers={})))
+        self.assertIsNone(retry_after_seconds(mock.Mock(headers={'Retry-After': 'soon'})))
+        self.assertIsNone(retry_after_seconds(None))
+
+    def test_retry_after_http_date(self):
+        with mock.patch('movies.tmdb_throttle.time.time', return_value=784111777):
+            delay = retry_after_seconds(mock.Mock(headers={'Retry-After': 'Sun, 06 Nov 1994 08:49:47 GMT'}))
+        self.assertEqual(delay, 10)
+
+
+class LocalTokenBucketTests(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch('movies.tmdb_throttle.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_then_wait_for_refill(self):
+        bucket = LocalTokenBucket(rate=2, capacity=3)
+        self.assertEqual([bucket._try_acquire() for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket._try_acquire(), 0.5)
+        self.clock.now += 0.5
+        self.assertEqual(bucket._try_acquire(), 0)
+
+    def test_refill_does_not_exceed_capacity(self):
+        bucket = LocalTokenBucket(rate=2, capacity=2)
+        self.clock.now += 60
+        self.assertEqual([bucket._try_acquire() for _ in range(2)], [0, 0])
+        self.assertGreater(bucket._try_acquire(), 0)
+
+    def test_acquire_sleeps_until_token(self):
+        bucket = LocalTokenBucket(rate=4, capacity=1)
+        bucket._try_acquire()
+
+        def sleep(seconds):
+            self.clock.now += seconds
+        with mock.patch('movies.tmdb_throttle.time.sleep', side_effect=sleep) as sleeper:
+            self.assertTrue(bucket.acquire(timeout=1))
+        sleeper.assert_called_once_with(0.25)
+
+    def test_acquire_gives_up_after_timeout(self):
+        bucket = LocalTokenBucket(rate=1, capacity=1)
+        bucket._try_acquire()
+        with mock.patch('movies.tmdb_throttle.time.sleep') as sleeper:
+            self.assertFalse(bucket.acquire(timeout=0.5))
+            self.assertFalse(asyncio.run(bucket.acquire_async(timeout=0.5)))
+        sleeper.assert_not_called()
+
+
+class AsyncSingleFlightTests(SimpleTestCase):
+
+    def test_cancelled_leader_does_not_cancel_followers(self):
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {'id': 1}
+
+        async def scenario():
+            flight = AsyncSingleFlight()
+            leader = asyncio.ensure_future(flight.do('key', fetch))
+            await asyncio.sleep(0)
+            follower = asyncio.ensure_future(flight.do('key', fetch))
+            await asyncio.sleep(0)
+            leader.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await leader
+            self.assertEqual(await follower, {'id': 1})
+            self.assertEqual(flight._calls, {})
+
+        asyncio.run(scenario())
+        self.assertEqual(len(calls), 1)
+
+    def test_errors_reach_every_caller(self):
+        async def fail():
+            await asyncio.sleep(0)
+            raise ValueError('boom')
+
+        async def scenario():
+            flight = AsyncSingleFlight()
+            return await asyncio.gather(flight.do('key', fail), flight.do('key', fail), return_exceptions=True)
+
+        results = asyncio.run(scenario())
+        self.assertEqual([type(result) for result in results], [ValueError, ValueError])
+        self.assertIs(results[0], results[1])
+
+
+class SharedTokenBucketTests(SimpleTestCase):
+
+    def test_acquire_async_hits_cache_off_the_event_loop(self):
+        bucket = SharedTokenBucket(rate=10, capacity=1, key='tests:ratelimit')
+        try_acquire = bucket._try_acquire
+        loops = []
+
+        def record_loop():
+            try:
+                loops.append(asyncio.get_running_loop())
+            except RuntimeError:
+                loops.append(None)
+            return try_acquire()
+        with mock.patch.object(bucket, '_try_acquire', side_effect=record_loop), \
+                mock.patch.object(LocalTokenBucket, '_try_acquire') as local:
+            self.assertTrue(asyncio.run(bucket.acquire_async(timeout=1)))
+        self.assertEqual(loops, [None])
+        local.assert_not_called()
+        cache.delete('tests:ratelimit')
+
+
+def tmdb_response(status_code, data=None, headers=None):
+    response = mock.Mock(status_code=status_code, headers=headers or {})
+    response.json.return_value = data
+    return response
+
+
+@override_settings(TMDB_MAX_RETRIES=2)
+class FetchRetryTests(SimpleTestCase):
+    """Retry policy and circuit breaker bookkeeping of TMDBApi._fetch / AsyncTMDBApi._fetch"""
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+        self.limiter = LocalTokenBucket(rate=1000, capacity=1000)
+        for name, value in (('get_circuit_breaker', self.breaker), ('get_rate_limiter', self.limiter)):
+            for module in ('movies.tmdb_api', 'movies.tmdb_api_async'):
+                patcher = mock.patch(f'{module}.{name}', return_value=value)
+                patcher.start()
+                self.addCleanup(patcher.stop)
+        patcher = mock.patch('movies.tmdb_api.time.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.api = TMDBApi()
+        self.api.session = mock.Mock()
+
+    def expire_open_breaker(self):
+        """The next _fetch becomes the HALF_OPEN trial request"""
+        self.breaker.record_failure()
+        self.breaker._opened_at -= 30
+
+    def test_retries_then_succeeds(self):
+        self.api.session.get.side_effect = [
+            tmdb_response(503), tmdb_response(429, headers={'Retry-After': '2'}), tmdb_response(200, {'id': 1}),
+        ]
+        self.assertEqual(self.api._fetch('/movie/1', {}), {'id': 1})
+        self.assertEqual(self.api.session.get.call_count, 3)
+        self.assertEqual(self.sleep.call_args_list[1], mock.call(2))
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_exhausted_retries_open_breaker(self):
+        self.api.session.get.return_value = tmdb_response(503)
+        self.assertIsNone(self.api._fetch('/movie/1', {}))
+        self.assertEqual(self.api.session.get.call_count, 3)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_limiter_timeout_releases_trial(self):
+        self.expire_open_breaker()
+        with mock.patch.object(self.limiter, 'acquire', return_value=False):
+            self.assertIsNone(self.api._fetch('/movie/1', {}))
+        self.api.session.get.assert_not_called()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertTrue(self.breaker.allow())
+
+    def test_async_cancellation_releases_trial(self):
+        self.expire_open_breaker()
+
+        async def cancelled(timeout=None):
+            raise asyncio.CancelledError
+        with mock.patch.object(self.limiter, 'acquire_async', side_effect=cancelled), \
+                mock.patch('movies.tmdb_api_async.get_async_client'):
+            with self.assertRaises(asyncio.CancelledError):
+                asyncio.run(AsyncTMDBApi()._fetch('/movie/1', {}))
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertTrue(self.breaker.allow())
+
+
+class SeasonBatchTests(SimpleTestCase):
+    """get_seasons_details batches uncached seasons through append_to_response"""
+
+    def setUp(self):
+        cache.clear()
+        get_response_cache().clear_local()
+        self.addCleanup(get_response_cache().clear_local)
+        self.addCleanup(cache.clear)
+        breaker, limiter = CircuitBreaker(failure_threshold=5, reset_timeout=30), LocalTokenBucket(1000, 1000)
+        for name, value in (('get_circuit_breaker', breaker), ('get_rate_limiter', limiter)):
+            patcher = mock.patch(f'movies.tmdb_api.{name}', return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.api = TMDBApi()
+        self.api.session = mock.Mock()
+        self.api.session.get.side_effect = self.respond
+        self.requested = []
+
+    def respond(self, url, params=None, **kwargs):
+        seasons = params['append_to_response'].split(',')
+        self.requested.append((url, seasons))
+        # TMDB omits seasons that do not exist
+        return tmdb_response(200, {'id': 1, **{key: {'season_number': int(key.split('/')[1])}
+                                               for key in seasons if key != 'season/25'}})
+
+    def test_batches_and_maps_seasons(self):
+        get_response_cache().set('/tv/1/season/3', {}, {'season_number': 3, 'cached': True})
+
+        seasons = self.api.get_seasons_details(1, range(1, 26))
+
+        batches = sorted((seasons for _, seasons in self.requested), key=len, reverse=True)
+        self.assertEqual(batches, [[f'season/{n}' for n in [1, 2] + list(range(4, 22))],
+                                   [f'season/{n}' for n in range(22, 26)]])
+        self.assertTrue(all(url.endswith('/tv/1') for url, _ in self.requested))
+        self.assertEqual(sorted(seasons), [n for n in range(1, 25)])
+        self.assertTrue(all(seasons[n]['season_number'] == n for n in seasons))
+        self.assertTrue(seasons[3]['cached'])
+
+        # Each season from a batch response is cached under its own endpoint
+        self.assertEqual(get_response_cache().get('/tv/1/season/22', {}), {'season_number': 22})
+        self.requested.clear()
+        self.assertEqual(self.api.get_seasons_details(1, [1, 22]), {1: {'season_number': 1}, 22: {'season_number': 22}})
+        self.assertEqual(self.requested, [])
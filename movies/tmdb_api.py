@@ -1,10 +1,76 @@
+import os
+import threading
+import time
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from django.conf import settings
 import logging
 from datetime import datetime
 
+from .tmdb_cache import get_response_cache, cache_key, SingleFlight, FILL_FAILED
+from .tmdb_throttle import (
+    RETRYABLE_STATUS_CODES, get_rate_limiter, get_circuit_breaker, retry_after_seconds, backoff_delay
+)
+
 logger = logging.getLogger(__name__)
 
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+# Concurrent identical requests within a worker share one in-flight call
+_single_flight = SingleFlight()
+
+
+def get_session():
+    """
+    Return the process-wide HTTP session used for TMDB requests.
+
+    The session keeps connections alive between requests and views, so only
+    the first call in a worker pays for the TCP+TLS handshake. It is created
+    lazily and re-created after a fork, so every gunicorn worker gets its own
+    connection pool instead of sharing sockets with the master process.
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is not None and _session_pid == pid:
+        return _session
+
+    with _session_lock:
+        if _session is None or _session_pid != pid:
+            pool_size = getattr(settings, 'TMDB_HTTP_POOL_SIZE', 10)
+            adapter = HTTPAdapter(
+                pool_connections=2,
+                pool_maxsize=pool_size,
+                pool_block=getattr(settings, 'TMDB_HTTP_POOL_BLOCK', False),
+            )
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+            _session_pid = pid
+    return _session
+
+
+def get_timeout():
+    """Return the (connect, read) timeout tuple for TMDB requests"""
+    return (
+        getattr(settings, 'TMDB_HTTP_CONNECT_TIMEOUT', 3.05),
+        getattr(settings, 'TMDB_HTTP_READ_TIMEOUT', 10),
+    )
+
+
+def max_fetch_time():
+    """
+    Return the longest a TMDBApi._fetch call can take: every attempt waits for
+    the rate limiter and times out, with the longest backoff between attempts.
+    """
+    retries = getattr(settings, 'TMDB_MAX_RETRIES', 3)
+    attempt = getattr(settings, 'TMDB_RATE_LIMIT_WAIT', 5) + sum(get_timeout())
+    return (retries + 1) * attempt + retries * getattr(settings, 'TMDB_RETRY_BACKOFF_MAX', 8)
+
+
 class TMDBApi:
     """Utility class for interacting with TMDB API"""
     BASE_URL = "https://api.themoviedb.org/3"
@@ -13,28 +79,133 @@ class TMDBApi:
         self.api_key = settings.TMDB_API_KEY
         if not self.api_key:
             logger.warning("TMDB API key is not set. Please set it in .env file.")
+        self.session = get_session()
+        self.cache = get_response_cache()
     
-    def _make_request(self, endpoint, params=None):
-        """Make a request to TMDB API"""
+    def _make_request(self, endpoint, params=None, refresh=False):
+        """
+        Make a request to TMDB API, serving it from the response cache when possible.
+        
+        With refresh=True the cached copy is bypassed (the fresh response is
+        still stored) and no expired copy is served if TMDB is unavailable.
+        """
         if params is None:
             params = {}
         
+        if not refresh:
+            cached = self.cache.get(endpoint, params)
+            if cached is not None:
+                return cached
+        
+        key = cache_key(endpoint, params)
+        return _single_flight.do(
+            key + ':refresh' if refresh else key,
+            lambda: self._fetch_and_store(endpoint, params, refresh)
+        )
+    
+    def _fetch_and_store(self, endpoint, params, refresh=False):
+        """Fetch a response and store it, coordinating with other processes if enabled"""
+        # Обновление не ждет чужой загрузки: в кэше может лежать как раз тот ответ, который нужно заменить
+        shared = (getattr(settings, 'TMDB_SINGLE_FLIGHT_SHARED', False) and self.cache.ttl_for(endpoint)
+                  and not refresh)
+        lock_token = None
+        if shared:
+            lock_token = self.cache.acquire_fill_lock(endpoint, params, timeout=max_fetch_time())
+            if lock_token is None:
+                # Another process is already fetching this - wait for its result
+                wait_timeout = getattr(settings, 'TMDB_SINGLE_FLIGHT_TIMEOUT', 10)
+                result = self.cache.wait_for_fill(endpoint, params, timeout=wait_timeout)
+                if result is FILL_FAILED:
+                    return self.cache.get_stale(endpoint, params)
+                if result is not None:
+                    return result
+                logger.warning(f"Timed out waiting for shared fetch of {endpoint}, fetching directly")
+        
+        try:
+            if lock_token:
+                # Another process may have stored the response between our cache miss and the lock
+                cached = self.cache.get(endpoint, params)
+                if cached is not None:
+                    return cached
+            result = self._fetch(endpoint, params)
+            if result is not None:
+                self.cache.set(endpoint, params, result)
+                return result
+            if lock_token:
+                self.cache.mark_fill_failed(endpoint, params)
+            if refresh:
+                return None
+            # TMDB is unavailable or throttling us - serve an expired copy if we have one
+            return self.cache.get_stale(endpoint, params)
+        finally:
+            if lock_token:
+                self.cache.release_fill_lock(endpoint, params, lock_token)
+    
+    def _fetch(self, endpoint, params):
+        """
+        Perform the HTTP request to TMDB API.
+        
+        Requests go through the token-bucket rate limiter, 429/5xx responses
+        and connection errors are retried with jittered exponential backoff
+        (honouring Retry-After), and while the circuit breaker is open no
+        request is made at all.
+        """
+        breaker = get_circuit_breaker()
+        if not breaker.allow():
+            logger.warning(f"TMDB circuit breaker is open, skipping request to {endpoint}")
+            return None
+        
         url = f"{self.BASE_URL}{endpoint}"
         headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json;charset=utf-8"
         }
+        limiter = get_rate_limiter()
+        max_retries = getattr(settings, 'TMDB_MAX_RETRIES', 3)
+        wait_limit = getattr(settings, 'TMDB_RATE_LIMIT_WAIT', 5)
         
+        # Every exit must reach the breaker (limiter timeout, cancellation included),
+        # otherwise a HALF_OPEN trial request would never finish
+        reported = False
         try:
-            response = requests.get(url, params=params, headers=headers)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error making request to TMDB API: {str(e)}")
-            if hasattr(e, 'response') and e.response is not None:
-                logger.error(f"Response status code: {e.response.status_code}")
-                logger.error(f"Response text: {e.response.text}")
+            for attempt in range(max_retries + 1):
+                if not limiter.acquire(timeout=wait_limit):
+                    logger.warning(f"TMDB rate limit wait exceeded for {endpoint}")
+                    return None
+                
+                retry_after = None
+                try:
+                    response = self.session.get(url, params=params, headers=headers, timeout=get_timeout())
+                    if response.status_code in RETRYABLE_STATUS_CODES:
+                        retry_after = retry_after_seconds(response)
+                        logger.warning(f"TMDB API returned {response.status_code} for {endpoint} (attempt {attempt + 1})")
+                    else:
+                        response.raise_for_status()
+                        breaker.record_success()
+                        reported = True
+                        return response.json()
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    logger.warning(f"Error connecting to TMDB API: {str(e)} (attempt {attempt + 1})")
+                except requests.exceptions.RequestException as e:
+                    # 4xx other than 429: retrying won't help and TMDB itself is healthy
+                    logger.error(f"Error making request to TMDB API: {str(e)}")
+                    if hasattr(e, 'response') and e.response is not None:
+                        logger.error(f"Response status code: {e.response.status_code}")
+                        logger.error(f"Response text: {e.response.text}")
+                    breaker.record_success()
+                    reported = True
+                    return None
+                
+                if attempt < max_retries:
+                    delay = retry_after if retry_after is not None else backoff_delay(attempt)
+                    time.sleep(min(delay, getattr(settings, 'TMDB_RETRY_BACKOFF_MAX', 8)))
+            
+            breaker.record_failure()
+            reported = True
             return None
+        finally:
+            if not reported:
+                breaker.record_abandoned()
     
     def test_connection(self):
         """Test the connection to TMDB API"""
@@ -63,10 +234,10 @@ class TMDBApi:
         }
         return self._make_request(endpoint, params)
     
-    def get_movie_details(self, movie_id):
-        """Get detailed information about a movie"""
+    def get_movie_details(self, movie_id, refresh=False):
+        """Get detailed information about a movie (refresh=True bypasses the response cache)"""
         endpoint = f"/movie/{movie_id}"
-        return self._make_request(endpoint)
+        return self._make_request(endpoint, refresh=refresh)
     
     def get_popular_movies(self, page=1):
         """Get list of popular movies"""
@@ -96,10 +267,10 @@ class TMDBApi:
         }
         return self._make_request(endpoint, params)
     
-    def get_tv_show_details(self, tv_id):
-        """Get detailed information about a TV show"""
+    def get_tv_show_details(self, tv_id, refresh=False):
+        """Get detailed information about a TV show (refresh=True bypasses the response cache)"""
         endpoint = f"/tv/{tv_id}"
-        return self._make_request(endpoint)
+        return self._make_request(endpoint, refresh=refresh)
     
     def get_popular_tv_shows(self, page=1):
         """Get list of popular TV shows"""
@@ -131,6 +302,60 @@ class TMDBApi:
         endpoint = f"/tv/{tv_id}/season/{season_number}"
         return self._make_request(endpoint)
     
+    # TMDB accepts at most 20 sub-resources in append_to_response
+    APPEND_TO_RESPONSE_LIMIT = 20
+    
+    def get_seasons_details(self, tv_id, season_numbers):
+        """
+        Get details for several seasons of a TV show.
+        
+        Seasons that are not cached are requested in batches of up to 20 via
+        append_to_response on /tv/{tv_id}, and the batches run concurrently
+        on a bounded thread pool. Returns a dict {season_number: season_data}.
+        """
+        seasons = {}
+        missing = []
+        for season_number in season_numbers:
+            cached = self.cache.get(f"/tv/{tv_id}/season/{season_number}", {})
+            if cached is not None:
+                seasons[season_number] = cached
+            else:
+                missing.append(season_number)
+        
+        chunks = [
+            missing[i:i + self.APPEND_TO_RESPONSE_LIMIT]
+            for i in range(0, len(missing), self.APPEND_TO_RESPONSE_LIMIT)
+        ]
+        if not chunks:
+            return seasons
+        
+        if len(chunks) == 1:
+            results = [self._get_seasons_chunk(tv_id, chunks[0])]
+        else:
+            workers = min(len(chunks), getattr(settings, 'TMDB_BATCH_WORKERS', 4))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(lambda chunk: self._get_seasons_chunk(tv_id, chunk), chunks))
+        
+        for chunk_result in results:
+            seasons.update(chunk_result)
+        return seasons
+    
+    def _get_seasons_chunk(self, tv_id, season_numbers):
+        """Fetch up to 20 seasons in one request and seed the per-season cache"""
+        endpoint = f"/tv/{tv_id}"
+        params = {"append_to_response": ",".join(f"season/{n}" for n in season_numbers)}
+        result = self._make_request(endpoint, params)
+        
+        seasons = {}
+        if not result:
+            return seasons
+        for season_number in season_numbers:
+            season_data = result.get(f"season/{season_number}")
+            if season_data:
+                seasons[season_number] = season_data
+                self.cache.set(f"/tv/{tv_id}/season/{season_number}", {}, season_data)
+        return seasons
+    
     def get_episode_details(self, tv_id, season_number, episode_number):
         """Get details for a specific episode of a TV show"""
         endpoint = f"/tv/{tv_id}/season/{season_number}/episode/{episode_number}"
@@ -164,7 +389,7 @@ class TMDBApi:
             except ValueError:
                 pass
                 
-        return {
+        tv_show = {
             'tmdb_id': tv_data['id'],
             'name': tv_data['name'],
             'overview': tv_data.get('overview', ''),
@@ -172,10 +397,13 @@ class TMDBApi:
             'first_air_date': first_air_date,
             'vote_average': tv_data.get('vote_average', 0),
             'vote_count': tv_data.get('vote_count', 0),
-            'number_of_seasons': tv_data.get('number_of_seasons', 0),
-            'number_of_episodes': tv_data.get('number_of_episodes', 0),
-            'status': tv_data.get('status', ''),
         }
+        # Popular/search results don't include these fields, so only set them
+        # when present instead of overwriting stored details with defaults
+        for field in ('number_of_seasons', 'number_of_episodes', 'status'):
+            if field in tv_data:
+                tv_show[field] = tv_data[field]
+        return tv_show
     
     def format_season_data(self, season_data, tv_show_id):
         """Format season data from TMDB API to match our model"""
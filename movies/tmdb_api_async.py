@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import weakref
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .tmdb_api import TMDBApi
+from .tmdb_cache import cache_key, AsyncSingleFlight
+from .tmdb_throttle import (
+    RETRYABLE_STATUS_CODES, get_rate_limiter, get_circuit_breaker, retry_after_seconds, backoff_delay
+)
+
+logger = logging.getLogger(__name__)
+
+# Клиент httpx и объединение запросов привязаны к event loop, поэтому храним их по циклам
+_loop_state = weakref.WeakKeyDictionary()
+
+
+def _get_loop_state():
+    loop = asyncio.get_running_loop()
+    state = _loop_state.get(loop)
+    if state is None:
+        pool_size = getattr(settings, 'TMDB_HTTP_POOL_SIZE', 10)
+        state = {
+            'client': httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+                timeout=httpx.Timeout(
+                    getattr(settings, 'TMDB_HTTP_READ_TIMEOUT', 10),
+                    connect=getattr(settings, 'TMDB_HTTP_CONNECT_TIMEOUT', 3.05),
+                ),
+            ),
+            'single_flight': AsyncSingleFlight(),
+        }
+        _loop_state[loop] = state
+    return state
+
+
+def get_async_client():
+    """Return the pooled httpx.AsyncClient of the running event loop"""
+    return _get_loop_state()['client']
+
+
+class AsyncTMDBApi(TMDBApi):
+    """
+    asyncio-native client for TMDB API.
+
+    Has the same endpoint methods as TMDBApi, but they return coroutines.
+    Requests share the response cache, rate limiter and circuit breaker with
+    the sync client and go through a pooled httpx.AsyncClient per event loop.
+    """
+
+    async def _make_request(self, endpoint, params=None, refresh=False):
+        """Make a request to TMDB API, serving it from the response cache when possible (see TMDBApi._make_request)"""
+        if params is None:
+            params = {}
+
+        if not refresh:
+            cached = await sync_to_async(self.cache.get, thread_sensitive=False)(endpoint, params)
+            if cached is not None:
+                return cached
+
+        key = cache_key(endpoint, params)
+        return await _get_loop_state()['single_flight'].do(
+            key + ':refresh' if refresh else key,
+            lambda: self._fetch_and_store(endpoint, params, refresh)
+        )
+
+    async def _fetch_and_store(self, endpoint, params, refresh=False):
+        result = await self._fetch(endpoint, params)
+        if result is not None:
+            await sync_to_async(self.cache.set, thread_sensitive=False)(endpoint, params, result)
+            return result
+        if refresh:
+            return None
+        # TMDB is unavailable or throttling us - serve an expired copy if we have one
+        return await sync_to_async(self.cache.get_stale, thread_sensitive=False)(endpoint, params)
+
+    async def _fetch(self, endpoint, params):
+        """Perform the HTTP request with the same rate limiting and retry policy as TMDBApi._fetch"""
+        breaker = get_circuit_breaker()
+        if not breaker.allow():
+            logger.warning(f"TMDB circuit breaker is open, skipping request to {endpoint}")
+            return None
+
+        url = f"{self.BASE_URL}{endpoint}"
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json;charset=utf-8"
+        }
+        client = get_async_client()
+        limiter = get_rate_limiter()
+        max_retries = getattr(settings, 'TMDB_MAX_RETRIES', 3)
+        wait_limit = getattr(settings, 'TMDB_RATE_LIMIT_WAIT', 5)
+
+        # Every exit must reach the breaker (limiter timeout, cancellation included),
+        # otherwise a HALF_OPEN trial request would never finish
+        reported = False
+        try:
+            for attempt in range(max_retries + 1):
+                if not await limiter.acquire_async(timeout=wait_limit):
+                    logger.warning(f"TMDB rate limit wait exceeded for {endpoint}")
+                    return None
+
+                retry_after = None
+                try:
+                    response = await client.get(url, params=params, headers=headers)
+                    if response.status_code in RETRYABLE_STATUS_CODES:
+                        retry_after = retry_after_seconds(response)
+                        logger.warning(f"TMDB API returned {response.status_code} for {endpoint} (attempt {attempt + 1})")
+                    else:
+                        response.raise_for_status()
+                        breaker.record_success()
+                        reported = True
+                        return response.json()
+                except httpx.TransportError as e:
+                    logger.warning(f"Error connecting to TMDB API: {str(e)} (attempt {attempt + 1})")
+                except httpx.HTTPStatusError as e:
+                    logger.error(f"Error making request to TMDB API: {str(e)}")
+                    logger.error(f"Response status code: {e.response.status_code}")
+                    logger.error(f"Response text: {e.response.text}")
+                    breaker.record_success()
+                    reported = True
+                    return None
+
+                if attempt < max_retries:
+                    delay = retry_after if retry_after is not None else backoff_delay(attempt)
+                    await asyncio.sleep(min(delay, getattr(settings, 'TMDB_RETRY_BACKOFF_MAX', 8)))
+
+            breaker.record_failure()
+            reported = True
+            return None
+        finally:
+            if not reported:
+                breaker.record_abandoned()
+
+    async def test_connection(self):
+        """Test the connection to TMDB API"""
+        result = await self._make_request("/configuration")
+        if result and 'images' in result:
+            return {
+                'success': True,
+                'message': 'Successfully connected to TMDB API',
+                'data': result
+            }
+        return {
+            'success': False,
+            'message': 'Failed to connect to TMDB API. Check your API key and connection.',
+            'data': result
+        }
+
+    async def get_tv_show_seasons(self, tv_id):
+        """Get seasons for a TV show"""
+        result = await self._make_request(f"/tv/{tv_id}")
+        if result and 'seasons' in result:
+            return result['seasons']
+        return []
+
+    async def get_seasons_details(self, tv_id, season_numbers):
+        """Async version of TMDBApi.get_seasons_details: batches are awaited concurrently"""
+        get_cached = sync_to_async(self.cache.get, thread_sensitive=False)
+        seasons = {}
+        missing = []
+        for season_number in season_numbers:
+            cached = await get_cached(f"/tv/{tv_id}/season/{season_number}", {})
+            if cached is not None:
+                seasons[season_number] = cached
+            else:
+                missing.append(season_number)
+
+        chunks = [
+            missing[i:i + self.APPEND_TO_RESPONSE_LIMIT]
+            for i in range(0, len(missing), self.APPEND_TO_RESPONSE_LIMIT)
+        ]
+        semaphore = asyncio.Semaphore(getattr(settings, 'TMDB_BATCH_WORKERS', 4))
+
+        async def fetch_chunk(chunk):
+            async with semaphore:
+                return await self._get_seasons_chunk(tv_id, chunk)
+
+        for chunk_result in await asyncio.gather(*(fetch_chunk(chunk) for chunk in chunks)):
+            seasons.update(chunk_result)
+        return seasons
+
+    async def _get_seasons_chunk(self, tv_id, season_numbers):
+        params = {"append_to_response": ",".join(f"season/{n}" for n in season_numbers)}
+        result = await self._make_request(f"/tv/{tv_id}", params)
+
+        seasons = {}
+        if not result:
+            return seasons
+        set_cached = sync_to_async(self.cache.set, thread_sensitive=False)
+        for season_number in season_numbers:
+            season_data = result.get(f"season/{season_number}")
+            if season_data:
+                seasons[season_number] = season_data
+                await set_cached(f"/tv/{tv_id}/season/{season_number}", {}, season_data)
+        return seasons
@@ -0,0 +1,349 @@
+"""
+Tiered cache for TMDB API responses.
+
+Lookups go to a small in-process LRU first and then to the shared Django
+cache backend, so every gunicorn worker can reuse responses fetched by the
+others. Each endpoint family has its own TTL: popular lists change a few
+times a day, while season and episode data hardly ever change.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+# TTL (в секундах) для каждого семейства эндпоинтов. 0 - не кэшировать.
+DEFAULT_TTLS = {
+    'popular': 3 * 60 * 60,
+    'search': 15 * 60,
+    'movie': 24 * 60 * 60,
+    'tv': 12 * 60 * 60,
+    'season': 7 * 24 * 60 * 60,
+    'episode': 7 * 24 * 60 * 60,
+    'credits': 3 * 24 * 60 * 60,
+    'similar': 24 * 60 * 60,
+    'configuration': 0,
+    'default': 60 * 60,
+}
+
+# Порядок важен: первое совпадение определяет семейство
+ENDPOINT_FAMILIES = [
+    ('configuration', re.compile(r'^/configuration')),
+    ('search', re.compile(r'^/search/')),
+    ('popular', re.compile(r'^/(movie|tv)/popular$')),
+    ('episode', re.compile(r'^/tv/\d+/season/\d+/episode/\d+$')),
+    ('season', re.compile(r'^/tv/\d+/season/\d+$')),
+    ('credits', re.compile(r'^/(movie|tv)/\d+/credits$')),
+    ('similar', re.compile(r'^/(movie|tv)/\d+/similar$')),
+    ('movie', re.compile(r'^/movie/\d+$')),
+    ('tv', re.compile(r'^/tv/\d+$')),
+]
+
+
+# Результат wait_for_fill(), когда ведущий процесс не получил ответа
+FILL_FAILED = object()
+
+
+def endpoint_family(endpoint):
+    """Return the TTL family name for a TMDB endpoint"""
+    for family, pattern in ENDPOINT_FAMILIES:
+        if pattern.match(endpoint):
+            return family
+    return 'default'
+
+
+def cache_key(endpoint, params=None):
+    """Build a stable cache key from an endpoint and its query parameters"""
+    raw = json.dumps([endpoint, params or {}], sort_keys=True, default=str)
+    return 'tmdb:' + hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+class TMDBResponseCache:
+    """In-process LRU in front of a shared Django cache backend"""
+
+    def __init__(self, max_entries=None, alias=None, ttls=None):
+        self.max_entries = max_entries or getattr(settings, 'TMDB_CACHE_LOCAL_MAX_ENTRIES', 512)
+        self.alias = alias or getattr(settings, 'TMDB_CACHE_ALIAS', 'default')
+        self.ttls = dict(DEFAULT_TTLS)
+        self.ttls.update(ttls or getattr(settings, 'TMDB_CACHE_TTLS', {}))
+        # Сколько хранить просроченный ответ для отдачи, пока TMDB недоступен
+        self.stale_ttl = getattr(settings, 'TMDB_CACHE_STALE_TTL', 24 * 60 * 60)
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'local_hits': 0, 'shared_hits': 0, 'misses': 0, 'stores': 0, 'stale_hits': 0, 'errors': 0}
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    def ttl_for(self, endpoint):
+        return self.ttls.get(endpoint_family(endpoint), self.ttls['default'])
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is None:
+                return None
+            if entry['expires_at'] <= time.time():
+                # Просроченная запись остается до вытеснения - она нужна get_stale()
+                return None
+            self._local.move_to_end(key)
+            return entry
+
+    def _set_local(self, key, entry):
+        with self._lock:
+            self._local[key] = entry
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_entries:
+                self._local.popitem(last=False)
+
+    def get(self, endpoint, params=None):
+        """Return the cached response for endpoint+params, or None"""
+        if not self.ttl_for(endpoint):
+            return None
+        key = cache_key(endpoint, params)
+
+        entry = self._get_local(key)
+        if entry is not None:
+            self._count('local_hits')
+            return entry['data']
+
+        try:
+            entry = self.shared.get(key)
+        except Exception as e:
+            logger.warning(f"TMDB cache backend error on get: {e}")
+            self._count('errors')
+            entry = None
+
+        if entry is not None and entry['expires_at'] > time.time():
+            self._set_local(key, entry)
+            self._count('shared_hits')
+            return entry['data']
+
+        self._count('misses')
+        return None
+
+    def get_stale(self, endpoint, params=None):
+        """Return a cached response even if its TTL has expired, or None"""
+        if not self.ttl_for(endpoint):
+            return None
+        key = cache_key(endpoint, params)
+        with self._lock:
+            entry = self._local.get(key)
+        if entry is not None and entry['expires_at'] + self.stale_ttl <= time.time():
+            entry = None
+        if entry is None:
+            try:
+                entry = self.shared.get(key)
+            except Exception as e:
+                logger.warning(f"TMDB cache backend error on get: {e}")
+                entry = None
+        if entry is None:
+            return None
+        self._count('stale_hits')
+        return entry['data']
+
+    def _peek_shared(self, key):
+        try:
+            entry = self.shared.get(key)
+        except Exception:
+            return None
+        if entry is not None and entry['expires_at'] > time.time():
+            self._set_local(key, entry)
+            return entry['data']
+        return None
+
+    def acquire_fill_lock(self, endpoint, params, timeout):
+        """
+        Try to become the only process fetching endpoint+params.
+
+        Returns an owner token if this process should fetch, otherwise None.
+        timeout must cover the slowest possible fetch (see tmdb_api.max_fetch_time),
+        or the lock expires mid-fetch and another process starts the same one.
+        Backend errors fail open, so a broken cache never blocks TMDB requests.
+        """
+        key = cache_key(endpoint, params)
+        token = uuid.uuid4().hex
+        try:
+            if not self.shared.add(key + ':lock', token, timeout=timeout):
+                return None
+            # Отметка о неудаче предыдущего ведущего больше не актуальна
+            self.shared.delete(key + ':miss')
+        except Exception as e:
+            logger.warning(f"TMDB cache backend error on lock: {e}")
+        return token
+
+    def release_fill_lock(self, endpoint, params, token):
+        """Release the lock taken by acquire_fill_lock() unless it has expired and been taken by another process"""
+        key = cache_key(endpoint, params) + ':lock'
+        try:
+            # Django cache API has no compare-and-delete; the window between get and delete is tiny
+            # compared with the lock lifetime, which already covers the whole fetch
+            if self.shared.get(key) == token:
+                self.shared.delete(key)
+        except Exception as e:
+            logger.warning(f"TMDB cache backend error on unlock: {e}")
+
+    def mark_fill_failed(self, endpoint, params):
+        """Tell processes waiting in wait_for_fill() that the fetch produced no response"""
+        try:
+            self.shared.set(cache_key(endpoint, params) + ':miss', 1,
+                            timeout=getattr(settings, 'TMDB_SINGLE_FLIGHT_MISS_TTL', 5))
+        except Exception as e:
+            logger.warning(f"TMDB cache backend error on set: {e}")
+
+    def wait_for_fill(self, endpoint, params, timeout, interval=0.05):
+        """
+        Poll the shared backend until another process stores the response.
+
+        Returns the response, FILL_FAILED if that process got no response,
+        or None on timeout.
+        """
+        key = cache_key(endpoint, params)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            data = self._peek_shared(key)
+            if data is not None:
+                self._count('shared_hits')
+                return data
+            try:
+                if self.shared.get(key + ':miss') is not None:
+                    return FILL_FAILED
+            except Exception:
+                pass
+            time.sleep(interval)
+        return None
+
+    def set(self, endpoint, params, data):
+        """Store a response in both tiers using the endpoint family TTL"""
+        ttl = self.ttl_for(endpoint)
+        if not ttl or data is None:
+            return
+        key = cache_key(endpoint, params)
+        entry = {'data': data, 'expires_at': time.time() + ttl}
+        self._set_local(key, entry)
+        try:
+            self.shared.set(key, entry, timeout=ttl + self.stale_ttl)
+        except Exception as e:
+            logger.warning(f"TMDB cache backend error on set: {e}")
+            self._count('errors')
+        self._count('stores')
+
+    def clear_local(self):
+        with self._lock:
+            self._local.clear()
+
+    def stats(self):
+        """Return hit/miss counters for this worker process"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['local_entries'] = len(self._local)
+        lookups = stats['local_hits'] + stats['shared_hits'] + stats['misses']
+        stats['hit_ratio'] = round((stats['local_hits'] + stats['shared_hits']) / lookups, 4) if lookups else 0.0
+        return stats
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Collapse concurrent identical calls into one.
+
+    The first caller for a key runs the function, every caller that arrives
+    while it is in flight waits for it and gets the same result.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+        return call.result
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+
+class AsyncSingleFlight:
+    """
+    asyncio counterpart of SingleFlight.
+
+    Must be used from a single event loop: concurrent coroutines awaiting
+    the same key share one in-flight call. The call runs as its own task and
+    every caller awaits it through asyncio.shield, so a cancelled caller
+    (e.g. a disconnected client) does not cancel the call for the others.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, func):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        return await asyncio.shield(task)
+
+    def _finish(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # Все ожидающие могли быть отменены - не ругаемся на непрочитанное исключение
+            task.exception()
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """Return the process-wide TMDB response cache"""
+    global _response_cache
+    if _response_cache is None:
+        with _response_cache_lock:
+            if _response_cache is None:
+                _response_cache = TMDBResponseCache()
+    return _response_cache
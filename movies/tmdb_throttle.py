@@ -0,0 +1,230 @@
+"""
+Rate limiting, retry backoff and circuit breaking for TMDB API requests.
+
+TMDB answers bursts above its per-IP limit with 429. A token bucket keeps
+our request rate at the allowed maximum (optionally shared by all workers
+through the Django cache), retries back off with jitter and honour
+Retry-After, and a circuit breaker stops calling TMDB for a while after
+repeated failures so views can fall back to cached data immediately.
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class LocalTokenBucket:
+    """Token bucket shared by the threads of one process"""
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _try_acquire(self):
+        """Take a token; return 0 on success or the seconds to wait for the next one"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self, timeout=None):
+        """Block until a token is available; return False if it takes longer than timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self._try_acquire()
+            if not wait:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    async def acquire_async(self, timeout=None):
+        """Like acquire(), but waits with asyncio.sleep instead of blocking the thread"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = await self._try_acquire_async()
+            if not wait:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+
+    async def _try_acquire_async(self):
+        # Only a thread lock is held, safe to call on the event loop
+        return self._try_acquire()
+
+
+class SharedTokenBucket(LocalTokenBucket):
+    """
+    Token bucket stored in the Django cache, shared by all workers.
+
+    Uses the GCRA formulation of a token bucket, so the whole state is one
+    timestamp (the theoretical arrival time of the next request). Updates
+    are serialised with a short cache.add() lock. If the backend fails the
+    bucket degrades to the local, per-process one.
+    """
+
+    def __init__(self, rate, capacity, alias='default', key='tmdb:ratelimit'):
+        super().__init__(rate, capacity)
+        self.alias = alias
+        self.key = key
+        self.interval = 1.0 / self.rate
+
+    def _try_acquire(self):
+        cache = caches[self.alias]
+        lock_key = self.key + ':lock'
+        try:
+            if not cache.add(lock_key, 1, timeout=1):
+                return 0.005
+            try:
+                now = time.time()
+                tat = cache.get(self.key) or now
+                new_tat = max(tat, now) + self.interval
+                wait = new_tat - now - self.capacity * self.interval
+                if wait > 0:
+                    return wait
+                cache.set(self.key, new_tat, timeout=int(self.capacity * self.interval) + 60)
+                return 0
+            finally:
+                cache.delete(lock_key)
+        except Exception as e:
+            logger.warning(f"Shared rate limiter unavailable, using local bucket: {e}")
+            return super()._try_acquire()
+
+    async def _try_acquire_async(self):
+        # Cache backends such as DatabaseCache must not be called from the event loop
+        return await sync_to_async(self._try_acquire, thread_sensitive=False)()
+
+
+class CircuitBreaker:
+    """
+    Per-process circuit breaker.
+
+    After failure_threshold consecutive failures the circuit opens and
+    requests are rejected for reset_timeout seconds. Then a single trial
+    request is let through: success closes the circuit, failure opens it again.
+    A trial that never reaches TMDB (record_abandoned) or never reports back
+    within reset_timeout does not block the next one.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._probe_started = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if self.state == self.OPEN and now - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._probe_started = now
+                return True
+            if self.state == self.HALF_OPEN and now - self._probe_started >= self.reset_timeout:
+                # The trial request never reported back; let another one through
+                self._probe_started = now
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self.state = self.CLOSED
+
+    def record_abandoned(self):
+        """The request ended without reaching TMDB (rate limit wait, cancellation)"""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                # Keep _opened_at so the next allow() starts a new trial right away
+                self.state = self.OPEN
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning(f"TMDB circuit breaker opened after {self._failures} failures")
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+def retry_after_seconds(response):
+    """Parse the Retry-After header (seconds or HTTP date) of a response"""
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, base=None, cap=None):
+    """Exponential backoff with full jitter for the given retry attempt (0-based)"""
+    base = base if base is not None else getattr(settings, 'TMDB_RETRY_BACKOFF_BASE', 0.5)
+    cap = cap if cap is not None else getattr(settings, 'TMDB_RETRY_BACKOFF_MAX', 8)
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+_rate_limiter = None
+_circuit_breaker = None
+_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """Return the rate limiter configured by TMDB_RATE_LIMIT_BACKEND ('local' or 'cache')"""
+    global _rate_limiter
+    if _rate_limiter is None:
+        with _lock:
+            if _rate_limiter is None:
+                rate = getattr(settings, 'TMDB_RATE_LIMIT', 40)
+                burst = getattr(settings, 'TMDB_RATE_LIMIT_BURST', 40)
+                if getattr(settings, 'TMDB_RATE_LIMIT_BACKEND', 'local') == 'cache':
+                    _rate_limiter = SharedTokenBucket(
+                        rate, burst, alias=getattr(settings, 'TMDB_CACHE_ALIAS', 'default')
+                    )
+                else:
+                    _rate_limiter = LocalTokenBucket(rate, burst)
+    return _rate_limiter
+
+
+def get_circuit_breaker():
+    """Return the TMDB circuit breaker of the current process"""
+    global _circuit_breaker
+    if _circuit_breaker is None:
+        with _lock:
+            if _circuit_breaker is None:
+                _circuit_breaker = CircuitBreaker(
+                    getattr(settings, 'TMDB_CIRCUIT_FAILURE_THRESHOLD', 5),
+                    getattr(settings, 'TMDB_CIRCUIT_RESET_TIMEOUT', 30),
+                )
+    return _circuit_breaker
@@ -1,10 +1,14 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import views, async_views
+
+# Под ASGI-сервером самые посещаемые страницы обслуживаются асинхронными версиями
+pages = async_views if settings.ASYNC_VIEWS else views
 
 urlpatterns = [
-    path('', views.home, name='home'),
+    path('', pages.home, name='home'),
     path('movies/', views.movies_home, name='movies_home'),
-    path('movie/<int:tmdb_id>/', views.movie_detail, name='movie_detail'),
+    path('movie/<int:tmdb_id>/', pages.movie_detail, name='movie_detail'),
     path('movie/<int:tmdb_id>/favorite/', views.toggle_favorite, name='toggle_favorite'),
     path('movie/<int:tmdb_id>/review/', views.add_review, name='add_review'),
     path('movie/<int:tmdb_id>/watch-status/', views.set_movie_watch_status, name='set_movie_watch_status'),
@@ -13,10 +17,10 @@ urlpatterns = [
     path('register/', views.register, name='register'),
     
     path('tvshows/', views.tvshows_home, name='tvshows_home'),
-    path('tvshow/<int:tmdb_id>/', views.tvshow_detail, name='tvshow_detail'),
+    path('tvshow/<int:tmdb_id>/', pages.tvshow_detail, name='tvshow_detail'),
     path('tvshow/<int:tmdb_id>/favorite/', views.toggle_tvshow_favorite, name='toggle_tvshow_favorite'),
     path('tvshow/<int:tmdb_id>/watch-status/', views.set_tvshow_watch_status, name='set_tvshow_watch_status'),
-    path('tvshow/<int:tmdb_id>/season/<int:season_number>/', views.season_detail, name='season_detail'),
+    path('tvshow/<int:tmdb_id>/season/<int:season_number>/', pages.season_detail, name='season_detail'),
     path('tvshow/<int:tmdb_id>/season/<int:season_number>/episode/<int:episode_number>/', views.episode_detail, name='episode_detail'),
     
     path('my-list/', views.my_watch_list, name='my_watch_list'),
@@ -27,4 +31,7 @@ urlpatterns = [
     path('friends/accept-invitation/<str:token>/', views.accept_friend_invitation, name='accept_friend_invitation'),
     path('friends/view/<int:friend_id>/', views.friend_watch_list, name='friend_watch_list'),
     path('friends/favorites/<int:friend_id>/', views.friend_favorites, name='friend_favorites'),
+    
+    # Кэш постеров через X-Accel-Redirect (POSTER_X_ACCEL_REDIRECT)
+    path('posters/<str:size>/<path:poster_path>', views.poster_file, name='poster_file'),
 ] 
\ No newline at end of file
@@ -3,17 +3,26 @@ from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.contrib.auth import login, authenticate
 from django.core.paginator import Paginator
-from django.db.models import Avg
-from django.http import JsonResponse, HttpResponseBadRequest
+from django.db.models import Count, Exists, OuterRef
+from django.http import JsonResponse, HttpResponseBadRequest, HttpResponse, FileResponse, Http404
 from django.views.decorators.http import require_POST
 from django import forms
 from django.urls import reverse
+from django.conf import settings
+from django.utils import timezone
+from django.core.files.storage import default_storage
+import mimetypes
 
 from .models import Movie, Review, TVShow, Season, Episode, TVShowReview, SeasonReview, EpisodeReview
 from .models import MovieWatchStatus, TVShowWatchStatus, WatchStatus
 from .forms import MovieSearchForm, ReviewForm, UserRegistrationForm, TVShowReviewForm, SeasonReviewForm, EpisodeReviewForm
 from .tmdb_api import TMDBApi
-from .image_cache import get_or_cache_poster  # Импортируем функцию кэширования
+from .ingest import upsert_movies, upsert_tv_shows, resolve_existing
+from .freshness import schedule_movie_refresh, schedule_tv_show_refresh, has_tv_show_details
+from .image_cache import resolve_posters  # Импортируем функции кэширования
+from .image_cache import IMAGE_SIZES, fetch_poster, is_known_image, poster_local_path, poster_presence, poster_failures
+from .image_cache import tmdb_image_url
+from .pagination import favorites_page
 from .models import Friendship, FriendInvitation
 from .forms import EmailAuthenticationForm
 
@@ -29,19 +38,7 @@ def process_movie_posters(movies_list):
     Returns:
         Список фильмов с обновленными путями к постерам
     """
-    for movie in movies_list:
-        if hasattr(movie, 'poster_path') and movie.poster_path:
-            # Получаем кэшированный URL для постера
-            cached_url = get_or_cache_poster(movie.poster_path)
-            if cached_url:
-                # Если у объекта есть метод __dict__, это, вероятно, модель Django
-                if hasattr(movie, '__dict__'):
-                    movie.cached_poster_url = cached_url
-                else:
-                    # Иначе, это вероятно словарь из API
-                    movie['cached_poster_url'] = cached_url
-    
-    return movies_list
+    return resolve_posters(movies_list)
 
 
 def home(request):
@@ -61,30 +58,20 @@ def home(request):
         # Search for movies
         movie_search_results = tmdb_api.search_movies(query)
         if movie_search_results and 'results' in movie_search_results:
-            # Convert TMDB data to our internal format for display
-            for movie_data in movie_search_results['results']:
-                movie_dict = tmdb_api.format_movie_data(movie_data)
-                # Check if this movie exists in our database
-                try:
-                    movie = Movie.objects.get(tmdb_id=movie_dict['tmdb_id'])
-                except Movie.DoesNotExist:
-                    # Create a transient object, but don't save to DB yet
-                    movie = Movie(**movie_dict)
-                movie_results.append(movie)
+            # Use stored movies where we have them (one query for all hits),
+            # transient objects that are not saved to DB for the rest
+            movie_results = resolve_existing(Movie, [
+                tmdb_api.format_movie_data(movie_data)
+                for movie_data in movie_search_results['results']
+            ])
         
         # Search for TV shows
         tvshow_search_results = tmdb_api.search_tv_shows(query)
         if tvshow_search_results and 'results' in tvshow_search_results:
-            # Convert TMDB data to our internal format for display
-            for tvshow_data in tvshow_search_results['results']:
-                tvshow_dict = tmdb_api.format_tv_show_data(tvshow_data)
-                # Check if this TV show exists in our database
-                try:
-                    tvshow = TVShow.objects.get(tmdb_id=tvshow_dict['tmdb_id'])
-                except TVShow.DoesNotExist:
-                    # Create a transient object, but don't save to DB yet
-                    tvshow = TVShow(**tvshow_dict)
-                tvshow_results.append(tvshow)
+            tvshow_results = resolve_existing(TVShow, [
+                tmdb_api.format_tv_show_data(tvshow_data)
+                for tvshow_data in tvshow_search_results['results']
+            ])
                 
         # Добавляем кэшированные URL постеров
         movie_results = process_movie_posters(movie_results)
@@ -97,15 +84,11 @@ def home(request):
         
         movies = []
         if popular_movies_data and 'results' in popular_movies_data:
-            # Convert TMDB data to our internal format
-            for movie_data in popular_movies_data['results'][:8]:  # Display top 8 movies
-                # Save or update the movie in our database
-                movie_dict = tmdb_api.format_movie_data(movie_data)
-                movie, created = Movie.objects.update_or_create(
-                    tmdb_id=movie_dict['tmdb_id'],
-                    defaults=movie_dict
-                )
-                movies.append(movie)
+            # Save or update the top 8 movies in our database in one bulk upsert
+            movies = upsert_movies([
+                tmdb_api.format_movie_data(movie_data)
+                for movie_data in popular_movies_data['results'][:8]
+            ])
         
         # Добавляем кэшированные URL постеров к популярным фильмам
         movies = process_movie_posters(movies)
@@ -115,31 +98,23 @@ def home(request):
         
         tvshows = []
         if popular_tvshows_data and 'results' in popular_tvshows_data:
-            # Convert TMDB data to our internal format
-            for tvshow_data in popular_tvshows_data['results'][:8]:  # Display top 8 TV shows
-                # Save or update the TV show in our database
-                tvshow_dict = tmdb_api.format_tv_show_data(tvshow_data)
-                tvshow, created = TVShow.objects.update_or_create(
-                    tmdb_id=tvshow_dict['tmdb_id'],
-                    defaults=tvshow_dict
-                )
-                tvshows.append(tvshow)
+            # Save or update the top 8 TV shows in our database in one bulk upsert
+            tvshows = upsert_tv_shows([
+                tmdb_api.format_tv_show_data(tvshow_data)
+                for tvshow_data in popular_tvshows_data['results'][:8]
+            ])
         
         # Добавляем кэшированные URL постеров к популярным сериалам
         tvshows = process_tvshow_posters(tvshows)
         
         # Also get some movies from our database that have reviews
-        local_movies = Movie.objects.annotate(avg_rating=Avg('reviews__rating')).filter(
-            reviews__isnull=False
-        ).distinct().order_by('-avg_rating')[:4]
+        local_movies = Movie.objects.filter(review_count__gt=0).order_by('-avg_rating', '-review_count')[:4]
         
         # Добавляем кэшированные URL постеров к фильмам с отзывами
         local_movies = process_movie_posters(local_movies)
         
         # Get some TV shows from our database that have reviews
-        local_tvshows = TVShow.objects.annotate(avg_rating=Avg('reviews__rating')).filter(
-            reviews__isnull=False
-        ).distinct().order_by('-avg_rating')[:4]
+        local_tvshows = TVShow.objects.filter(review_count__gt=0).order_by('-avg_rating', '-review_count')[:4]
         
         # Добавляем кэшированные URL постеров к сериалам с отзывами
         local_tvshows = process_tvshow_posters(local_tvshows)
@@ -170,14 +145,8 @@ def movie_detail(request, tmdb_id):
     # Try to get movie from our database
     try:
         movie = Movie.objects.get(tmdb_id=tmdb_id)
-        # Refresh from TMDB
-        tmdb_api = TMDBApi()
-        movie_data = tmdb_api.get_movie_details(tmdb_id)
-        if movie_data:
-            movie_dict = tmdb_api.format_movie_data(movie_data)
-            for key, value in movie_dict.items():
-                setattr(movie, key, value)
-            movie.save()
+        # Serve the stored row and refresh it from TMDB in the background if stale
+        schedule_movie_refresh(movie)
     except Movie.DoesNotExist:
         # Get from TMDB and save to our database
         tmdb_api = TMDBApi()
@@ -187,11 +156,10 @@ def movie_detail(request, tmdb_id):
             return redirect('home')
         
         movie_dict = tmdb_api.format_movie_data(movie_data)
-        movie = Movie.objects.create(**movie_dict)
+        movie = Movie.objects.create(**movie_dict, details_updated_at=timezone.now())
     
     # Кэшируем постер фильма
-    if movie.poster_path:
-        movie.cached_poster_url = get_or_cache_poster(movie.poster_path)
+    resolve_posters([movie])
     
     # Get movie reviews
     reviews = movie.reviews.select_related('user').all()
@@ -317,29 +285,20 @@ def user_favorites(request):
     # Определяем активную вкладку (по умолчанию - фильмы)
     active_tab = request.GET.get('tab', 'movies')
     
-    # Получаем избранные фильмы
-    favorite_movies = request.user.favorite_movies.all()
-    # Добавляем кэшированные URL постеров к фильмам
-    favorite_movies = process_movie_posters(favorite_movies)
-    
-    # Получаем избранные сериалы
-    favorite_tvshows = request.user.favorite_tvshows.all()
-    # Добавляем кэшированные URL постеров к сериалам
-    favorite_tvshows = process_tvshow_posters(favorite_tvshows)
+    # Страница избранных фильмов (по курсору, а не по номеру страницы)
+    favorite_movies = favorites_page(request.user, Movie, request.GET.get('after_movies'),
+                                     request.GET.get('before_movies'))
+    # Постеры - только для видимой страницы
+    process_movie_posters(favorite_movies.object_list)
     
-    # Настраиваем пагинацию для фильмов
-    movies_paginator = Paginator(favorite_movies, 12)
-    movies_page = request.GET.get('page_movies', 1)
-    favorite_movies_page = movies_paginator.get_page(movies_page)
-    
-    # Настраиваем пагинацию для сериалов
-    tvshows_paginator = Paginator(favorite_tvshows, 12)
-    tvshows_page = request.GET.get('page_tvshows', 1)
-    favorite_tvshows_page = tvshows_paginator.get_page(tvshows_page)
+    # Страница избранных сериалов
+    favorite_tvshows = favorites_page(request.user, TVShow, request.GET.get('after_tvshows'),
+                                      request.GET.get('before_tvshows'))
+    process_tvshow_posters(favorite_tvshows.object_list)
     
     context = {
-        'favorite_movies': favorite_movies_page,
-        'favorite_tvshows': favorite_tvshows_page,
+        'favorite_movies': favorite_movies,
+        'favorite_tvshows': favorite_tvshows,
         'active_tab': active_tab
     }
     return render(request, 'movies/user_favorites.html', context)
@@ -353,23 +312,17 @@ def tvshows_home(request):
     
     tvshows = []
     if popular_tvshows_data and 'results' in popular_tvshows_data:
-        # Convert TMDB data to our internal format for display
-        for tvshow_data in popular_tvshows_data['results'][:12]:  # Display top 12 TV shows
-            # Save or update the TV show in our database
-            tvshow_dict = tmdb_api.format_tv_show_data(tvshow_data)
-            tvshow, created = TVShow.objects.update_or_create(
-                tmdb_id=tvshow_dict['tmdb_id'],
-                defaults=tvshow_dict
-            )
-            tvshows.append(tvshow)
+        # Save or update the top 12 TV shows in our database in one bulk upsert
+        tvshows = upsert_tv_shows([
+            tmdb_api.format_tv_show_data(tvshow_data)
+            for tvshow_data in popular_tvshows_data['results'][:12]
+        ])
     
     # Добавляем кэшированные URL постеров к популярным сериалам
     tvshows = process_tvshow_posters(tvshows)
     
     # Also get some TV shows from our database that have reviews
-    local_tvshows = TVShow.objects.annotate(avg_rating=Avg('reviews__rating')).filter(
-        reviews__isnull=False
-    ).distinct().order_by('-avg_rating')[:6]
+    local_tvshows = TVShow.objects.filter(review_count__gt=0).order_by('-avg_rating', '-review_count')[:6]
     
     # Добавляем кэшированные URL постеров к сериалам с отзывами
     local_tvshows = process_tvshow_posters(local_tvshows)
@@ -389,13 +342,19 @@ def tvshow_detail(request, tmdb_id):
     # Try to get TV show from our database
     try:
         tvshow = TVShow.objects.get(tmdb_id=tmdb_id)
-        # Refresh from TMDB
-        tvshow_data = tmdb_api.get_tv_show_details(tmdb_id)
-        if tvshow_data:
-            tvshow_dict = tmdb_api.format_tv_show_data(tvshow_data)
-            for key, value in tvshow_dict.items():
-                setattr(tvshow, key, value)
-            tvshow.save()
+        if has_tv_show_details(tvshow):
+            # Serve the stored row and refresh it from TMDB in the background if stale
+            schedule_tv_show_refresh(tvshow)
+        else:
+            # Only seen in popular/search lists so far - details are required to render
+            tvshow_data = tmdb_api.get_tv_show_details(tmdb_id)
+            if tvshow_data:
+                tvshow_dict = tmdb_api.format_tv_show_data(tvshow_data)
+                for key, value in tvshow_dict.items():
+                    setattr(tvshow, key, value)
+                tvshow.details_updated_at = timezone.now()
+                # Только поля из TMDB - агрегаты отзывов обновляются отдельно (см. ratings.py)
+                tvshow.save(update_fields=[*tvshow_dict, 'details_updated_at', 'updated_at'])
     except TVShow.DoesNotExist:
         # Get from TMDB and save to our database
         tvshow_data = tmdb_api.get_tv_show_details(tmdb_id)
@@ -404,17 +363,17 @@ def tvshow_detail(request, tmdb_id):
             return redirect('tvshows_home')
         
         tvshow_dict = tmdb_api.format_tv_show_data(tvshow_data)
-        tvshow = TVShow.objects.create(**tvshow_dict)
+        tvshow = TVShow.objects.create(**tvshow_dict, details_updated_at=timezone.now())
     
     # Кэшируем постер сериала
-    if tvshow.poster_path:
-        tvshow.cached_poster_url = get_or_cache_poster(tvshow.poster_path)
+    resolve_posters([tvshow])
     
     # Get seasons using a more reliable approach
     seasons = []
+    # Fetch all seasons in batched, concurrent requests instead of one call per season
+    seasons_data = tmdb_api.get_seasons_details(tmdb_id, range(1, tvshow.number_of_seasons + 1))
     for season_number in range(1, tvshow.number_of_seasons + 1):
-        # Get season data from TMDB first
-        season_data = tmdb_api.get_season_details(tmdb_id, season_number)
+        season_data = seasons_data.get(season_number)
         if season_data:
             # Format the data
             season_dict = tmdb_api.format_season_data(season_data, tvshow.id)
@@ -437,12 +396,11 @@ def tvshow_detail(request, tmdb_id):
                     defaults=defaults
                 )
             
-            # Кэшируем постер сезона
-            if season.poster_path:
-                season.cached_poster_url = get_or_cache_poster(season.poster_path)
-                
             seasons.append(season)
     
+    # Кэшируем постеры сезонов одним проходом по индексу
+    resolve_posters(seasons)
+    
     # Get TV show reviews
     reviews = tvshow.reviews.select_related('user').all()
     
@@ -506,7 +464,7 @@ def season_detail(request, tmdb_id, season_number):
             return redirect('tvshows_home')
         
         tvshow_dict = tmdb_api.format_tv_show_data(tvshow_data)
-        tvshow = TVShow.objects.create(**tvshow_dict)
+        tvshow = TVShow.objects.create(**tvshow_dict, details_updated_at=timezone.now())
     
     # Get season data from TMDB first, then get or create the season
     season_data = tmdb_api.get_season_details(tmdb_id, season_number)
@@ -536,8 +494,7 @@ def season_detail(request, tmdb_id, season_number):
         )
     
     # Кэшируем постер сезона
-    if season.poster_path:
-        season.cached_poster_url = get_or_cache_poster(season.poster_path)
+    resolve_posters([season])
     
     # Get episodes
     episodes = []
@@ -559,12 +516,11 @@ def season_detail(request, tmdb_id, season_number):
                 defaults=defaults
             )
             
-            # Кэшируем изображение эпизода
-            if episode.still_path:
-                episode.cached_still_url = get_or_cache_poster(episode.still_path)
-                
             episodes.append(episode)
     
+    # Кэшируем изображения эпизодов одним проходом по индексу
+    resolve_posters(episodes, 'still_path', 'cached_still_url')
+    
     # Get season reviews
     reviews = season.reviews.select_related('user').all()
     
@@ -616,7 +572,7 @@ def episode_detail(request, tmdb_id, season_number, episode_number):
             return redirect('tvshows_home')
         
         tvshow_dict = tmdb_api.format_tv_show_data(tvshow_data)
-        tvshow = TVShow.objects.create(**tvshow_dict)
+        tvshow = TVShow.objects.create(**tvshow_dict, details_updated_at=timezone.now())
     
     # Get or create season
     season_data = tmdb_api.get_season_details(tmdb_id, season_number)
@@ -662,8 +618,7 @@ def episode_detail(request, tmdb_id, season_number, episode_number):
     )
     
     # Кэшируем изображение эпизода
-    if episode.still_path:
-        episode.cached_still_url = get_or_cache_poster(episode.still_path)
+    resolve_posters([episode], 'still_path', 'cached_still_url')
     
     # Get episode reviews
     reviews = episode.reviews.select_related('user').all()
@@ -735,19 +690,7 @@ def process_tvshow_posters(tvshows_list):
     Returns:
         Список сериалов с обновленными путями к постерам
     """
-    for tvshow in tvshows_list:
-        if hasattr(tvshow, 'poster_path') and tvshow.poster_path:
-            # Получаем кэшированный URL для постера
-            cached_url = get_or_cache_poster(tvshow.poster_path)
-            if cached_url:
-                # Если у объекта есть метод __dict__, это, вероятно, модель Django
-                if hasattr(tvshow, '__dict__'):
-                    tvshow.cached_poster_url = cached_url
-                else:
-                    # Иначе, это вероятно словарь из API
-                    tvshow['cached_poster_url'] = cached_url
-    
-    return tvshows_list
+    return resolve_posters(tvshows_list)
 
 
 @require_POST
@@ -781,7 +724,7 @@ def add_tvshow_to_favorites(request):
             return JsonResponse({'status': 'error', 'message': 'TV show not found'})
         
         tvshow_dict = tmdb_api.format_tv_show_data(tvshow_data)
-        tvshow = TVShow.objects.create(**tvshow_dict)
+        tvshow = TVShow.objects.create(**tvshow_dict, details_updated_at=timezone.now())
     
     # Check if already a favorite
     already_favorite = tvshow.favorited_by.filter(id=request.user.id).exists()
@@ -917,10 +860,10 @@ def my_watch_list(request):
     active_status = request.GET.get('status', 'want_to_watch')
     
     # Movies by status
-    movie_statuses = MovieWatchStatus.objects.filter(user=request.user)
+    movie_statuses = MovieWatchStatus.objects.filter(user=request.user).select_related('movie')
     
-    # Get all favorite movie IDs for the user
-    favorite_movie_ids = request.user.favorite_movies.values_list('id', flat=True)
+    # Get all favorite movie IDs for the user (a set: one query, O(1) membership checks)
+    favorite_movie_ids = set(request.user.favorite_movies.values_list('id', flat=True))
     
     # Create dictionaries to store movies by status
     movies_by_status = {
@@ -936,20 +879,17 @@ def my_watch_list(request):
         movies_by_status[movie_status.status].append({
             'movie': movie_status.movie,
             'is_rewatching': movie_status.is_rewatching,
-            'is_favorite': movie_status.movie.id in favorite_movie_ids
+            'is_favorite': movie_status.movie_id in favorite_movie_ids
         })
     
     # Process posters for all movies
-    for status, movies in movies_by_status.items():
-        for item in movies:
-            if item['movie'].poster_path:
-                item['movie'].cached_poster_url = get_or_cache_poster(item['movie'].poster_path)
+    resolve_posters([item['movie'] for movies in movies_by_status.values() for item in movies])
     
     # TV Shows by status
-    tvshow_statuses = TVShowWatchStatus.objects.filter(user=request.user)
+    tvshow_statuses = TVShowWatchStatus.objects.filter(user=request.user).select_related('tvshow')
     
     # Get all favorite TV show IDs for the user
-    favorite_tvshow_ids = request.user.favorite_tvshows.values_list('id', flat=True)
+    favorite_tvshow_ids = set(request.user.favorite_tvshows.values_list('id', flat=True))
     
     # Create dictionaries to store TV shows by status
     tvshows_by_status = {
@@ -965,14 +905,11 @@ def my_watch_list(request):
         tvshows_by_status[tvshow_status.status].append({
             'tvshow': tvshow_status.tvshow,
             'is_rewatching': tvshow_status.is_rewatching,
-            'is_favorite': tvshow_status.tvshow.id in favorite_tvshow_ids
+            'is_favorite': tvshow_status.tvshow_id in favorite_tvshow_ids
         })
     
     # Process posters for all TV shows
-    for status, tvshows in tvshows_by_status.items():
-        for item in tvshows:
-            if item['tvshow'].poster_path:
-                item['tvshow'].cached_poster_url = get_or_cache_poster(item['tvshow'].poster_path)
+    resolve_posters([item['tvshow'] for tvshows in tvshows_by_status.values() for item in tvshows])
     
     # Context data for template
     context = {
@@ -1117,50 +1054,48 @@ def friend_watch_list(request, friend_id):
     active_tab = request.GET.get('tab', 'movies')  # По умолчанию, вкладка фильмов
     active_status = request.GET.get('status', WatchStatus.COMPLETED)  # По умолчанию, завершенные
     
-    # Подготавливаем словари для хранения статусов фильмов и сериалов
-    movies_by_status = {status[0]: [] for status in WatchStatus.choices}
-    tvshows_by_status = {status[0]: [] for status in WatchStatus.choices}
-    
-    # Получаем статусы фильмов друга
-    movie_statuses = MovieWatchStatus.objects.filter(user=friend).select_related('movie')
-    for status in movie_statuses:
-        is_favorite = status.movie.favorited_by.filter(id=friend.id).exists()
-        movies_by_status[status.status].append({
-            'movie': status.movie,
-            'status': status.status,
-            'is_rewatching': status.is_rewatching,
-            'is_favorite': is_favorite
-        })
-    
-    # Получаем статусы сериалов друга
-    tvshow_statuses = TVShowWatchStatus.objects.filter(user=friend).select_related('tvshow')
-    for status in tvshow_statuses:
-        is_favorite = status.tvshow.favorited_by.filter(id=friend.id).exists()
-        tvshows_by_status[status.status].append({
-            'tvshow': status.tvshow,
-            'status': status.status,
-            'is_rewatching': status.is_rewatching,
-            'is_favorite': is_favorite
-        })
+    if active_status not in WatchStatus.values:
+        active_status = WatchStatus.COMPLETED
     
-    # Добавляем кэшированные URL постеров
-    for status in WatchStatus.choices:
-        status_code = status[0]
-        for item in movies_by_status[status_code]:
-            if item['movie'].poster_path:
-                item['movie'].cached_poster_url = get_or_cache_poster(item['movie'].poster_path)
-        
-        for item in tvshows_by_status[status_code]:
-            if item['tvshow'].poster_path:
-                item['tvshow'].cached_poster_url = get_or_cache_poster(item['tvshow'].poster_path)
+    if active_tab == 'movies':
+        statuses = MovieWatchStatus.objects.filter(user=friend)
+        item_field = 'movie'
+        favorites = Movie.favorited_by.through.objects.filter(movie_id=OuterRef('movie_id'), user_id=friend.id)
+    else:
+        statuses = TVShowWatchStatus.objects.filter(user=friend)
+        item_field = 'tvshow'
+        favorites = TVShow.favorited_by.through.objects.filter(tvshow_id=OuterRef('tvshow_id'), user_id=friend.id)
+    
+    # Количество записей по всем статусам - одним агрегирующим запросом
+    status_counts = dict.fromkeys(WatchStatus.values, 0)
+    status_counts.update(statuses.values_list('status').annotate(count=Count('id')).order_by())
+    
+    # Загружаем только страницу активного статуса, признак избранного - подзапросом Exists
+    active_statuses = statuses.filter(status=active_status).select_related(item_field).annotate(
+        is_favorite=Exists(favorites)
+    ).order_by('-updated_at', '-id')
+    paginator = Paginator(active_statuses, 24)
+    # Количество уже известно из агрегата - Paginator не будет считать его повторно
+    paginator.count = status_counts[active_status]
+    page = paginator.get_page(request.GET.get('page', 1))
+    
+    items = [{
+        item_field: getattr(status, item_field),
+        'status': status.status,
+        'is_rewatching': status.is_rewatching,
+        'is_favorite': status.is_favorite
+    } for status in page]
+    
+    # Добавляем кэшированные URL постеров только для видимой страницы
+    resolve_posters([item[item_field] for item in items])
     
     context = {
         'friend': friend,
         'active_tab': active_tab,
         'active_status': active_status,
-        'statuses': WatchStatus.choices,
-        'movies_by_status': movies_by_status,
-        'tvshows_by_status': tvshows_by_status
+        'statuses': [(code, text, status_counts[code]) for code, text in WatchStatus.choices],
+        'items': items,
+        'page': page
     }
     
     return render(request, 'movies/friend_watch_list.html', context)
@@ -1196,30 +1131,20 @@ def friend_favorites(request, friend_id):
     # Определяем активную вкладку (по умолчанию - фильмы)
     active_tab = request.GET.get('tab', 'movies')
     
-    # Получаем избранные фильмы друга
-    favorite_movies = friend.favorite_movies.all()
-    # Добавляем кэшированные URL постеров к фильмам
-    favorite_movies = process_movie_posters(favorite_movies)
-    
-    # Получаем избранные сериалы друга
-    favorite_tvshows = friend.favorite_tvshows.all()
-    # Добавляем кэшированные URL постеров к сериалам
-    favorite_tvshows = process_tvshow_posters(favorite_tvshows)
-    
-    # Настраиваем пагинацию для фильмов
-    movies_paginator = Paginator(favorite_movies, 12)
-    movies_page = request.GET.get('page_movies', 1)
-    favorite_movies_page = movies_paginator.get_page(movies_page)
-    
-    # Настраиваем пагинацию для сериалов
-    tvshows_paginator = Paginator(favorite_tvshows, 12)
-    tvshows_page = request.GET.get('page_tvshows', 1)
-    favorite_tvshows_page = tvshows_paginator.get_page(tvshows_page)
+    # Загружаем только активную вкладку: страницу избранного друга по курсору
+    favorite_movies = favorite_tvshows = None
+    if active_tab == 'movies':
+        favorite_movies = favorites_page(friend, Movie, request.GET.get('after'), request.GET.get('before'))
+        # Постеры - только для видимой страницы
+        process_movie_posters(favorite_movies.object_list)
+    else:
+        favorite_tvshows = favorites_page(friend, TVShow, request.GET.get('after'), request.GET.get('before'))
+        process_tvshow_posters(favorite_tvshows.object_list)
     
     context = {
         'friend': friend,
-        'favorite_movies': favorite_movies_page,
-        'favorite_tvshows': favorite_tvshows_page,
+        'favorite_movies': favorite_movies,
+        'favorite_tvshows': favorite_tvshows,
         'active_tab': active_tab
     }
     return render(request, 'movies/friend_favorites.html', context)
@@ -1231,23 +1156,17 @@ def movies_home(request):
     
     movies = []
     if popular_movies_data and 'results' in popular_movies_data:
-        # Convert TMDB data to our internal format for display
-        for movie_data in popular_movies_data['results'][:12]:  # Display top 12 movies
-            # Save or update the movie in our database
-            movie_dict = tmdb_api.format_movie_data(movie_data)
-            movie, created = Movie.objects.update_or_create(
-                tmdb_id=movie_dict['tmdb_id'],
-                defaults=movie_dict
-            )
-            movies.append(movie)
+        # Save or update the top 12 movies in our database in one bulk upsert
+        movies = upsert_movies([
+            tmdb_api.format_movie_data(movie_data)
+            for movie_data in popular_movies_data['results'][:12]
+        ])
     
     # Добавляем кэшированные URL постеров к популярным фильмам
     movies = process_movie_posters(movies)
     
     # Also get some movies from our database that have reviews
-    local_movies = Movie.objects.annotate(avg_rating=Avg('reviews__rating')).filter(
-        reviews__isnull=False
-    ).distinct().order_by('-avg_rating')[:6]
+    local_movies = Movie.objects.filter(review_count__gt=0).order_by('-avg_rating', '-review_count')[:6]
     
     # Добавляем кэшированные URL постеров к фильмам с отзывами
     local_movies = process_movie_posters(local_movies)
@@ -1258,3 +1177,46 @@ def movies_home(request):
         'search_form': MovieSearchForm()  # Используем такую же форму поиска, как для сериалов
     }
     return render(request, 'movies/movies_home.html', context)
+
+
+def poster_file(request, size, poster_path):
+    """
+    Serves a cached image through nginx (X-Accel-Redirect), fetching it from TMDB on a miss.
+    Only images referenced by stored movies, shows, seasons and episodes are fetched;
+    other paths (e.g. transient search results) are redirected to the TMDB CDN.
+    Requests carrying the current content hash (?v=...) are cacheable forever.
+    """
+    if size not in IMAGE_SIZES or '..' in poster_path.split('/'):
+        raise Http404("Image not found")
+    local_path = poster_local_path(poster_path, size)
+    version = request.GET.get('v')
+    if poster_path.startswith('derived/'):
+        # Производные создаются вместе с оригиналом и версионируются его хешем; нет файла - nginx ответит 404
+        immutable = bool(version)
+    else:
+        info = poster_presence.get(local_path)
+        if not info and not is_known_image(poster_path):
+            return redirect(tmdb_image_url(poster_path, size))
+        if not info and fetch_poster(poster_path, size):
+            info = poster_presence.get(local_path)
+        if not info:
+            failure = poster_failures.get(local_path)
+            if failure and failure['missing']:
+                raise Http404("Image not found")
+            return redirect(tmdb_image_url(poster_path, size))
+        immutable = bool(version) and version == info.content_hash
+
+    if settings.DEBUG:
+        # Без nginx отдаем файл сами
+        if not default_storage.exists(local_path):
+            raise Http404("Image not found")
+        response = FileResponse(default_storage.open(local_path))
+    else:
+        response = HttpResponse(content_type=mimetypes.guess_type(local_path)[0])
+        response['X-Accel-Redirect'] = f"{settings.POSTER_X_ACCEL_LOCATION}{local_path}"
+
+    if immutable:
+        response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response['Cache-Control'] = 'public, max-age=86400'
+    return response
@@ -113,6 +113,17 @@ else:
         }
     }
 
+# Cache
+# Общий кэш для всех воркеров: задайте CACHE_BACKEND/CACHE_LOCATION, например
+# django.core.cache.backends.db.DatabaseCache (после manage.py createcachetable)
+# или django.core.cache.backends.redis.RedisCache
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', 'tmdb-net'),
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -171,6 +182,83 @@ LOGIN_URL = 'login'  # URL to redirect for login when using @login_required
 TMDB_API_KEY = os.environ.get('TMDB_API_KEY', '')
 TMDB_API_URL = 'https://api.themoviedb.org/3'
 
+# Пул HTTP-соединений к TMDB (один на процесс/воркер gunicorn)
+TMDB_HTTP_POOL_SIZE = int(os.environ.get('TMDB_HTTP_POOL_SIZE', 10))
+TMDB_HTTP_POOL_BLOCK = os.environ.get('TMDB_HTTP_POOL_BLOCK', 'False') == 'True'
+TMDB_HTTP_CONNECT_TIMEOUT = float(os.environ.get('TMDB_HTTP_CONNECT_TIMEOUT', 3.05))
+TMDB_HTTP_READ_TIMEOUT = float(os.environ.get('TMDB_HTTP_READ_TIMEOUT', 10))
+
+# Кэш ответов TMDB: локальный LRU в каждом воркере + общий бэкенд Django
+TMDB_CACHE_ALIAS = os.environ.get('TMDB_CACHE_ALIAS', 'default')
+TMDB_CACHE_LOCAL_MAX_ENTRIES = int(os.environ.get('TMDB_CACHE_LOCAL_MAX_ENTRIES', 512))
+# Переопределение TTL по семействам эндпоинтов, например {'popular': 3600}
+TMDB_CACHE_TTLS = {}
+# Сколько хранить просроченные ответы для отдачи во время сбоев TMDB
+TMDB_CACHE_STALE_TTL = int(os.environ.get('TMDB_CACHE_STALE_TTL', 24 * 60 * 60))
+# Объединение одинаковых одновременных запросов между процессами через блокировку в кэше
+# (внутри процесса запросы объединяются всегда)
+TMDB_SINGLE_FLIGHT_SHARED = os.environ.get('TMDB_SINGLE_FLIGHT_SHARED', 'False') == 'True'
+# Сколько секунд ожидающий процесс ждет результата ведущего (сама блокировка живет до tmdb_api.max_fetch_time())
+TMDB_SINGLE_FLIGHT_TIMEOUT = float(os.environ.get('TMDB_SINGLE_FLIGHT_TIMEOUT', 10))
+# Сколько секунд ожидающие процессы помнят, что запрос ведущего процесса не дал результата (404, TMDB недоступен)
+TMDB_SINGLE_FLIGHT_MISS_TTL = int(os.environ.get('TMDB_SINGLE_FLIGHT_MISS_TTL', 5))
+
+# Ограничение частоты запросов к TMDB: 'local' - в пределах воркера,
+# 'cache' - общий для всех воркеров token bucket в кэше TMDB_CACHE_ALIAS
+TMDB_RATE_LIMIT_BACKEND = os.environ.get('TMDB_RATE_LIMIT_BACKEND', 'local')
+TMDB_RATE_LIMIT = float(os.environ.get('TMDB_RATE_LIMIT', 40))  # запросов в секунду
+TMDB_RATE_LIMIT_BURST = int(os.environ.get('TMDB_RATE_LIMIT_BURST', 40))
+TMDB_RATE_LIMIT_WAIT = float(os.environ.get('TMDB_RATE_LIMIT_WAIT', 5))
+# Повторы при 429/5xx с экспоненциальной задержкой и circuit breaker
+TMDB_MAX_RETRIES = int(os.environ.get('TMDB_MAX_RETRIES', 3))
+TMDB_RETRY_BACKOFF_BASE = float(os.environ.get('TMDB_RETRY_BACKOFF_BASE', 0.5))
+TMDB_RETRY_BACKOFF_MAX = float(os.environ.get('TMDB_RETRY_BACKOFF_MAX', 8))
+TMDB_CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('TMDB_CIRCUIT_FAILURE_THRESHOLD', 5))
+TMDB_CIRCUIT_RESET_TIMEOUT = float(os.environ.get('TMDB_CIRCUIT_RESET_TIMEOUT', 30))
+# Максимум параллельных запросов при пакетной загрузке (например, сезонов сериала)
+TMDB_BATCH_WORKERS = int(os.environ.get('TMDB_BATCH_WORKERS', 4))
+
+# Асинхронные версии главной и детальных страниц (включать при запуске под ASGI,
+# например: gunicorn tmdb_net.asgi:application -k uvicorn.workers.UvicornWorker)
+ASYNC_VIEWS = os.environ.get('ASYNC_VIEWS', 'False') == 'True'
+
+# Запись о фильме/сериале старше этого возраста (в секундах) отдается из БД,
+# а обновление из TMDB выполняется в фоне
+TMDB_DETAIL_MAX_AGE = int(os.environ.get('TMDB_DETAIL_MAX_AGE', 6 * 60 * 60))
+
+# Фоновые задачи (пул потоков в каждом воркере)
+BACKGROUND_TASKS_WORKERS = int(os.environ.get('BACKGROUND_TASKS_WORKERS', 4))
+BACKGROUND_TASKS_EAGER = os.environ.get('BACKGROUND_TASKS_EAGER', 'False') == 'True'
+# Отдельные пулы: загрузка постеров не должна занимать потоки остальных задач
+BACKGROUND_TASKS_POOLS = {
+    'posters': int(os.environ.get('POSTER_DOWNLOAD_WORKERS', 4)),
+}
+
+# Сколько секунд кэшируется количество элементов в избранном (сбрасывается при изменении избранного)
+FAVORITES_COUNT_CACHE_TIMEOUT = int(os.environ.get('FAVORITES_COUNT_CACHE_TIMEOUT', 300))
+
+# Кэш постеров: как часто (в секундах) сохранять в индекс время последнего доступа
+POSTER_ACCESS_FLUSH_INTERVAL = int(os.environ.get('POSTER_ACCESS_FLUSH_INTERVAL', 60))
+# Как часто (в секундах) воркер перечитывает из индекса набор закэшированных постеров
+POSTER_PRESENCE_RELOAD_INTERVAL = int(os.environ.get('POSTER_PRESENCE_RELOAD_INTERVAL', 300))
+# Как часто (в секундах) воркер сверяет с общим кэшем счетчик удалений постеров другими процессами
+POSTER_PRESENCE_CHECK_INTERVAL = int(os.environ.get('POSTER_PRESENCE_CHECK_INTERVAL', 5))
+# Бюджет кэша постеров: при превышении в фоне вытесняются давно не использованные
+# изображения, пока размер не опустится до POSTER_CACHE_EVICT_TARGET от бюджета
+POSTER_CACHE_MAX_SIZE_MB = int(os.environ.get('POSTER_CACHE_MAX_SIZE_MB', 500))
+POSTER_CACHE_EVICT_TARGET = float(os.environ.get('POSTER_CACHE_EVICT_TARGET', 0.9))
+# Негативный кэш постеров: задержка повтора после неудачной загрузки (секунды),
+# удваивается с каждой неудачей подряд; для 404 - отдельная, более долгая
+POSTER_RETRY_BACKOFF_BASE = int(os.environ.get('POSTER_RETRY_BACKOFF_BASE', 60))
+POSTER_MISSING_BACKOFF_BASE = int(os.environ.get('POSTER_MISSING_BACKOFF_BASE', 60 * 60))
+POSTER_RETRY_BACKOFF_MAX = int(os.environ.get('POSTER_RETRY_BACKOFF_MAX', 24 * 60 * 60))
+# Ширины (в пикселях) уменьшенных копий постеров в WebP/AVIF для srcset
+POSTER_DERIVATIVE_WIDTHS = [int(w) for w in os.environ.get('POSTER_DERIVATIVE_WIDTHS', '185,342,500').split(',')]
+# Отдавать постеры через Django с X-Accel-Redirect на внутренний location nginx:
+# при промахе кэша изображение загружается с TMDB по первому запросу браузера
+POSTER_X_ACCEL_REDIRECT = os.environ.get('POSTER_X_ACCEL_REDIRECT', 'False') == 'True'
+POSTER_X_ACCEL_LOCATION = os.environ.get('POSTER_X_ACCEL_LOCATION', '/protected-media/')
+
 # Email settings
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 # EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
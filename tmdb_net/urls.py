@@ -32,6 +32,7 @@ urlpatterns = [
     path('admin/test-api-connection/', tmdb_admin.test_api_connection_view, name='admin-test-tmdb-api'),
     path('admin/test-api-connection/check/', tmdb_admin.check_api_connection, name='admin-check-tmdb-api'),
     path('admin/test-api-popular/', tmdb_admin.test_popular_movies, name='admin-test-popular-movies'),
+    path('admin/tmdb-cache-stats/', admin.site.admin_view(tmdb_admin.tmdb_cache_stats), name='admin-tmdb-cache-stats'),
     
     # Основные маршруты админки
     path('admin/', admin.site.urls),